@@ -25,14 +25,30 @@ migrate = Migrate()
 @click.command(name='start_lis_server')
 @click.option('--port')
 @click.option('--interface')
+@click.option(
+    '--bind', 'binds', multiple=True,
+    help='NIC_OR_IP:PORT[@profile], repeatable (default: LIS_BINDS)'
+)
+@click.option(
+    '--engine', type=click.Choice(['asyncio', 'legacy']),
+    help='Listener implementation (default: LIS_ENGINE)'
+)
 @with_appcontext
-def start_lis_server(port, interface):
-    if(not interface):
-        interface = current_app.config['DEFAULT_LIS_NIC']
-    if(not port):
-        port = current_app.config['DEFAULT_LIS_PORT']
-    from agentpi.apps.astm.server import run_server
-    run_server(current_app, port, interface)
+def start_lis_server(port, interface, binds, engine):
+    from agentpi.apps.astm.server import parse_binds, run_server
+    if(not binds and not (port or interface)):
+        binds = current_app.config['LIS_BINDS']
+    if(not binds):
+        if(not interface):
+            interface = current_app.config['DEFAULT_LIS_NIC']
+        if(not port):
+            port = current_app.config['DEFAULT_LIS_PORT']
+        binds = [f"{interface}:{port}"]
+    try:
+        binds = parse_binds(binds)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--bind')
+    run_server(current_app, binds, engine=engine)
 
 
 @click.command(name='send_lis_test')
@@ -43,17 +59,80 @@ def send_lis_test():
 
 
 @click.command(name='publish_results')
+@click.option('--concurrency', default=4, show_default=True, help='Parallel uploads')
+@click.option('--rate', type=float, help='Max uploads per second')
+@click.option('--since', type=click.DateTime(), help='created_at >= (UTC)')
+@click.option('--until', type=click.DateTime(), help='created_at < (UTC)')
+@click.option('--dry-run', is_flag=True, help='List, do not send')
 @with_appcontext
-def publish_results():
+def publish_results(concurrency, rate, since, until, dry_run):
     from agentpi.apps.astm.models import publish_results
-    publish_results(current_app)
+    publish_results(
+        current_app,
+        concurrency=concurrency,
+        rate=rate,
+        since=since,
+        until=until,
+        dry_run=dry_run,
+    )
+
+
+@click.command(name='start_retry_service')
+@with_appcontext
+def start_retry_service():
+    from agentpi.apps.astm.retry import RetryScheduler
+    RetryScheduler(current_app._get_current_object()).serve_forever()
 
 
 @click.command(name='show_results')
+@click.option('--since', type=click.DateTime(), help='created_at >= (UTC)')
+@click.option('--until', type=click.DateTime(), help='created_at < (UTC)')
+@click.option('--instrument', help='Instrument serial number')
+@click.option('--status', type=click.Choice(['uploaded', 'error', 'skipped']))
+@click.option(
+    '--format', 'fmt', default='table', show_default=True,
+    type=click.Choice(['table', 'csv', 'ndjson'])
+)
 @with_appcontext
-def show_results():
+def show_results(since, until, instrument, status, fmt):
     from agentpi.apps.astm.models import show_results
-    show_results(current_app)
+    show_results(
+        current_app,
+        since=since,
+        until=until,
+        instrument=instrument,
+        status=status,
+        fmt=fmt,
+    )
+
+
+@click.command(name='show_spool')
+@click.option('--segment', type=int, help='Print the entries of this segment')
+@click.option('--dead-letter', is_flag=True,
+              help='Print the entries the database rejected')
+@with_appcontext
+def show_spool(segment, dead_letter):
+    from agentpi.apps.astm.spool import show_spool
+    show_spool(current_app, segment=segment, dead_letter=dead_letter)
+
+
+@click.command(name='replay_spool')
+@with_appcontext
+def replay_spool():
+    from agentpi.apps.astm.spool import SpoolIngester
+    if(not current_app.config['LIS_SPOOL_DIR']):
+        raise click.UsageError('LIS_SPOOL_DIR is not set')
+    app = current_app._get_current_object()
+    try:
+        count = SpoolIngester(app).replay()
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    finally:
+        # let the uploads the replay enqueued go out
+        upload_queue = app.extensions.get('astm_upload_queue')
+        if(upload_queue is not None):
+            upload_queue.stop(timeout=60)
+    print(f"{count} spooled datagrams ingested")
 
 
 def create_app():
@@ -86,7 +165,10 @@ def create_app():
     app.cli.add_command(start_lis_server)
     app.cli.add_command(send_lis_test)
     app.cli.add_command(publish_results)
+    app.cli.add_command(start_retry_service)
     app.cli.add_command(show_results)
+    app.cli.add_command(show_spool)
+    app.cli.add_command(replay_spool)
 
     with app.app_context():
         from agentpi.apps.astm import astm_bp
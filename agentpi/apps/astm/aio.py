@@ -0,0 +1,209 @@
+"""asyncio LIS1-A / ASTM E1381 listener."""
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from astm.constants import ACK, CRLF, ENQ, EOT, NAK, STX
+
+from .codec import FrameAssembler, FrameError
+from .dispatcher import AgentRecordDispatcher
+from .flow import get_flow_control
+from .metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class LISConnection(object):
+    """
+    One instrument connection: the ENQ / frames / EOT exchange of
+    astm.server.RequestHandler on asyncio streams. Records are handed to
+    the connection's own dispatcher on the executor, so a slow commit only
+    holds up the instrument that sent them.
+    """
+    def __init__(self, reader, writer, dispatcher, executor, timeout=None,
+                 flow=None):
+        self.reader = reader
+        self.writer = writer
+        self.dispatcher = dispatcher
+        self.executor = executor
+        self.timeout = timeout
+        self.flow = flow
+        self.peer = writer.get_extra_info('peername')
+        self.is_transfer_state = False
+        self.frames = FrameAssembler(dispatcher.config['LIS_CHECKSUM'])
+
+    async def read(self, coro):
+        if(self.timeout):
+            return await asyncio.wait_for(coro, self.timeout)
+        return await coro
+
+    async def send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def serve(self):
+        try:
+            while True:
+                data = await self.read(self.reader.read(1))
+                if(not data):
+                    break
+                resp = await self.on_data(data)
+                if(resp is not None):
+                    await self.send(resp)
+        except asyncio.TimeoutError:
+            logger.info(f"{self.peer}: idle timeout, closing")
+        except (
+            asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+            ConnectionError
+        ) as e:
+            logger.info(f"{self.peer}: connection lost {e!r}")
+        finally:
+            self.writer.close()
+
+    async def on_data(self, data):
+        if(data == ENQ):
+            return await self.on_enq()
+        elif(data == EOT):
+            return self.on_eot()
+        elif(data == STX):
+            frame = data + await self.read(self.reader.readuntil(CRLF))
+            return await self.on_message(frame)
+        elif(data in (ACK, NAK)):
+            logger.error(f"{self.peer}: server should not be ACKed/NAKed")
+        elif(data not in (b'\r', b'\n')):
+            logger.error(f"{self.peer}: unable to dispatch data: {data!r}")
+        return None
+
+    async def on_enq(self):
+        if(self.is_transfer_state):
+            logger.error(f"{self.peer}: ENQ is not expected")
+            return NAK
+        if(not await self.admit()):
+            return NAK
+        self.is_transfer_state = True
+        return ACK
+
+    async def admit(self):
+        """
+        flow.FlowControl gate of a new session; `delay` holds the ENQ
+        while waiting for the backpressure to clear
+        """
+        flow = self.flow
+        if(flow is None or flow.pressure() is None):
+            return True
+        if(flow.action == 'delay'):
+            loop = asyncio.get_event_loop()
+            deadline = loop.time() + flow.delay
+            while loop.time() < deadline:
+                await asyncio.sleep(min(flow.interval, deadline - loop.time()))
+                if(flow.pressure() is None):
+                    metrics.incr(
+                        f'lis.{self.dispatcher.listener}.backpressure_delayed'
+                    )
+                    return True
+        return flow.admit(self.dispatcher.listener)
+
+    def on_eot(self):
+        if(not self.is_transfer_state):
+            logger.error(f"{self.peer}: not ready to accept EOT")
+        self.is_transfer_state = False
+        self.frames.reset()
+        return None
+
+    async def on_message(self, message):
+        if(not self.is_transfer_state):
+            self.frames.reset()
+            return NAK
+        try:
+            # ETB frames are checked and held here, the dispatcher gets
+            # whole messages
+            message = self.frames.feed(message)
+        except FrameError as e:
+            logger.error(f"{self.peer}: {e}")
+            metrics.incr(f'lis.{self.dispatcher.listener}.nak')
+            return NAK
+        if(message is None):
+            return ACK
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        try:
+            await loop.run_in_executor(self.executor, self.dispatcher, message)
+        except Exception:
+            logger.exception('Error occurred on message handling.')
+            metrics.incr(f'lis.{self.dispatcher.listener}.nak')
+            return NAK
+        finally:
+            metrics.observe('lis.dispatch_seconds', time.perf_counter() - start)
+        return ACK
+
+
+class AsyncServer(object):
+    """
+    Serves any number of listeners and instruments from one event loop,
+    each connection gets its own dispatcher
+    """
+    def __init__(self, app, listeners, dispatcher=AgentRecordDispatcher,
+                 timeout=None, workers=None):
+        self.app = app
+        self.listeners = listeners
+        self.dispatcher = dispatcher
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers or app.config['LIS_EXECUTOR_WORKERS'],
+            thread_name_prefix='lis-dispatch',
+        )
+        self.connections = {listener.name: 0 for listener in listeners}
+        self.flow = get_flow_control(app)
+
+    async def handle(self, listener, reader, writer):
+        if(self.flow.refuses(listener.name)):
+            logger.warning(
+                f"{listener.name} {writer.get_extra_info('peername')}: "
+                f"refused, backpressure ({self.flow.reason})"
+            )
+            writer.close()
+            return
+        conn = LISConnection(
+            reader,
+            writer,
+            self.dispatcher(
+                app=self.app,
+                listener=listener.name,
+                profile=listener.profile,
+            ),
+            self.executor,
+            timeout=self.timeout,
+            flow=self.flow,
+        )
+        self.connections[listener.name] += 1
+        metrics.gauge(
+            f'lis.{listener.name}.open', self.connections[listener.name]
+        )
+        logger.info(f"{listener.name} {conn.peer}: connected")
+        try:
+            await conn.serve()
+        finally:
+            self.connections[listener.name] -= 1
+            metrics.gauge(
+                f'lis.{listener.name}.open', self.connections[listener.name]
+            )
+            logger.info(f"{listener.name} {conn.peer}: disconnected")
+
+    async def serve(self):
+        servers = [
+            await asyncio.start_server(
+                functools.partial(self.handle, listener),
+                listener.host,
+                listener.port,
+            ) for listener in self.listeners
+        ]
+        await asyncio.gather(*[s.serve_forever() for s in servers])
+
+    def serve_forever(self):
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.executor.shutdown(wait=True)
@@ -0,0 +1,58 @@
+"""Local archive sink, delivered results appended to daily NDJSON files."""
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+
+logger = logging.getLogger(__name__)
+
+
+class Archive(object):
+    """
+    `directory`/results-YYYYMMDD.ndjson, one line per result
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, now=None):
+        now = now or datetime.utcnow()
+        return os.path.join(self.directory, f"results-{now:%Y%m%d}.ndjson")
+
+    def append(self, dgid, payload):
+        line = json.dumps(dict(payload, dgid=dgid), sort_keys=True) + '\n'
+        with self.lock:
+            with open(self.path(), 'a', encoding='utf-8') as f:
+                f.write(line)
+
+
+def archive_payload(archive, dgid, payload):
+    """
+    Same contract as uplink.send_payload: (is_uploaded, is_error, failure)
+    """
+    try:
+        archive.append(dgid, payload)
+    except OSError as e:
+        logger.error(f"Archive write failed for patient_id '{payload['vialId']}': {e!r}")
+        return False, True, 'archive'
+    return True, False, None
+
+
+_lock = threading.Lock()
+
+
+def get_archive(app):
+    """
+    The app's Archive, None unless LIS_ARCHIVE_DIR is set
+    """
+    if(not app.config['LIS_ARCHIVE_DIR']):
+        return None
+    with _lock:
+        archive = app.extensions.get('astm_archive')
+        if(archive is None):
+            archive = Archive(app.config['LIS_ARCHIVE_DIR'])
+            app.extensions['astm_archive'] = archive
+        return archive
@@ -0,0 +1,131 @@
+"""Per-destination circuit breaker and adaptive read timeout for the uplinks."""
+import logging
+import threading
+import time
+from collections import deque
+
+from agentpi.library import percentile
+
+
+logger = logging.getLogger(__name__)
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# metrics gauge value of each state
+STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker(object):
+    """
+    Opens after `threshold` failures in a row; while open nothing is sent
+    until `reset_timeout` seconds have passed, then a single probe is let
+    through (half-open) which closes it again or re-opens it.
+
+    `on_change(old, new, breaker)` is called once per state change.
+    """
+    def __init__(self, name, threshold=5, reset_timeout=30.0, on_change=None):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.on_change = on_change
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def _set(self, state):
+        # under self.lock, returns the change for _notify
+        old, self.state = self.state, state
+        if(state == OPEN):
+            self.opened_at = time.monotonic()
+        return (old, state) if old != state else None
+
+    def _notify(self, change):
+        if(change is None):
+            return
+        logger.warning(f"uplink '{self.name}': circuit {change[0]} -> {change[1]}")
+        if(self.on_change is not None):
+            try:
+                self.on_change(change[0], change[1], self)
+            except Exception:
+                ## DO NOT BREAK!!!
+                logger.exception("Circuit breaker state change hook failed")
+
+    def remaining(self):
+        """
+        Seconds until an open circuit lets a probe through (0 otherwise)
+        """
+        if(self.state != OPEN):
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self):
+        """
+        May a request go out now? Claims the probe when half-open.
+        """
+        if(not self.threshold):
+            return True
+        change = None
+        with self.lock:
+            if(self.state == OPEN):
+                if(self.remaining() > 0):
+                    return False
+                change = self._set(HALF_OPEN)
+            if(self.state == HALF_OPEN):
+                if(self.probing):
+                    allowed = False
+                else:
+                    self.probing = allowed = True
+            else:
+                allowed = True
+        self._notify(change)
+        return allowed
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            change = self._set(CLOSED)
+        self._notify(change)
+
+    def failure(self):
+        if(not self.threshold):
+            return
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            change = None
+            if(self.state == HALF_OPEN or self.failures >= self.threshold):
+                change = self._set(OPEN)
+        self._notify(change)
+
+
+class AdaptiveTimeout(object):
+    """
+    Read timeout of `factor` x the p95 of the last `window` successful
+    requests, kept within [minimum, maximum]; `maximum` until `warmup`
+    requests were seen (or with factor 0)
+    """
+    def __init__(self, maximum, minimum=1.0, factor=3.0, window=200,
+                 warmup=20):
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.factor = factor
+        self.warmup = warmup
+        self.samples = deque(maxlen=window)
+        self.value = maximum
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        if(not self.factor):
+            return
+        with self.lock:
+            self.samples.append(seconds)
+            if(len(self.samples) < self.warmup):
+                return
+            p95 = percentile(sorted(self.samples), 95)
+            self.value = min(self.maximum, max(self.minimum, p95 * self.factor))
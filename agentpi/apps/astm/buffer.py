@@ -0,0 +1,74 @@
+"""Raw message buffer of one datagram (H .. L)."""
+from tempfile import TemporaryFile
+
+
+class MessageBuffer(object):
+    """
+    Raw messages of the current datagram, kept up to `max_bytes` (0 = no
+    limit): messages past the cap are dropped and counted, the ones kept
+    are stored as is. Past `spool_bytes` (0 = never) they are spilled to
+    a temporary file instead of memory.
+    """
+    __slots__ = (
+        'max_bytes', 'spool_bytes', 'size', 'sizes', 'chunks', 'file',
+        'dropped', 'dropped_bytes'
+    )
+
+    def __init__(self, max_bytes=0, spool_bytes=0):
+        self.max_bytes = max_bytes
+        self.spool_bytes = spool_bytes
+        self.size = 0
+        self.sizes = []
+        self.chunks = []
+        self.file = None
+        self.dropped = 0
+        self.dropped_bytes = 0
+
+    def __len__(self):
+        return len(self.sizes)
+
+    @property
+    def truncated(self):
+        return self.dropped > 0
+
+    def append(self, message):
+        """
+        Keep `message`, False when the cap made us drop it
+        """
+        if(self.max_bytes and self.size + len(message) > self.max_bytes):
+            self.dropped += 1
+            self.dropped_bytes += len(message)
+            return False
+        self.sizes.append(len(message))
+        self.size += len(message)
+        if(self.file is not None):
+            self.file.write(message)
+        elif(self.spool_bytes and self.size > self.spool_bytes):
+            self.file = TemporaryFile()
+            self.file.writelines(self.chunks)
+            self.file.write(message)
+            self.chunks = []
+        else:
+            self.chunks.append(message)
+        return True
+
+    def __iter__(self):
+        if(self.file is None):
+            yield from self.chunks
+            return
+        self.file.seek(0)
+        for size in self.sizes:
+            yield self.file.read(size)
+        self.file.seek(0, 2)
+
+    def clear(self):
+        if(self.file is not None):
+            self.file.close()
+        self.file = None
+        self.size = 0
+        self.sizes = []
+        self.chunks = []
+        self.dropped = 0
+        self.dropped_bytes = 0
+
+    close = clear
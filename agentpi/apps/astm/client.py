@@ -1,14 +1,16 @@
-import re
 import logging
 import netifaces as ni
 from datetime import datetime
 
 from astm import client
+from astm.constants import EOT
 from astm.records import (
     HeaderRecord, PatientRecord, OrderRecord, TerminatorRecord
 )
 
 from agentpi.library import is_ipv4
+from .codec import OFF, decode_message, encode
+from .timestamps import parse_timestamp
 from .records import (
     QuidelHeaderRecord, QuidelPatientRecord, QuidelOrderRecord,
     QuidelCommentRecord, QuidelResultRecord
@@ -75,56 +77,73 @@ test_string_04 = [
     b'\x026L|1|N\r\x0309\r\n'
 ]
 
-def generate_record_from_byte_string(input):
-    unicode_string = ''.join([chr(x) for x in input])
-    clean_string1 = re.sub(r'^\x02', '', unicode_string)  # drop 1st character (\x02)
-    clean_string2 = re.sub(r'\r\x03[A-F0-9]{2}\r\n$', '', clean_string1)  # drop last character \r\x03...
-    record = clean_string2.split('|')
+class CodecEmitter(client.Emitter):
+    """
+    astm client Emitter that frames records with our codec
+    """
+    def _send_record(self, record):
+        if self.bulk_mode:
+            return super()._send_record(record)
+        self.last_seq += 1
+        chunks = encode([record], self.encoding, self.chunk_size, self.last_seq)
+        self.buffer.extend(chunks)
+        data = self.buffer.pop(0)
+        self.last_seq += len(self.buffer)
+        if record[0] == 'L':
+            self.last_seq = 0
+            self.buffer.append(EOT)
+        return data
+
+
+class LISClient(client.Client):
+    emitter_wrapper = CodecEmitter
 
-    if(record[0] == '1H'):
+
+def record_from_message(message):
+    """
+    Captured frame -> Quidel record (the captures' checksums were edited by
+    hand, so they aren't verified)
+    """
+    seq, records = decode_message(message, verify=OFF)
+    record = records[0]
+    if(record.type == 'H'):
         # HEADER
         qhr = QuidelHeaderRecord()
         qhr.instrument = record[4]
-        qhr.firmware = record[12]
-        qhr.timestamp = datetime.strptime(
-            record[13],
-            "%Y%m%d%H%M%S"
-        )
+        qhr.firmware = record.text(12)
+        qhr.timestamp = parse_timestamp(record.text(13))
         return qhr
-    elif(record[0] == '2P'):
+    elif(record.type == 'P'):
         # PATIENT
         qpr = QuidelPatientRecord()
-        qpr.patient_id = record[2]
-        qpr.location = record[25]
+        qpr.patient_id = record.text(2)
+        qpr.location = record.text(25)
         return qpr
-    elif(record[0] == '3O'):
+    elif(record.type == 'O'):
         qor = QuidelOrderRecord()
-        qor.order_id = record[2]
-        qor.test_type = record[4]
-        qor.operator_id = record[10]
-        qor.sample_type = record[15]
+        qor.order_id = record.text(2)
+        qor.test_type = record.text(4)
+        qor.operator_id = record.text(10)
+        qor.sample_type = record.text(15)
         return qor
-    elif(record[0] == '4C'):
+    elif(record.type == 'C'):
         qcr = QuidelCommentRecord()
-        qcr.sample_comment = record[3]
+        qcr.sample_comment = record.text(3)
         return qcr
-    elif(record[0] == '5R'):
+    elif(record.type == 'R'):
         qrr = QuidelResultRecord()
-        qrr.analyte_name = record[2]
-        qrr.test_value = record[3]
-        qrr.test_units = record[4]
-        qrr.test_range = record[5]
-        qrr.test_flag = record[6]
-        qrr.test_type = record[8]
-        qrr.completion = datetime.strptime(
-            record[12],
-            "%Y%m%d%H%M%S"
-        )
+        qrr.analyte = record[2]
+        qrr.test_value = record.text(3)
+        qrr.test_units = record.text(4)
+        qrr.test_range = record.text(5)
+        qrr.test_flag = record.text(6)
+        qrr.test_type = record.text(8)
+        qrr.completion = parse_timestamp(record.text(12))
         return qrr
-    elif(record[0] == '6L'):
+    elif(record.type == 'L'):
         return TerminatorRecord()
     else:
-        raise Exception(f"Malformed string: {input}")
+        raise Exception(f"Malformed string: {message}")
 
 
 def string_emitter():
@@ -132,7 +151,7 @@ def string_emitter():
     Given recorded strings, emit LIS1-A messaging...
     """
     emit_list = [
-       generate_record_from_byte_string(x) for x in test_string_01
+       record_from_message(x) for x in test_string_01
     ]
     patient = False
     for gr in emit_list:
@@ -150,8 +169,7 @@ def string_emitter():
 
 def emitter():
     qhr = QuidelHeaderRecord()
-    qhr.model = 'Sopfia'
-    qhr.serial = '29000021'
+    qhr.instrument = ['Sopfia', '29000021']
     qhr.firmware = '1.7.0'
     qhr.timestamp = '20000101000000'
 
@@ -177,7 +195,7 @@ def emitter():
         qcrs.append(qcr)
 
         qrr = QuidelResultRecord()
-        qrr.analyte_name = '^^^Flu A'
+        qrr.analyte = [None, None, None, 'Flu A']
         qrr.test_value = 'positive'
         qrr.test_units = ''
         qrr.test_range = ''
@@ -208,7 +226,7 @@ def run_client(current_app):
             print(str(e))
             return
     logger.info(f"Launching client service on {astm_nic}: {ip}:{astm_port}")
-    c = client.Client(
+    c = LISClient(
         string_emitter,
         host=ip,
         port=astm_port,
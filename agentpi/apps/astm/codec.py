@@ -0,0 +1,269 @@
+"""LIS1-A / ASTM E1381 frame codec.
+
+Frames are checked on a memoryview (checksum summed in C, no per-byte
+Python work) and a record's fields are only split and decoded when asked
+for.
+"""
+import logging
+from collections import namedtuple
+
+from .metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+ENCODING = 'latin-1'
+
+STX = 0x02
+ETX = 0x03
+ETB = 0x17
+CR = b'\r'
+CRLF = b'\r\n'
+RECORD_SEP = b'\r'
+FIELD_SEP = b'|'
+REPEAT_SEP = b'\\'
+COMPONENT_SEP = b'^'
+
+# checksum handling (LIS_CHECKSUM)
+STRICT = 'strict'  # reject the frame
+WARN = 'warn'  # log, count and accept
+OFF = 'off'  # don't compute it
+CHECKSUM_MODES = (STRICT, WARN, OFF)
+
+# 240 characters of text per frame (ASTM E1381) + 7 control characters
+MAX_FRAME_SIZE = 247
+
+
+class FrameError(ValueError):
+    """Not a well formed LIS1-A frame"""
+
+
+class ChecksumError(FrameError):
+    """Frame checksum doesn't match its content"""
+
+
+Frame = namedtuple('Frame', ['seq', 'data', 'is_final'])
+
+
+def checksum(data):
+    """
+    Modulo 256 sum of `data` (bytes, bytearray or memoryview)
+    """
+    return sum(data) & 0xFF
+
+
+def split_frame(message, verify=STRICT):
+    """
+    STX seq data <ETX|ETB> C1 C2 CR LF -> Frame, `data` is a memoryview
+    into `message` and keeps the record separator before ETX
+    """
+    view = memoryview(message)
+    size = len(view)
+    if(size < 7 or view[0] != STX or view[size - 2:] != CRLF):
+        raise FrameError(f"Malformed frame: {bytes(view)!r}")
+    end = size - 4
+    terminator = view[end - 1]
+    if(terminator == ETX):
+        is_final = True
+    elif(terminator == ETB):
+        is_final = False
+    else:
+        raise FrameError(f"Expected ETX or ETB: {bytes(view)!r}")
+    seq = view[1] - 0x30
+    if(not 0 <= seq <= 7):
+        raise FrameError(f"Bad frame number: {bytes(view)!r}")
+    if(verify != OFF):
+        try:
+            expected = int(bytes(view[end:end + 2]), 16)
+        except ValueError:
+            raise FrameError(f"Bad checksum characters: {bytes(view)!r}")
+        actual = checksum(view[1:end])
+        if(expected != actual):
+            if(verify == STRICT):
+                raise ChecksumError(
+                    f"Checksum failure: expected {expected:02X}, calculated "
+                    f"{actual:02X}: {bytes(view)!r}"
+                )
+            logger.warning(
+                f"Checksum mismatch, expected {expected:02X}, calculated "
+                f"{actual:02X}: {bytes(view)!r}"
+            )
+            metrics.incr('lis.checksum_mismatch')
+    return Frame(seq, view[2:end - 1], is_final)
+
+
+def build_frame(seq, data, is_final=True):
+    """
+    Wrap `data` (records, the last one CR terminated) into a frame
+    """
+    body = b'%d%s%c' % (seq % 8, data, ETX if is_final else ETB)
+    return b'\x02%s%02X\r\n' % (body, checksum(body))
+
+
+class FrameAssembler(object):
+    """
+    Collects ETB intermediate frames until the final ETX frame.
+
+    feed() returns None while a message is incomplete, else one complete
+    single frame message (the frame as is when it wasn't split).
+    """
+    def __init__(self, verify=STRICT):
+        self.verify = verify
+        self.parts = []
+
+    def feed(self, message):
+        frame = split_frame(message, self.verify)
+        if(frame.is_final and not self.parts):
+            return message
+        self.parts.append(frame.data)
+        if(not frame.is_final):
+            return None
+        data = b''.join(self.parts)
+        self.parts = []
+        return build_frame(1, data)
+
+    def reset(self):
+        self.parts = []
+
+
+def decode_field(raw, encoding=ENCODING):
+    """
+    Field bytes -> str, [components] or [[components], ...], None if empty
+    (the same shapes astm.codec.decode_record produces)
+    """
+    if(REPEAT_SEP in raw):
+        return [
+            decode_component(item, encoding) for item in raw.split(REPEAT_SEP)
+        ]
+    elif(COMPONENT_SEP in raw):
+        return decode_component(raw, encoding)
+    return raw.decode(encoding) or None
+
+
+def decode_component(raw, encoding=ENCODING):
+    return [
+        item.decode(encoding) or None for item in raw.split(COMPONENT_SEP)
+    ]
+
+
+class Record(object):
+    """
+    One record of a frame, fields are split on first access and decoded
+    one by one
+    """
+    __slots__ = ('raw', 'encoding', '_fields')
+
+    def __init__(self, raw, encoding=ENCODING):
+        self.raw = raw
+        self.encoding = encoding
+        self._fields = None
+
+    @property
+    def type(self):
+        return chr(self.raw[0]) if self.raw else ''
+
+    @property
+    def fields(self):
+        if(self._fields is None):
+            self._fields = self.raw.split(FIELD_SEP)
+        return self._fields
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __getitem__(self, index):
+        return decode_field(self.fields[index], self.encoding)
+
+    def __iter__(self):
+        encoding = self.encoding
+        return (decode_field(raw, encoding) for raw in self.fields)
+
+    def text(self, index):
+        """
+        Field as undivided text, None when empty or missing
+        """
+        fields = self.fields
+        if(index >= len(fields)):
+            return None
+        return fields[index].decode(self.encoding) or None
+
+    def component(self, index, component):
+        """
+        One component of a field, None when empty or missing
+        """
+        fields = self.fields
+        if(index >= len(fields)):
+            return None
+        parts = fields[index].split(COMPONENT_SEP)
+        if(component >= len(parts)):
+            return None
+        return parts[component].decode(self.encoding) or None
+
+    def __repr__(self):
+        return f"Record({self.raw!r})"
+
+
+def decode_records(data, encoding=ENCODING):
+    """
+    Frame data -> [Record, ...]
+    """
+    return [
+        Record(raw, encoding) for raw in bytes(data).split(RECORD_SEP) if raw
+    ]
+
+
+def decode_message(message, encoding=ENCODING, verify=STRICT):
+    """
+    Complete (ETX) message -> (seq, [Record, ...])
+    """
+    frame = split_frame(message, verify)
+    if(not frame.is_final):
+        raise FrameError(f"Intermediate frame, expected ETX: {message!r}")
+    return frame.seq, decode_records(frame.data, encoding)
+
+
+def encode_field(field, encoding=ENCODING):
+    if(field is None):
+        return b''
+    elif(isinstance(field, bytes)):
+        return field
+    elif(isinstance(field, str)):
+        return field.encode(encoding)
+    elif(isinstance(field, (list, tuple))):
+        if(any(isinstance(item, (list, tuple)) for item in field)):
+            return REPEAT_SEP.join(
+                encode_field(item, encoding) for item in field
+            )
+        return COMPONENT_SEP.join(
+            encode_field(item, encoding) for item in field
+        ).rstrip(COMPONENT_SEP)
+    return str(field).encode(encoding)
+
+
+def encode_record(record, encoding=ENCODING):
+    """
+    [field, ...] -> record bytes, fields as astm.codec.encode_record takes
+    them (str, None, components, repeated components)
+    """
+    return FIELD_SEP.join(encode_field(field, encoding) for field in record)
+
+
+def encode(records, encoding=ENCODING, size=None, seq=1):
+    """
+    Records -> list of frames, split into ETB frames of at most `size`
+    bytes. Drop-in for astm.codec.encode.
+    """
+    data = b''.join(
+        encode_record(record, encoding) + RECORD_SEP for record in records
+    )
+    if(not size or len(data) + 7 <= size):
+        return [build_frame(seq, data)]
+    if(size < 8):
+        raise ValueError('Frame size must be at least 8')
+    step = size - 7
+    chunks = [data[i:i + step] for i in range(0, len(data), step)]
+    return [
+        build_frame(seq + i, chunk, is_final=(i == len(chunks) - 1))
+        for i, chunk in enumerate(chunks)
+    ]
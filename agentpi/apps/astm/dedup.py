@@ -0,0 +1,57 @@
+"""Recently seen result keys, drops instrument retransmits early."""
+import threading
+from collections import OrderedDict
+
+
+def natural_key(serial, vial_id, completion):
+    """
+    'serial|vial ID|YYYYMMDDHHMMSS' of a result, None unless all three
+    are known (no dedup then)
+    """
+    if(not (serial and vial_id and completion)):
+        return None
+    return f'{serial}|{vial_id}|{completion}'
+
+
+class RecentKeys(object):
+    """
+    Thread safe LRU set of the last `maxsize` keys (0 = remember none)
+    """
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def seen(self, key):
+        """
+        True if `key` was seen recently, else remember it
+        """
+        if(not self.maxsize):
+            return False
+        with self.lock:
+            if(key in self.keys):
+                self.keys.move_to_end(key)
+                return True
+            self.keys[key] = None
+            if(len(self.keys) > self.maxsize):
+                self.keys.popitem(last=False)
+            return False
+
+    def forget(self, key):
+        with self.lock:
+            self.keys.pop(key, None)
+
+
+_lock = threading.Lock()
+
+
+def get_recent_keys(app):
+    with _lock:
+        recent = app.extensions.get('astm_recent_keys')
+        if(recent is None):
+            recent = RecentKeys(app.config['LIS_DEDUP_CACHE_SIZE'])
+            app.extensions['astm_recent_keys'] = recent
+        return recent
@@ -1,55 +1,119 @@
 import re
 import logging
 import pprint
-from datetime import datetime
-import requests
-import json
-import copy
 
 from flask import current_app
-from flask.cli import with_appcontext
 
 from astm.server import BaseRecordsDispatcher
 from astm.records import HeaderRecord, PatientRecord, OrderRecord, CommentRecord
 
 from agentpi import db
 from .models import (
-    LISDatagram, LISPatient, LISOrder, LISComment, LISResult
+    LISDatagram, LISPatient, LISOrder, LISComment, LISResult, pack_messages
 )
 from .records import (
     QuidelHeaderRecord,
 )
+from .buffer import MessageBuffer
+from .codec import decode_message
+from .dedup import get_recent_keys, natural_key
+from .metrics import metrics
+from .profiles import profile_config
+from .retry import first_attempt_at
+from .routing import route_vialid
+from .schema import SCHEMAS
+from .spool import datagram_entry, get_spool
+from .sqlite_store import get_sqlite_store
+from .timestamps import format_timestamp
+from .uploads import UploadJob, get_upload_queue
 
 
 pp = pprint.PrettyPrinter(indent=4)
 logger = logging.getLogger(__name__)
 
+HEADER = SCHEMAS['H']
+PATIENT = SCHEMAS['P']
+ORDER = SCHEMAS['O']
+COMMENT = SCHEMAS['C']
+RESULT = SCHEMAS['R']
+
 
 class AgentRecordDispatcher(BaseRecordsDispatcher):
-    def __init__(self, encoding=None):
+    def __init__(self, encoding=None, app=None, listener=None, profile=None):
         super().__init__(encoding=encoding)
-        # messages
-        self.messages = []
-        # Header
-        self.is_vial_uaxx = False
+        # records may be handled off the thread that created us, so hold
+        # on to the app rather than rely on the CLI's app context
+        self.app = app or current_app._get_current_object()
+        self.config = profile_config(self.app.config, profile)
+        self.listener = listener or 'default'
+        metrics.incr(f'lis.{self.listener}.connections')
+        # local write-ahead store in front of the database, if any
+        self.store = None if self.config['DISABLE_DATABASE'] else (
+            get_spool(self.app) or get_sqlite_store(self.app)
+        )
+        self.messages = MessageBuffer(
+            self.config['LIS_MESSAGE_MAX_BYTES'],
+            self.config['LIS_MESSAGE_SPOOL_BYTES'],
+        )
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the previous datagram, several may come over one connection
+        """
+        self.messages.clear()
+        self.header = None
+        self.groups = 0
+        self.reset_group()
+
+    def reset_group(self):
+        """
+        Forget the patient group (P, O, C, R records) just flushed
+        """
+        self.is_vialid_uaxx = False
         self.is_vialid_test = False
         self.is_skipped = False
         self.is_uploaded = False
         self.is_error = False
+        self.upload_destination = None
+        self.next_attempt_at = None
 
-        self.datagram = {}
-        self.patient = {}
-        self.order = {}
+        # schema.SCHEMAS records
+        self.patient = None
+        self.order = None
         self.comments = []
         self.results = []
+        self.db_ids = None
+        # dedup.natural_key of the group's result
+        self.key = None
 
     def __call__(self, message):
         """
         Stash message into database before futher propagation
         """
-        print(message)
-        self.messages.append(message)
-        super().__call__(message)
+        # decode first: a frame we NAK is sent again and mustn't be kept
+        seq, records = decode_message(
+            message, self.encoding, self.config['LIS_CHECKSUM']
+        )
+        logger.debug('message: %r', message)
+        first = records[0].type if records else None
+        if(first == 'H'):
+            self.reset()
+        elif(first == 'P' and self.patient is not None):
+            # the previous patient is complete, flush it before this
+            # message joins the buffer of the next one
+            with self.app.app_context():
+                self.flush()
+        metrics.incr(f'lis.{self.listener}.messages')
+        metrics.incr(f'lis.{self.listener}.bytes', len(message))
+        if(not self.messages.append(message)):
+            metrics.incr(f'lis.{self.listener}.messages_truncated')
+            metrics.incr(
+                f'lis.{self.listener}.messages_truncated_bytes', len(message)
+            )
+        with self.app.app_context():
+            for record in records:
+                self.dispatch.get(record.type, self.on_unknown)(record)
 
     def print_record(self, title, record):
         if type(record) == str:
@@ -59,201 +123,176 @@ class AgentRecordDispatcher(BaseRecordsDispatcher):
                 f"{title}: [{', '.join([str(i or 'None') for i in record])}]"
             )
 
-    @with_appcontext
     def on_header(self, record):
         super().on_header(record)
-        notfail = not (len(record) < 14)
-        if(record[4] and type(record[4]) == list):
-            self.datagram['instrument_model'], self.datagram['instrument_serial_number'] = record[4]
-        else:
-            self.datagram['instrument_model'], self.datagram['instrument_serial_number'] = (None, None)
-        self.datagram['instrument_firmware'] = record[12] if notfail else None
-        self.datagram['instrument_timestamp'] = record[13] if notfail else None
-        if(self.datagram['instrument_timestamp']):
-            try:
-                self.datagram['instrument_timestamp'] = datetime.strptime(
-                    self.datagram['instrument_timestamp'],
-                    "%Y%m%d%H%M%S"
-                )
-            except ValueError:
-                logger.info(
-                    f"ERROR '{self.datagram['instrument_timestamp']}'"
-                    " TypeError to datetime!"
-                )
-                self.datagram['instrument_timestamp'] = None
+        self.header = HEADER(record)
 
     def on_patient(self, record):
         super().on_patient(record)
-        notfail = not (len(record) <= 25)
-        self.patient['patient_id'] = record[2] if notfail else None
-        self.patient['location'] = record[25] if notfail else None
+        if(self.patient is not None):
+            self.flush()
+        self.patient = PATIENT(record)
 
     def on_order(self, record):
         super().on_order(record)
-        notfail = not (len(record) <= 15)
-        self.order['order_id'] = record[2] if notfail else None
-        self.order['test_type'] = record[4] if notfail else None
-        self.order['operator_id'] = record[10] if notfail else None
-        self.order['sample_type'] = record[15] if notfail else None
+        self.order = ORDER(record)
 
     def on_comment(self, record):
         super().on_comment(record)
-        notfail = not (len(record) <= 3)
-        comment = record[3] if notfail else None
-        self.comments.append(comment)
+        self.comments.append(COMMENT(record))
 
     def on_result(self, record):
         super().on_result(record)
-        result = {}
-        notfail1 = not (len(record) <= 12)
-        notfail2 = notfail1 and (not (len(record[2]) <= 3))
-        result['analyte_name'] = record[2][3] if notfail2 else None
-        result['test_value'] = record[3] if notfail1 else None
-        result['test_units'] = record[4] if notfail1 else None
-        result['test_range'] = record[5] if notfail1 else None
-        result['test_flag'] = record[6] if notfail1 else None
-        result['test_type'] = record[8] if notfail1 else None
-        result['completion'] = record[12] if notfail1 else None
-        if(result['completion']):
-            try:
-                result['completion'] = datetime.strptime(
-                    result['completion'], "%Y%m%d%H%M%S"
-                )
-            except (ValueError):
-                logger.error(str(b'\n'.join(self.messages)))
-                logger.error(
-                    f"ERROR on RESULT, field pos 12: '{result['completion']}'"
-                    " TypeError to datetime!"
-                )
-        self.results.append(result)
+        self.results.append(RESULT(record))
 
-    @with_appcontext
     def on_terminator(self, record):
-        super().on_order(record)
+        super().on_terminator(record)
+        # the last patient group, or the whole session when it didn't
+        # have any patient
+        if(self.patient is not None or not self.groups):
+            self.flush()
+        self.messages.clear()
+
+    def flush(self):
+        """
+        Save and hand off the current patient group, so batch sessions
+        (many P..R groups between H and L) are uploaded as they come in
+        and only ever hold one group
+        """
+        self.groups += 1
+        metrics.incr(f'lis.{self.listener}.patients')
         payload = self.generate_payload()
-        # ONLY SEND UAXX-????? or TSTXX-?????? or TT-??? labels
-        if(re.match(r'^UA[0-9]{2}-[0-9]*', payload['vialId'])):
-            self.is_vialid_uaxx = True
-            self.is_vialid_test = False
-            self.send_payload(
-                payload,
-                current_app.config['SARS_UPLINK_API_URL'],
-                current_app.config['SARS_UPLINK_API_KEY'],
-                disable_send=current_app.config['DISABLE_UPLINK'],
-            )
-        elif(re.match(r'^TT[a-zA-Z0-9]*$', payload['vialId'])):
-            self.is_vialid_uaxx = False
-            self.is_vialid_test = True
-            self.send_payload(
-                payload,
-                current_app.config['SARS_UPLINK_API_URL'],
-                current_app.config['SARS_UPLINK_API_KEY'],
-                disable_send=current_app.config['DISABLE_UPLINK'],
-            )
-            self.slack_message(f"testid: {payload['vialId']} sent!")
-        elif(
-            re.match(r'^UA[0-9]{2}-TEST[0-9]{3}$', payload['vialId']) or
-            re.match(r'^TST[0-9]{1}-[0-9]{7}$', payload['vialId'])
-        ):
-            # UA01-TEST001 or TST1-0000001
-            self.is_vialid_uaxx = False
-            self.is_vialid_test = True
-            self.send_payload(
-                payload,
-                current_app.config['TEST_UPLINK_API_URL'],
-                current_app.config['TEST_UPLINK_API_KEY'],
-                disable_send=current_app.config['DISABLE_UPLINK'],
-            )
-            self.slack_message(f"testid: {payload['vialId']} sent!")
+        self.key = natural_key(
+            payload['serialNo'], payload['vialId'], payload['resultTime']
+        )
+        if(self.key is not None and get_recent_keys(self.app).seen(self.key)):
+            # the instrument sent this result again (lost ACK, resend
+            # button), it is stored and uploaded already
+            metrics.incr('dedup.suppressed')
+            metrics.incr(f'lis.{self.listener}.duplicates')
+            logger.info(f"{self.listener}: {self.key} seen recently, duplicate dropped")
+            self.messages.clear()
+            self.reset_group()
+            return
+        route = route_vialid(payload['vialId'], self.config)
+        self.is_vialid_uaxx = route.is_vialid_uaxx
+        self.is_vialid_test = route.is_vialid_test
+        upload = None
+        if(route.destination):
+            notify = f"testid: {payload['vialId']} sent!" if route.notify else None
+            upload = (route.destination, notify)
         else:
             logger.info(f"patient_id: {payload['vialId']} skipped")
-            self.is_vialid_uaxx = False
-            self.is_vialid_test = False
             self.is_uploaded = False
             self.is_error = False
             self.is_skipped = True
+        if(upload and self.config['DISABLE_UPLINK']):
+            logger.info(f"UPLINK DISABLED: {payload['vialId']} skipped")
+            self.is_skipped = True
+            upload = None
+        elif(upload):
+            # Saved as failed until the upload worker reports back, so a
+            # crash before delivery still leaves the row for a retry. The
+            # spool/SQLite worker schedules it when it loads the row and
+            # enqueues the upload, however late that is.
+            self.is_uploaded = False
+            self.is_error = True
+            self.upload_destination = route.destination
+            if(self.store is None):
+                self.next_attempt_at = first_attempt_at(self.config)
         # # @todo: need to visually display issue on pi?
         # #### self.print_record('terminator', record)
-        self.save_datagram()
+        if(self.messages.truncated):
+            logger.warning(
+                f"{self.listener}: {self.messages.dropped} messages "
+                f"({self.messages.dropped_bytes} bytes) over "
+                f"LIS_MESSAGE_MAX_BYTES not stored"
+            )
+        stored = False
+        try:
+            if(self.store is not None):
+                self.store_datagram(payload, upload)
+                stored = True
+            else:
+                self.save_datagram()
+                stored = self.db_ids is not None or self.config['DISABLE_DATABASE']
+                if(self.db_ids and self.db_ids['duplicate']):
+                    upload = None
+                if(upload):
+                    self.enqueue_payload(payload, *upload)
+        finally:
+            if(self.key is not None and not stored):
+                # nothing kept, let a retransmit through
+                get_recent_keys(self.app).forget(self.key)
+        self.messages.clear()
+        self.reset_group()
 
     def on_unknown(self, record):
         super().on_unknown(record)
-        self.print_record('unknown', record)
+        self.print_record('unknown', list(record))
 
-    @with_appcontext
-    def slack_message(self, message):
+    def datagram_row(self):
         """
-        Push a notice to slack
+        lis_datagram columns of the current datagram
         """
-        hostname = current_app.config['HOSTNAME']
-        slack_webhook = current_app.config['SLACK_WEBHOOK']
-        slack_webhook_enabled = current_app.config['SLACK_CHANNEL_ENABLED']
-        if(slack_webhook and slack_webhook_enabled):
-            payload = {
-                'text': f'{hostname}: {message}'
-            }
-            r = requests.post(slack_webhook, data=json.dumps(payload).encode('utf-8'))
-            if(r.status_code != requests.codes.ok):
-                logger.error(f"Failed to send slack notfication! {r.status_code}")
-                try:
-                    r.raise_for_status()
-                except Exception as e:
-                    logger.error(str(e))
-        elif(slack_webhook_enabled):
-            logger.warning("Slack hook empty!")
+        header = self.header or HEADER.empty
+        return {
+            'instrument_model': header.instrument_model,
+            'instrument_serial_number': header.instrument_serial_number,
+            'instrument_firmware': header.firmware,
+            'instrument_timestamp': header.timestamp,
+            'messages': pack_messages(self.messages),
+            'natural_key': self.key,
+            'is_vialid_uaxx': self.is_vialid_uaxx,
+            'is_vialid_test': self.is_vialid_test,
+            'is_uploaded': self.is_uploaded,
+            'is_error': self.is_error,
+            'is_skipped': self.is_skipped,
+            'upload_destination': self.upload_destination,
+            'next_attempt_at': self.next_attempt_at,
+        }
+
+    def store_datagram(self, payload, upload=None):
+        """
+        Append the datagram to the local store (spool or SQLite) and
+        return, its background worker loads it into the database and
+        enqueues the upload
+        """
+        self.store.append(datagram_entry(
+            self.datagram_row(),
+            self.patient,
+            self.order,
+            self.comments,
+            self.results,
+            upload=(payload, *upload) if upload else None,
+        ))
+        self.db_ids = None
 
-    @with_appcontext
     def save_datagram(self):
         """
         Save all data to database!!
         """
-        if(not current_app.config['DISABLE_DATABASE']):
-            datagram = {
-                'instrument_model': self.datagram['instrument_model'],
-                'instrument_serial_number': self.datagram['instrument_serial_number'],
-                'instrument_firmware': self.datagram['instrument_firmware'],
-                'instrument_timestamp': self.datagram['instrument_timestamp'],
-                'messages': [ x.decode('utf-8') for x in self.messages ],
-                'is_vialid_uaxx': self.is_vialid_uaxx,
-                'is_vialid_test': self.is_vialid_test,
-                'is_uploaded': self.is_uploaded,
-                'is_error': self.is_error,
-                'is_skipped': self.is_skipped,
-            }
-            self.db_obj = LISDatagram.create_without_fail(**datagram)
-            if(self.db_obj):
-                # Patient
-                patient = copy.deepcopy(self.patient)
-                patient['dgid'] = self.db_obj.id
-                self.patient_obj = LISPatient.create_without_fail(**patient)
-                # Order
-                order = copy.deepcopy(self.order)
-                order['dgid'] = self.db_obj.id
-                self.order_obj = LISOrder.create_without_fail(**order)
-                # Comments
-                c_objs = []
-                for c in self.comments:
-                    c_obj = LISComment.create_without_fail(
-                        sample_comment=c,
-                        dgid=self.db_obj.id
-                    )
-                    c_objs.append(c_obj)
-                # Results
-                r_objs = []
-                for r in self.results:
-                    r['dgid'] = self.db_obj.id
-                    r_obj = LISResult.create_without_fail(**r)
-                    r_objs.append(r_obj)
+        if(not self.config['DISABLE_DATABASE']):
+            datagram = self.datagram_row()
+            self.db_ids = LISDatagram.create_datagram_without_fail(
+                datagram,
+                self.patient,
+                self.order,
+                self.comments,
+                self.results,
+            )
+        else:
+            self.db_ids = None
 
     def generate_payload(self):
         """
         LIS1-A data might be messy, cleanup for sending payload
         """
-        patient_id = self.patient['patient_id'] if 'patient_id' in self.patient else ''
-        test_type = self.order['test_type'] if 'test_type' in self.order else ''
+        patient_id = self.patient.patient_id if self.patient else ''
+        test_type = self.order.test_type if self.order else ''
         if(len(self.results) == 1):
-            test_value = self.results[0]['test_value'] if 'test_value' in self.results[0] else ''
-            completion = self.results[0]['completion'] if 'completion' in self.results[0] else ''
+            test_value = self.results[0].test_value
+            completion = self.results[0].completion
         elif(len(self.results) > 1):
             logger.error(f"ERROR: more than one result for patient: '{patient_id}'")
             logger.error(pprint.pformat(self.results, indent=4))
@@ -273,59 +312,16 @@ class AgentRecordDispatcher(BaseRecordsDispatcher):
             'vialId': patient_id,
             'testType': test_type,
             'results': test_value,
-            'serialNo': self.datagram['instrument_serial_number'] if (
-                'instrument_serial_number' in self.datagram
-             ) else '',
-            'resultTime': completion.strftime("%Y%m%d%H%M%S")
+            'serialNo': self.header.instrument_serial_number if (
+                self.header
+            ) else '',
+            'resultTime': format_timestamp(completion)
         }
 
-    @with_appcontext
-    def send_payload(self, payload, url, key, disable_send=False):
+    def enqueue_payload(self, payload, destination, notify=None):
         """
-        Send our data upstream
+        Hand our data to the upload queue, never waits on the uplink
         """
-        # pp.pprint(payload)
-        self.is_uploaded = False
-        self.is_error = False
-        headers = {
-            'Content-Type': 'application/json',
-            'x-api-key': key
-        }
-        if(not disable_send):
-            try:
-                res = requests.post(url,data=json.dumps(payload),headers=headers)
-                res.raise_for_status()
-            except requests.exceptions.HTTPError as e:
-                logger.error(repr(e))
-                logger.error(f"url: '{url}'")
-                logger.error(f"HTTP error with patient_id: '{payload['vialId']}'")
-                self.is_error = True
-            except requests.exceptions.ConnectionError as e:
-                logger.error(repr(e))
-                logger.error(f"url: '{url}'")
-                logger.error(f"Connection error with patient_id: '{payload['vialId']}'")
-                self.is_error = True
-            except requests.exceptions.Timeout as e:
-                logger.error(repr(e))
-                logger.error(f"url: '{url}'")
-                logger.error(f"Timeout with patient_id '{payload['vialId']}'")
-                self.is_error = True
-            except (requests.exceptions.RequestException, Exception) as e:
-                logger.error(repr(e))
-                logger.error(f"url: '{url}'")
-                logger.error(f"Unknown error with patient_id '{payload['vialId']}'")
-                self.is_error = True
-            else:
-                if(res.status_code == 200):
-                    # Successfully uploaded data
-                    self.is_uploaded = True
-                else:
-                    # This should be impossible
-                    logger.error(f"HTTP ERROR '{res.status_code}': : {payload['vialId']}")
-                    self.is_error = True
-            finally:
-                if(self.is_error):
-                    self.slack_message("@channel ERROR Detected!")
-        else:
-            logger.info(f"UPLINK DISABLED: {payload['vialId']} skipped")
-            self.is_skipped = True
+        dgid = self.db_ids['dgid'] if self.db_ids else None
+        upload_queue = get_upload_queue(self.app)
+        upload_queue.submit(UploadJob(dgid, payload, destination, notify))
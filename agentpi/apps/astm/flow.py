@@ -0,0 +1,173 @@
+"""Flow control toward the instruments when downstream falls behind.
+
+The backlogs behind the listeners (queued uploads, the spool or SQLite
+store not yet in the database) are compared to high/low watermarks.
+Past a high watermark backpressure is engaged until every backlog is back
+under its low watermark. While engaged a new session's ENQ is answered
+with NAK -- LIS1-A lets the receiver refuse, the instrument waits (>= 10s)
+and sends ENQ again -- after up to LIS_BACKPRESSURE_DELAY seconds of
+waiting for it to clear (asyncio engine, `delay`), and with `refuse` new
+connections are closed as well. Sessions already in transfer are never
+interrupted.
+"""
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+from .metrics import metrics
+from .spool import get_spool, list_segments, load_checkpoint
+from .sqlite_store import get_sqlite_store
+from .uploads import get_upload_queue
+
+
+logger = logging.getLogger(__name__)
+
+
+# off: accept everything, nak: NAK new sessions, delay: hold their ENQ
+# first, refuse: NAK and close new connections
+ACTIONS = ('off', 'nak', 'delay', 'refuse')
+
+Watermark = namedtuple('Watermark', ['name', 'read', 'high', 'low'])
+
+
+def spool_lag(spool):
+    """
+    Bytes of the spool past the ingest checkpoint
+    """
+    segment, offset = load_checkpoint(spool.directory)
+    lag = 0
+    for number, path in list_segments(spool.directory):
+        if(number < segment):
+            continue
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            # pruned meanwhile
+            continue
+        lag += max(0, size - (offset if number == segment else 0))
+    return lag
+
+
+class FlowControl(object):
+    """
+    Watermarks over the app's backlogs, re-read at most every
+    LIS_BACKPRESSURE_INTERVAL seconds
+    """
+    def __init__(self, app):
+        config = app.config
+        self.app = app
+        self.action = config['LIS_BACKPRESSURE_ACTION']
+        self.interval = config['LIS_BACKPRESSURE_INTERVAL']
+        self.delay = config['LIS_BACKPRESSURE_DELAY']
+        self.watermarks = []
+        if(config['LIS_BACKPRESSURE_UPLOADS_HIGH']):
+            self.watermarks.append(Watermark(
+                'uploads',
+                lambda: get_upload_queue(app).depth(),
+                config['LIS_BACKPRESSURE_UPLOADS_HIGH'],
+                config['LIS_BACKPRESSURE_UPLOADS_LOW'],
+            ))
+        spool = get_spool(app)
+        if(spool is not None and config['LIS_BACKPRESSURE_SPOOL_HIGH']):
+            self.watermarks.append(Watermark(
+                'spool',
+                lambda: spool_lag(spool),
+                config['LIS_BACKPRESSURE_SPOOL_HIGH'],
+                config['LIS_BACKPRESSURE_SPOOL_LOW'],
+            ))
+        store = get_sqlite_store(app)
+        if(store is not None and config['LIS_BACKPRESSURE_STORE_HIGH']):
+            self.watermarks.append(Watermark(
+                'store',
+                store.backlog,
+                config['LIS_BACKPRESSURE_STORE_HIGH'],
+                config['LIS_BACKPRESSURE_STORE_LOW'],
+            ))
+        # name of the backlog that engaged backpressure, None = accepting
+        self.reason = None
+        self.since = None
+        self.checked = None
+        self.lock = threading.Lock()
+
+    def pressure(self):
+        """
+        The reason backpressure is engaged, None while accepting
+        """
+        if(self.action == 'off' or not self.watermarks):
+            return None
+        now = time.monotonic()
+        if(self.checked is not None and now - self.checked < self.interval):
+            return self.reason
+        with self.lock:
+            if(self.checked is None or now - self.checked >= self.interval):
+                self.checked = now
+                self.update(now)
+        return self.reason
+
+    def update(self, now):
+        levels = {}
+        for watermark in self.watermarks:
+            try:
+                levels[watermark.name] = watermark.read()
+            except Exception:
+                ## DO NOT BREAK!!!
+                logger.exception(f"Backpressure: can't read {watermark.name}")
+                continue
+            metrics.gauge(f'lis.backlog.{watermark.name}', levels[watermark.name])
+        if(self.reason is None):
+            for watermark in self.watermarks:
+                level = levels.get(watermark.name, 0)
+                if(level >= watermark.high):
+                    self.reason = watermark.name
+                    self.since = now
+                    metrics.gauge('lis.backpressure', 1)
+                    metrics.incr(f'lis.backpressure.{watermark.name}')
+                    logger.warning(
+                        f"Backpressure on ({self.action}): {watermark.name} "
+                        f"backlog {level} >= {watermark.high}"
+                    )
+                    return
+        elif(all(
+            levels.get(watermark.name, 0) <= watermark.low
+            for watermark in self.watermarks
+        )):
+            metrics.gauge('lis.backpressure', 0)
+            metrics.observe('lis.backpressure_seconds', now - self.since)
+            logger.warning(
+                f"Backpressure off after {now - self.since:.1f}s "
+                f"({self.reason}), backlogs: {levels}"
+            )
+            self.reason = None
+            self.since = None
+
+    def admit(self, listener):
+        """
+        May a new session (ENQ) start on `listener`? Counts the NAK if not.
+        """
+        if(self.pressure() is None):
+            return True
+        metrics.incr(f'lis.{listener}.backpressure_nak')
+        return False
+
+    def refuses(self, listener):
+        """
+        Turn a new connection away? Only with LIS_BACKPRESSURE_ACTION=refuse
+        """
+        if(self.action != 'refuse' or self.pressure() is None):
+            return False
+        metrics.incr(f'lis.{listener}.backpressure_refused')
+        return True
+
+
+_lock = threading.Lock()
+
+
+def get_flow_control(app):
+    with _lock:
+        flow = app.extensions.get('astm_flow_control')
+        if(flow is None):
+            flow = FlowControl(app)
+            app.extensions['astm_flow_control'] = flow
+        return flow
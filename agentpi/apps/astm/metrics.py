@@ -0,0 +1,112 @@
+"""In-process counters and timings for the LIS listener."""
+import logging
+import threading
+import time
+from collections import deque
+
+from agentpi.library import percentile
+
+
+logger = logging.getLogger(__name__)
+
+
+class Timing(object):
+    """
+    Running count/total/max plus a bounded sample window for percentiles
+    """
+    __slots__ = ('count', 'total', 'max', 'samples')
+
+    def __init__(self, window=1024):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=window)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if(value > self.max):
+            self.max = value
+        self.samples.append(value)
+
+    def summary(self):
+        ordered = sorted(self.samples)
+        return {
+            'count': self.count,
+            'avg': (self.total / self.count) if self.count else 0.0,
+            'max': self.max,
+            'p50': percentile(ordered, 50),
+            'p95': percentile(ordered, 95),
+            'p99': percentile(ordered, 99),
+        }
+
+
+class Metrics(object):
+    """
+    Thread safe registry of counters, gauges and timings
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self._lock:
+            timing = self.timings.get(name)
+            if(timing is None):
+                timing = self.timings[name] = Timing()
+            timing.add(value)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'timings': {
+                    name: timing.summary()
+                    for name, timing in self.timings.items()
+                },
+            }
+
+    def log_snapshot(self):
+        snap = self.snapshot()
+        for name, value in sorted(snap['counters'].items()):
+            logger.info(f"metric {name}={value}")
+        for name, value in sorted(snap['gauges'].items()):
+            logger.info(f"metric {name}={value}")
+        for name, summary in sorted(snap['timings'].items()):
+            logger.info(
+                f"metric {name}: n={summary['count']} "
+                f"avg={summary['avg'] * 1000:.3f}ms "
+                f"p95={summary['p95'] * 1000:.3f}ms "
+                f"max={summary['max'] * 1000:.3f}ms"
+            )
+
+
+metrics = Metrics()
+
+
+def start_reporter(interval):
+    """
+    Log a metrics snapshot every `interval` seconds (0 disables)
+    """
+    if(not interval):
+        return None
+
+    def report():
+        while True:
+            time.sleep(interval)
+            metrics.log_snapshot()
+
+    thread = threading.Thread(target=report, name='metrics', daemon=True)
+    thread.start()
+    return thread
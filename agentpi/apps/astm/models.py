@@ -1,19 +1,100 @@
 """Database models."""
 import datetime
-import logging
 import json
+import logging
 import pprint
-import requests
+import re
+import zlib
 
+from sqlalchemy import exc
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.types import CHAR
-from sqlalchemy.dialects.postgresql import JSONB
 
 from agentpi import db
+from .metrics import metrics
+from .timestamps import format_timestamp
 
 
 logger = logging.getLogger(__name__)
 pp = pprint.PrettyPrinter(indent=4)
 
+# Postgres NOTIFY channel that wakes the retry service on a new failure
+UPLOAD_RETRY_CHANNEL = 'lis_upload_retry'
+
+# zlib level of lis_messages.data
+MESSAGES_COMPRESSION = 6
+
+# STX ... CR LF, frames carry no LF of their own
+FRAME = re.compile(rb'\x02.*?\r\n', re.S)
+
+
+def pack_messages(messages):
+    """
+    Raw frames (bytes, or str as the old JSONB column held them) -> one
+    zlib compressed blob for lis_messages.data
+    """
+    return zlib.compress(
+        b''.join(
+            m if isinstance(m, bytes) else m.encode('utf-8') for m in messages
+        ),
+        MESSAGES_COMPRESSION,
+    )
+
+
+def unpack_messages(data):
+    """
+    lis_messages.data -> [frame bytes, ...]
+    """
+    return FRAME.findall(zlib.decompress(data)) if data else []
+
+
+def record_row(model, record, dgid):
+    """
+    INSERT values for `model`'s table read off the same-named attributes
+    of `record` (None for a missing record or attribute)
+    """
+    row = {
+        column.name: getattr(record, column.name, None)
+        for column in model.__table__.columns
+        if not column.primary_key
+    }
+    row['dgid'] = dgid
+    return row
+
+
+def insert_rows(conn, model, rows):
+    """
+    INSERT `rows` into `model`'s table -> their primary keys, in order.
+    One multi-row INSERT ... RETURNING on Postgres, one INSERT per row
+    elsewhere (SQLAlchemy 1.3 has no RETURNING for SQLite).
+    """
+    table = model.__table__
+    if(conn.dialect.name == 'postgresql'):
+        key = list(table.primary_key.columns)[0]
+        return [row[0] for row in conn.execute(
+            table.insert().values(rows).returning(key)
+        )]
+    return [
+        conn.execute(table.insert(), row).inserted_primary_key[0]
+        for row in rows
+    ]
+
+
+def is_rejected(error):
+    """
+    Did the database refuse the rows themselves (value too long, NOT NULL,
+    a value of the wrong type) rather than fail to take any (link down,
+    missing table, a bug)? Only then will sending the same rows again
+    never work.
+    """
+    if(isinstance(error, (exc.DataError, exc.IntegrityError))):
+        return True
+    # a value its column type can't bind, raised before it reaches the DB
+    return (
+        isinstance(error, exc.StatementError)
+        and not isinstance(error, exc.DBAPIError)
+    )
+
 
 # LIS1-A spec
 class LISDatagram(db.Model):
@@ -21,6 +102,17 @@ class LISDatagram(db.Model):
     HEADER / TERMINATOR -> Full datagram
     """
     __tablename__ = 'lis_datagram'
+    __table_args__ = (
+        # Only failed uploads are indexed, so the retry service's cost
+        # follows the size of the backlog rather than the table
+        db.Index(
+            'ix_lis_datagram_retry',
+            'next_attempt_at',
+            postgresql_where=db.text('is_error AND NOT is_uploaded'),
+        ),
+        # one row per result, retransmits only bump `duplicates`
+        db.Index('ux_lis_datagram_natural_key', 'natural_key', unique=True),
+    )
 
     id = db.Column('dgid', db.Integer, primary_key=True)
     # HEADER
@@ -32,7 +124,7 @@ class LISDatagram(db.Model):
     )
     instrument_serial_number = db.Column(
         db.String(12),
-        index=False,
+        index=True,
         unique=False,
         nullable=True
     )
@@ -48,13 +140,12 @@ class LISDatagram(db.Model):
         unique=False,
         nullable=True
     )
-    # Data stream
-    messages = db.Column(JSONB)  # WARNING: Object is Immutable!!!
+    # Data stream: lis_messages, only loaded when asked for
     # GENERAL
     created_at = db.Column(
         db.DateTime,
         default=datetime.datetime.utcnow,
-        index=False,
+        index=True,
         unique=False,
         nullable=True
     )
@@ -64,8 +155,24 @@ class LISDatagram(db.Model):
     is_uploaded = db.Column(db.Boolean, unique=False, default=False)
     is_error = db.Column(db.Boolean, unique=False, default=False)
     is_skipped = db.Column(db.Boolean, unique=False, default=False)
+    # 'serial|vial ID|completion' (dedup.natural_key), NULL when unknown
+    natural_key = db.Column(db.String(64), nullable=True)
+    duplicates = db.Column(
+        db.Integer, unique=False, default=0, server_default='0'
+    )
+    # Upload retry bookkeeping; the destination routed when it was stored
+    # (listener profile rules included), NULL for rows stored before
+    upload_destination = db.Column(db.String(12), nullable=True)
+    upload_attempts = db.Column(db.Integer, unique=False, default=0)
+    next_attempt_at = db.Column(
+        db.DateTime,
+        index=False,
+        unique=False,
+        nullable=True
+    )
 
     # results = db.relationship("ASTMResult", backref="datagram", lazy='dynamic')
+    raw = db.relationship("LISMessages", uselist=False, lazy='select')
     patient = db.relationship("LISPatient", uselist=False)
     order = db.relationship("LISOrder", uselist=False)
     comments = db.relationship("LISComment", backref="datagram", lazy='dynamic')
@@ -74,6 +181,17 @@ class LISDatagram(db.Model):
     def __repr__(self):
         return f"<ASTM Message {self.id}>"
 
+    @property
+    def messages(self):
+        """
+        Raw frames as text, as the old JSONB column held them (loads
+        lis_messages on first use)
+        """
+        return [
+            m.decode('utf-8', 'replace')
+            for m in unpack_messages(self.raw.data if self.raw else None)
+        ]
+
     @classmethod
     def create_without_fail(cls, **kwargs):
         try:
@@ -89,6 +207,281 @@ class LISDatagram(db.Model):
             logger.info(f"+LISDatagram(id={obj.id})")
             return obj
 
+    @classmethod
+    def create_datagram_without_fail(
+        cls, datagram, patient, order, comments, results
+    ):
+        """
+        Save a full HEADER -> TERMINATOR datagram as a single unit of work.
+
+        `datagram` holds the lis_datagram columns plus 'messages'
+        (pack_messages); patient, order (either
+        may be None) and each of comments/results are records whose
+        attributes are named after their table's columns (schema.SCHEMAS).
+        Everything goes through one transaction; on Postgres comments and
+        results are written with multi-row INSERT ... RETURNING so their ids
+        come back in one round-trip. Returns a dict of the new ids ('duplicate' set
+        when the natural_key was already stored and nothing was added), or
+        None (nothing is kept) if the database failed.
+        """
+        try:
+            ids = cls.insert_datagram(
+                db.session.connection(),
+                datagram, patient, order, comments, results
+            )
+            db.session.commit()
+        except Exception as e:
+            ## DO NOT BREAK!!!
+            db.session.rollback()
+            logger.error("WARNING -> DB failure on LISDatagram (bulk)")
+            logger.error(str(e))
+            return None
+        else:
+            if(ids['duplicate']):
+                logger.info(
+                    f"LISDatagram(id={ids['dgid']}) already holds "
+                    f"{datagram['natural_key']}, duplicate dropped"
+                )
+                return ids
+            logger.info(
+                f"+LISDatagram(id={ids['dgid']}) +LISPatient(id={ids['pid']}) "
+                f"+LISOrder(id={ids['oid']}) +LISComment(ids={ids['cids']}) "
+                f"+LISResult(ids={ids['rids']})"
+            )
+            return ids
+
+    @classmethod
+    def insert_datagram(cls, conn, datagram, patient, order, comments,
+                        results):
+        """
+        INSERT one datagram and its records on `conn`, the caller owns the
+        transaction. Returns a dict of the new ids; a duplicate (see
+        upsert) only gets 'dgid', of the row already stored.
+        """
+        datagram = dict(datagram)
+        data = datagram.pop('messages', None)
+        dgid, inserted = cls.upsert(conn, datagram)
+        if(not inserted):
+            metrics.incr('dedup.conflicts')
+            return {
+                'dgid': dgid, 'pid': None, 'oid': None,
+                'cids': [], 'rids': [], 'duplicate': True,
+            }
+        if(data is not None):
+            conn.execute(LISMessages.__table__.insert(), dgid=dgid, data=data)
+        pid = conn.execute(
+            LISPatient.__table__.insert(),
+            record_row(LISPatient, patient, dgid)
+        ).inserted_primary_key[0]
+        oid = conn.execute(
+            LISOrder.__table__.insert(),
+            record_row(LISOrder, order, dgid)
+        ).inserted_primary_key[0]
+        cids = []
+        if(comments):
+            cids = insert_rows(conn, LISComment, [
+                record_row(LISComment, c, dgid) for c in comments
+            ])
+        rids = []
+        if(results):
+            rids = insert_rows(conn, LISResult, [
+                record_row(LISResult, r, dgid) for r in results
+            ])
+        return {
+            'dgid': dgid, 'pid': pid, 'oid': oid,
+            'cids': cids, 'rids': rids, 'duplicate': False,
+        }
+
+    @classmethod
+    def upsert(cls, conn, datagram):
+        """
+        INSERT ... ON CONFLICT (natural_key) DO UPDATE of a lis_datagram
+        row -> (dgid, True); when the natural_key is already stored that
+        row's `duplicates` is bumped instead -> (its dgid, False)
+        """
+        table = cls.__table__
+        key = datagram.get('natural_key')
+        if(key is None):
+            return conn.execute(
+                table.insert(), datagram
+            ).inserted_primary_key[0], True
+        duplicates = db.func.coalesce(table.c.duplicates, 0) + 1
+        if(conn.dialect.name == 'postgresql'):
+            # xmax is 0 on a row this statement inserted
+            row = conn.execute(
+                postgresql.insert(table).values(datagram)
+                .on_conflict_do_update(
+                    index_elements=[table.c.natural_key],
+                    set_={'duplicates': duplicates},
+                ).returning(table.c.dgid, db.literal_column('xmax = 0'))
+            ).first()
+            return row[0], row[1]
+        dgid = conn.execute(
+            db.select([table.c.dgid]).where(table.c.natural_key == key)
+        ).scalar()
+        if(dgid is None):
+            return conn.execute(
+                table.insert(), datagram
+            ).inserted_primary_key[0], True
+        conn.execute(
+            table.update().where(table.c.dgid == dgid)
+            .values(duplicates=duplicates)
+        )
+        return dgid, False
+
+    @classmethod
+    def insert_datagrams(cls, conn, datagrams):
+        """
+        INSERT many (datagram, patient, order, comments, results) on
+        `conn` with one executemany per table, the caller owns the
+        transaction. Returns the new dgids, in order, None for a duplicate
+        (natural_key stored already, or earlier in `datagrams`).
+
+        On Postgres the dgids are drawn from the sequence up front so the
+        children can reference them without RETURNING.
+        """
+        if(not datagrams):
+            return []
+        if(conn.dialect.name != 'postgresql'):
+            return [
+                None if ids['duplicate'] else ids['dgid']
+                for ids in (
+                    cls.insert_datagram(conn, *datagram)
+                    for datagram in datagrams
+                )
+            ]
+        table = cls.__table__
+        keys = [datagram[0].get('natural_key') for datagram in datagrams]
+        stored = set()
+        if(any(keys)):
+            stored = {row[0] for row in conn.execute(
+                db.select([table.c.natural_key])
+                .where(table.c.natural_key.in_([k for k in keys if k]))
+            )}
+        fresh = []
+        repeated = []
+        for key, datagram in zip(keys, datagrams):
+            if(key is not None and key in stored):
+                repeated.append({'key': key})
+                fresh.append(None)
+            else:
+                if(key is not None):
+                    stored.add(key)
+                fresh.append(datagram)
+        if(repeated):
+            metrics.incr('dedup.conflicts', len(repeated))
+            conn.execute(
+                table.update()
+                .where(table.c.natural_key == db.bindparam('key'))
+                .values(duplicates=db.func.coalesce(table.c.duplicates, 0) + 1),
+                repeated
+            )
+        inserted = cls._insert_datagrams(
+            conn, [datagram for datagram in fresh if datagram is not None]
+        )
+        return [
+            None if datagram is None else next(inserted) for datagram in fresh
+        ]
+
+    @classmethod
+    def _insert_datagrams(cls, conn, datagrams):
+        """
+        insert_datagrams without the duplicate checks (Postgres), returns
+        an iterator over the new dgids
+        """
+        if(not datagrams):
+            return iter([])
+        dgids = [row[0] for row in conn.execute(
+            db.text(
+                "SELECT nextval('lis_datagram_dgid_seq') "
+                "FROM generate_series(1, :count)"
+            ),
+            count=len(datagrams),
+        )]
+        rows = []
+        messages = []
+        comments = []
+        results = []
+        for dgid, datagram in zip(dgids, datagrams):
+            row = dict(datagram[0], dgid=dgid)
+            data = row.pop('messages', None)
+            rows.append(row)
+            if(data is not None):
+                messages.append({'dgid': dgid, 'data': data})
+            comments.extend(record_row(LISComment, c, dgid) for c in datagram[3])
+            results.extend(record_row(LISResult, r, dgid) for r in datagram[4])
+        conn.execute(cls.__table__.insert(), rows)
+        if(messages):
+            conn.execute(LISMessages.__table__.insert(), messages)
+        conn.execute(LISPatient.__table__.insert(), [
+            record_row(LISPatient, datagram[1], dgid)
+            for dgid, datagram in zip(dgids, datagrams)
+        ])
+        conn.execute(LISOrder.__table__.insert(), [
+            record_row(LISOrder, datagram[2], dgid)
+            for dgid, datagram in zip(dgids, datagrams)
+        ])
+        if(comments):
+            conn.execute(LISComment.__table__.insert(), comments)
+        if(results):
+            conn.execute(LISResult.__table__.insert(), results)
+        return iter(dgids)
+
+    @classmethod
+    def update_flags_without_fail(cls, dgid, **flags):
+        """
+        Write upload outcome flags back onto an existing datagram row; a
+        new failure also NOTIFYs the retry service (Postgres only)
+        """
+        return cls.update_flags_many_without_fail({dgid: flags})
+
+    @classmethod
+    def update_flags_many_without_fail(cls, flags, deliveries=()):
+        """
+        update_flags_without_fail for several rows, {dgid: flags}, in one
+        transaction (the outcome of a batched upload), along with their
+        LISDelivery.record `deliveries`
+        """
+        try:
+            for dgid, values in flags.items():
+                db.session.query(cls).filter(cls.id == dgid).update(
+                    values, synchronize_session=False
+                )
+            if(deliveries):
+                LISDelivery.record(deliveries)
+            if(
+                any(values.get('is_error') for values in flags.values())
+                and db.engine.dialect.name == 'postgresql'
+            ):
+                db.session.execute(f"NOTIFY {UPLOAD_RETRY_CHANNEL}")
+            db.session.commit()
+        except Exception as e:
+            ## DO NOT BREAK!!!
+            db.session.rollback()
+            logger.error(
+                f"WARNING -> DB failure updating LISDatagram("
+                f"{list(flags) or [d[0] for d in deliveries]})"
+            )
+            logger.error(str(e))
+            return False
+        else:
+            return True
+
+
+class LISMessages(db.Model):
+    """
+    Raw messages of a datagram, zlib compressed (OneToOne -> LISDatagram);
+    kept out of lis_datagram so scans of it don't read them
+    """
+    __tablename__ = 'lis_messages'
+    dgid = db.Column(
+        db.Integer, db.ForeignKey('lis_datagram.dgid'), primary_key=True
+    )
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    def __repr__(self):
+        return f"<LISMessages {self.dgid}>"
+
 
 class LISPatient(db.Model):
     """
@@ -98,7 +491,7 @@ class LISPatient(db.Model):
     id = db.Column('pid', db.Integer, primary_key=True)
     patient_id = db.Column(
         db.String(12),
-        index=False,
+        index=True,
         unique=False,
         nullable=True,
     )
@@ -108,7 +501,7 @@ class LISPatient(db.Model):
         unique=False,
         nullable=True,
     )
-    dgid = db.Column(db.Integer, db.ForeignKey('lis_datagram.dgid'))
+    dgid = db.Column(db.Integer, db.ForeignKey('lis_datagram.dgid'), index=True)
     datagram = db.relationship('LISDatagram')
 
     @classmethod
@@ -159,7 +552,7 @@ class LISOrder(db.Model):
         unique=False,
         nullable=True,
     )
-    dgid = db.Column(db.Integer, db.ForeignKey('lis_datagram.dgid'))
+    dgid = db.Column(db.Integer, db.ForeignKey('lis_datagram.dgid'), index=True)
     datagram = db.relationship('LISDatagram')
 
     @classmethod
@@ -192,7 +585,7 @@ class LISComment(db.Model):
         unique=False,
         nullable=True,
     )
-    dgid = db.Column(db.Integer, db.ForeignKey('lis_datagram.dgid'))
+    dgid = db.Column(db.Integer, db.ForeignKey('lis_datagram.dgid'), index=True)
     # datagram = db.relationship('LISDatagram')
 
     @classmethod
@@ -258,7 +651,7 @@ class LISResult(db.Model):
         unique=False,
         nullable=True
     )
-    dgid = db.Column(db.Integer, db.ForeignKey('lis_datagram.dgid'))
+    dgid = db.Column(db.Integer, db.ForeignKey('lis_datagram.dgid'), index=True)
     # datagram = db.relationship('LISDatagram')
 
     @classmethod
@@ -278,88 +671,195 @@ class LISResult(db.Model):
             logger.info(f"+LISComment(id={obj.id})")
             return obj
 
-def publish_results(current_app):
+class LISDelivery(db.Model):
     """
+    Outcome of a datagram's delivery to one destination (uplink, audit,
+    archive, slack), each destination is delivered on its own
     """
-    from agentpi.apps.astm.models import LISDatagram
-    lds = db.session.query(LISDatagram)
-    stop_this = False
-    for ld in lds:
-        if(not ld.is_vialid_uaxx):
-            continue
-        print(f"{ld.id}:{ld.patient.patient_id} - is_uploaded: {ld.is_uploaded} - is_error: {ld.is_error} - is_skipped: {ld.is_skipped}")
-        results = ld.results.all()
-        if(len(results) == 1):
-            if(not ld.is_uploaded and ld.is_error):
-                url = current_app.config['SARS_UPLINK_API_URL']
-                key = current_app.config['SARS_UPLINK_API_KEY']
-                payload = {
-                    'vialId': ld.patient.patient_id,
-                    'testType': ld.order.test_type,
-                    'results': results[0].test_value,
-                    'serialNo': ld.instrument_serial_number,
-                    'resultTime': results[0].completion.strftime("%Y%m%d%H%M%S") if results[0].completion else ''
-                }
-                headers = {
-                    'Content-Type': 'application/json',
-                    'x-api-key': key
-                }
-                if(results[0].completion > datetime.datetime(2020,10,15,0,0,0)):
-                    print("PUBLISHING...")
-                    print(f"url: {url}")
-                    pp.pprint(payload)
-                    try:
-                        stop_this = True
-                        res = requests.post(url, data=json.dumps(payload), headers=headers)
-                        res.raise_for_status()
-                    except requests.exceptions.HTTPError as e:
-                        logger.error(repr(e))
-                        logger.error(f"url: '{url}'")
-                        logger.error(f"HTTP error with patient_id: '{payload['vialId']}'")
-
-                    except requests.exceptions.ConnectionError as e:
-                        logger.error(repr(e))
-                        logger.error(f"url: '{url}'")
-                        logger.error(f"Connection error with patient_id: '{payload['vialId']}'")
-
-                    except requests.exceptions.Timeout as e:
-                        logger.error(repr(e))
-                        logger.error(f"url: '{url}'")
-                        logger.error(f"Timeout with patient_id '{payload['vialId']}'")
-
-                    except (requests.exceptions.RequestException, Exception) as e:
-                        logger.error(repr(e))
-                        logger.error(f"url: '{url}'")
-                        logger.error(f"Unknown error with patient_id '{payload['vialId']}'")
-                    else:
-                        if(res.status_code == 200):
-                            # Successfully uploaded data
-                            ld.is_uploaded = True
-                            ld.is_error = False
-                            db.session.commit()
-                        else:
-                            # This should be impossible
-                            logger.error(f"HTTP ERROR '{res.status_code}': : {payload['vialId']}")
-        else:
-            print(f"Couldn't upload [patient_id]: {ld.patient.patient_id}")
-        # if(stop_this):
-        #     break
+    __tablename__ = 'lis_delivery'
+    dgid = db.Column(
+        db.Integer, db.ForeignKey('lis_datagram.dgid'), primary_key=True
+    )
+    destination = db.Column(db.String(12), primary_key=True)
+    # 'ok' | 'error'
+    status = db.Column(db.String(8), nullable=False)
+    failure = db.Column(db.String(32), nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.datetime.utcnow
+    )
+
+    def __repr__(self):
+        return f"<LISDelivery {self.dgid} {self.destination} {self.status}>"
+
+    @classmethod
+    def record(cls, deliveries):
+        """
+        Upsert (dgid, destination, failure) outcomes on the session and
+        count the attempt, the caller commits. One INSERT ... ON CONFLICT
+        per outcome on Postgres, so concurrent writers can't both insert;
+        SELECT then UPDATE or INSERT elsewhere.
+        """
+        table = cls.__table__
+        now = datetime.datetime.utcnow()
+        for dgid, destination, failure in deliveries:
+            values = {
+                'status': 'ok' if failure is None else 'error',
+                'failure': failure,
+                'updated_at': now,
+            }
+            if(db.engine.dialect.name == 'postgresql'):
+                db.session.execute(
+                    postgresql.insert(table).values(
+                        dgid=dgid, destination=destination, attempts=1,
+                        **values
+                    ).on_conflict_do_update(
+                        index_elements=[table.c.dgid, table.c.destination],
+                        set_=dict(values, attempts=table.c.attempts + 1),
+                    )
+                )
+                continue
+            found = db.session.query(cls.dgid).filter(
+                cls.dgid == dgid, cls.destination == destination
+            ).first()
+            if(found is None):
+                db.session.add(cls(
+                    dgid=dgid, destination=destination, attempts=1, **values
+                ))
+                continue
+            db.session.query(cls).filter(
+                cls.dgid == dgid, cls.destination == destination
+            ).update(
+                dict(values, attempts=cls.attempts + 1),
+                synchronize_session=False
+            )
+
+def datagram_payload(ld, results):
+    """
+    Rebuild the uplink payload of a stored datagram, None unless it has
+    exactly one result
+    """
+    if(len(results) != 1 or ld.patient is None):
+        return None
+    return {
+        'vialId': ld.patient.patient_id,
+        'testType': ld.order.test_type if ld.order else '',
+        'results': results[0].test_value,
+        'serialNo': ld.instrument_serial_number,
+        'resultTime': format_timestamp(results[0].completion)
+    }
 
 
-def show_results(current_app):
+def publish_results(current_app, concurrency=4, rate=None, since=None,
+                    until=None, dry_run=False):
     """
+    Bulk replay of every failed upload, due or not
+    (start_retry_service does this continuously)
     """
-    from agentpi.apps.astm.models import LISDatagram
-    lds = db.session.query(LISDatagram)
-    for ld in lds:
-        results = ld.results.all()
-        if(results[0].completion > datetime.datetime(2020,10,15,0,0,0)):
-            print(
-                f"[{ld.id}]:[{ld.patient.patient_id}] - is_uploaded: "
-                f"{ld.is_uploaded} - is_error: {ld.is_error} - "
-                f"is_skipped: {ld.is_skipped} - is_vialid_uaxx: "
-                f"{ld.is_vialid_uaxx}"
-            )
+    from agentpi.apps.astm.retry import replay
+    app = current_app._get_current_object()
+    # one pooled connection per replay thread
+    app.config['UPLINK_POOL_MAXSIZE'] = max(
+        app.config['UPLINK_POOL_MAXSIZE'], concurrency
+    )
+    stats = replay(
+        app,
+        concurrency=concurrency,
+        rate=rate,
+        since=since,
+        until=until,
+        dry_run=dry_run,
+        echo=print,
+    )
+    if(dry_run):
+        print(f"DRY RUN: {stats.found} failed uploads would be published")
+    else:
+        print(stats.summary())
+
+
+REPORT_COLUMNS = [
+    ('dgid', LISDatagram.id),
+    ('created_at', LISDatagram.created_at),
+    ('serial', LISDatagram.instrument_serial_number),
+    ('patient_id', LISPatient.patient_id),
+    ('test_type', LISOrder.test_type),
+    ('result', LISResult.test_value),
+    ('completion', LISResult.completion),
+    ('is_uploaded', LISDatagram.is_uploaded),
+    ('is_error', LISDatagram.is_error),
+    ('is_skipped', LISDatagram.is_skipped),
+    ('is_vialid_uaxx', LISDatagram.is_vialid_uaxx),
+    ('attempts', LISDatagram.upload_attempts),
+]
+
+REPORT_STATUS = {
+    'uploaded': LISDatagram.is_uploaded,
+    'error': db.and_(LISDatagram.is_error, db.not_(LISDatagram.is_uploaded)),
+    'skipped': LISDatagram.is_skipped,
+}
+
+
+def report_rows(since=None, until=None, instrument=None, status=None,
+                batch_size=1000):
+    """
+    Stream one flat row per (datagram, result) -- a datagram without
+    results still gets a row -- from a single outer-joined query on a
+    server-side cursor
+    """
+    query = db.session.query(
+        *[column for name, column in REPORT_COLUMNS]
+    ).select_from(
+        LISDatagram
+    ).outerjoin(
+        LISPatient, LISPatient.dgid == LISDatagram.id
+    ).outerjoin(
+        LISOrder, LISOrder.dgid == LISDatagram.id
+    ).outerjoin(
+        LISResult, LISResult.dgid == LISDatagram.id
+    )
+    if(since):
+        query = query.filter(LISDatagram.created_at >= since)
+    if(until):
+        query = query.filter(LISDatagram.created_at < until)
+    if(instrument):
+        query = query.filter(LISDatagram.instrument_serial_number == instrument)
+    if(status):
+        query = query.filter(REPORT_STATUS[status])
+    return query.order_by(LISDatagram.id).yield_per(batch_size)
+
+
+def show_results(current_app, since=None, until=None, instrument=None,
+                 status=None, fmt='table', out=None):
+    """
+    Print the datagram report as a table, CSV or NDJSON
+    """
+    import csv
+    import sys
+    out = out or sys.stdout
+    names = [name for name, column in REPORT_COLUMNS]
+    rows = report_rows(since, until, instrument, status)
+    if(fmt == 'csv'):
+        writer = csv.writer(out)
+        writer.writerow(names)
+        for row in rows:
+            writer.writerow(['' if v is None else v for v in row])
+    elif(fmt == 'ndjson'):
+        for row in rows:
+            out.write(json.dumps(
+                dict(zip(names, row)), default=lambda v: v.isoformat()
+            ) + '\n')
+    else:
+        line = '{:>8} {:19} {:12} {:12} {:6} {:10} {:19} {:5} {:5} {:5} {:5} {:>4}\n'
+        out.write(line.format(*[
+            'dgid', 'created_at', 'serial', 'patient_id', 'test', 'result',
+            'completion', 'upld', 'err', 'skip', 'uaxx', 'try'
+        ]))
+        for row in rows:
+            out.write(line.format(*[
+                (v.strftime("%Y-%m-%d %H:%M:%S") if isinstance(v, datetime.datetime) else str(v))
+                if v is not None else '' for v in row
+            ]))
+
 
 __all__ = [
     'LISDatagram', 'LISPatient', 'LISOrder', 'LISComment', 'LISResult'
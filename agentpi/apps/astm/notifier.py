@@ -0,0 +1,170 @@
+"""Slack notices, sent by a background thread off the ingest/upload path.
+
+notify() never blocks: it drops (and counts, slack.dropped) what doesn't
+fit the bounded queue. Repeats are coalesced: the first notice with a given
+key that is queued goes out, the ones after it within SLACK_DIGEST_SECONDS
+are only counted (they never take a queue slot) and sent as one digest. The sender posts at most
+SLACK_RATE notices a second.
+"""
+import logging
+import queue
+import threading
+import time
+
+from agentpi.library import TokenBucket
+from .metrics import metrics
+from .uplink import slack_message
+
+
+logger = logging.getLogger(__name__)
+
+
+# digest key -> what is being counted, "37 upload errors in last 60s"
+DIGEST_LABELS = {
+    'upload_error': 'upload errors',
+}
+
+
+def slack_enabled(config):
+    return bool(config['SLACK_WEBHOOK'] and config['SLACK_CHANNEL_ENABLED'])
+
+
+class Digest(object):
+    __slots__ = ('key', 'text', 'count', 'until')
+
+    def __init__(self, key, text, until):
+        self.key = key
+        self.text = text
+        self.count = 0
+        self.until = until
+
+
+class SlackNotifier(object):
+    """
+    Bounded queue of notices drained by one daemon thread
+    """
+    def __init__(self, app):
+        config = app.config
+        self.app = app
+        self.window = config['SLACK_DIGEST_SECONDS']
+        self.queue = queue.Queue(maxsize=config['SLACK_QUEUE_MAXSIZE'])
+        self.bucket = TokenBucket(config['SLACK_RATE'], burst=config['SLACK_BURST'])
+        # key -> Digest of the repeats since its first notice
+        self.digests = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name='slack-notifier', daemon=True
+        )
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        if(self.thread is not None):
+            try:
+                self.queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            self.thread.join(timeout)
+            self.thread = None
+
+    def notify(self, text, key=None):
+        """
+        Queue a notice, `key` (default: the text) groups repeats into a
+        digest. Returns False if it was dropped.
+        """
+        if(not slack_enabled(self.app.config)):
+            return False
+        key = key or text
+        with self.lock:
+            digest = self.digests.get(key)
+            if(digest is not None):
+                digest.count += 1
+            else:
+                try:
+                    self.queue.put_nowait(text)
+                except queue.Full:
+                    # no digest: the next one with this key is queued
+                    # again, not reported as a repeat of one never sent
+                    metrics.incr('slack.dropped')
+                    return False
+                self.digests[key] = Digest(
+                    key, text, time.monotonic() + self.window
+                )
+        if(digest is not None):
+            metrics.incr('slack.coalesced')
+            return True
+        metrics.gauge('slack.queue_depth', self.queue.qsize())
+        return True
+
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.next_flush())
+            except queue.Empty:
+                item = False
+            try:
+                if(item is None):
+                    self.flush(force=True)
+                    return
+                if(item):
+                    self.send(item)
+                self.flush()
+            except Exception:
+                ## DO NOT BREAK!!!
+                logger.exception("Slack notifier failure")
+
+    def next_flush(self):
+        """
+        Seconds until the oldest digest is due (None: nothing pending)
+        """
+        with self.lock:
+            if(not self.digests):
+                return None
+            until = min(d.until for d in self.digests.values())
+        return max(0.0, until - time.monotonic())
+
+    def flush(self, force=False):
+        """
+        Send the digests whose window is over; one without repeats is just
+        forgotten, the next notice with its key goes out right away
+        """
+        now = time.monotonic()
+        with self.lock:
+            due = [
+                self.digests.pop(key)
+                for key, digest in list(self.digests.items())
+                if force or digest.until <= now
+            ]
+        for digest in due:
+            if(not digest.count):
+                continue
+            label = DIGEST_LABELS.get(digest.key)
+            self.send(
+                f"{digest.count} {label} in last {self.window:g}s" if label
+                else f"{digest.count} more x '{digest.text}' in last {self.window:g}s"
+            )
+
+    def send(self, text):
+        self.bucket.acquire()
+        if(slack_message(self.app, text)):
+            metrics.incr('slack.sent')
+        else:
+            metrics.incr('slack.error')
+
+
+_lock = threading.Lock()
+
+
+def get_notifier(app):
+    """
+    Return the app's SlackNotifier, started on first use
+    """
+    with _lock:
+        notifier = app.extensions.get('astm_notifier')
+        if(notifier is None):
+            notifier = SlackNotifier(app)
+            notifier.start()
+            app.extensions['astm_notifier'] = notifier
+        return notifier
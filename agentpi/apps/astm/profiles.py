@@ -0,0 +1,26 @@
+"""Per-listener settings profiles."""
+import json
+from collections import ChainMap
+
+
+def load_profiles(config):
+    """
+    LIS_PROFILES as a dict: profile name -> config keys it overrides, e.g.
+    {"bench": {"DISABLE_UPLINK": true}}
+    """
+    profiles = config['LIS_PROFILES'] or {}
+    if(isinstance(profiles, str)):
+        profiles = json.loads(profiles)
+    return profiles
+
+
+def profile_config(config, profile=None):
+    """
+    The app config as seen by a listener bound with `profile`
+    """
+    if(not profile):
+        return config
+    profiles = load_profiles(config)
+    if(profile not in profiles):
+        raise KeyError(f"Unknown LIS profile '{profile}'")
+    return ChainMap(profiles[profile], config)
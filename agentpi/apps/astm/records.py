@@ -1,11 +1,25 @@
 from datetime import datetime
 
 from astm.mapping import (
-    Record, ConstantField, DateTimeField, IntegerField, NotUsedField,
-    TextField, RepeatedComponentField, Component
+    Record, ConstantField, ComponentField, DateTimeField, IntegerField,
+    NotUsedField, TextField, RepeatedComponentField, Component
 )
 
 
+# Sofia^29000021
+QuidelInstrument = Component.build(
+    TextField(name='model'),
+    TextField(name='serial_number'),
+)
+
+# ^^^SARS
+QuidelAnalyte = Component.build(
+    NotUsedField(name='unused00'),
+    NotUsedField(name='unused01'),
+    NotUsedField(name='unused02'),
+    TextField(name='name'),
+)
+
 QuidelHeaderRecord = Record.build(
     ConstantField(name='type', default='H'),  # 1
     RepeatedComponentField(Component.build(
@@ -14,7 +28,7 @@ QuidelHeaderRecord = Record.build(
     ), name='delimeter', default=[[], ['', '&']]),  # 2
     NotUsedField(name='unused01'), # 3
     NotUsedField(name='unused02'), # 4
-    TextField(name='instrument'),  # 5
+    ComponentField(QuidelInstrument, name='instrument'),  # 5
     NotUsedField(name='unused03'), # 6
     NotUsedField(name='unused03'), # 7
     NotUsedField(name='unused03'), # 8
@@ -85,7 +99,7 @@ QuidelCommentRecord = Record.build(
 QuidelResultRecord = Record.build(
     ConstantField(name='type', default='R'),  # 1
     IntegerField(name='seq', default=1, required=True),  # 2
-    TextField(name='analyte_name'),  # 3
+    ComponentField(QuidelAnalyte, name='analyte'),  # 3
     TextField(name='test_value'),  # 4
     TextField(name='test_units'),  # 5
     TextField(name='test_range'),  # 6
@@ -0,0 +1,370 @@
+"""Long running retry service for uploads that failed."""
+import logging
+import random
+import select
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy.orm import joinedload
+
+from agentpi import db
+from agentpi.library import TokenBucket, percentile
+from .archive import archive_payload, get_archive
+from .metrics import metrics
+from .models import (
+    LISDatagram, LISDelivery, LISResult, UPLOAD_RETRY_CHANNEL, datagram_payload
+)
+from .routing import route_vialid
+from .uplink import get_uplink, send_payload
+
+
+logger = logging.getLogger(__name__)
+
+
+def backoff_delay(attempts, base, cap):
+    """
+    Exponential backoff with "equal jitter": half fixed, half random
+    """
+    delay = min(cap, base * (2 ** attempts))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def first_attempt_at(config, now=None):
+    """
+    Retry time of a datagram whose upload is just being handed to the
+    upload queue (RETRY_INITIAL_DELAY), in case the worker never reports
+    """
+    return (now or datetime.utcnow()) + timedelta(
+        seconds=config['RETRY_INITIAL_DELAY']
+    )
+
+
+def next_attempt_after(config, attempts, now=None):
+    """
+    When to retry after `attempts` failures, None once RETRY_MAX_ATTEMPTS
+    is used up (the row then stays is_error but is no longer retried)
+    """
+    max_attempts = config['RETRY_MAX_ATTEMPTS']
+    if(max_attempts and attempts >= max_attempts):
+        return None
+    delay = backoff_delay(
+        attempts, config['RETRY_BACKOFF_BASE'], config['RETRY_BACKOFF_MAX']
+    )
+    return (now or datetime.utcnow()) + timedelta(seconds=delay)
+
+
+def failed_query():
+    """
+    Datagrams whose upload failed; the predicate matches the partial
+    index ix_lis_datagram_retry
+    """
+    return LISDatagram.query.filter(
+        LISDatagram.is_error, db.not_(LISDatagram.is_uploaded)
+    )
+
+
+def results_by_dgid(dgids):
+    results = {}
+    for result in LISResult.query.filter(LISResult.dgid.in_(dgids)):
+        results.setdefault(result.dgid, []).append(result)
+    return results
+
+
+class RetryScheduler(object):
+    """
+    Re-sends failed datagrams as their next_attempt_at comes due.
+
+    Sleeps until the earliest next_attempt_at (at most RETRY_POLL_INTERVAL)
+    and is woken early by NOTIFY on UPLOAD_RETRY_CHANNEL when running on
+    Postgres.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.batch_size = app.config['RETRY_BATCH_SIZE']
+        self.poll_interval = app.config['RETRY_POLL_INTERVAL']
+        self.listener = None
+
+    def due(self, now):
+        return self.collect(failed_query().filter(
+            LISDatagram.next_attempt_at <= now
+        ).order_by(
+            LISDatagram.next_attempt_at
+        ))
+
+    def collect(self, query):
+        """
+        Load one batch as (dgid, attempts, payload, destination) tuples
+        """
+        lds = query.options(
+            joinedload(LISDatagram.patient),
+            joinedload(LISDatagram.order),
+        ).limit(self.batch_size).all()
+        if(not lds):
+            return []
+        results = results_by_dgid([ld.id for ld in lds])
+        return [(
+            ld.id,
+            ld.upload_attempts or 0,
+            datagram_payload(ld, results.get(ld.id, [])),
+            ld.upload_destination,
+        ) for ld in lds]
+
+    def seconds_until_due(self):
+        next_at = db.session.query(
+            db.func.min(LISDatagram.next_attempt_at)
+        ).filter(
+            LISDatagram.is_error, db.not_(LISDatagram.is_uploaded)
+        ).scalar()
+        if(next_at is None):
+            return self.poll_interval
+        wait = (next_at - datetime.utcnow()).total_seconds()
+        return min(max(wait, 0), self.poll_interval)
+
+    def attempt(self, dgid, attempts, payload, destination=None):
+        """
+        Try one datagram again at the `destination` it was routed to when
+        stored (routed again by the default rules for rows stored without
+        one), returns (columns to store, failure class, destination tried)
+        """
+        if(destination is None):
+            destination = route_vialid(
+                payload['vialId'] if payload else None, self.app.config
+            ).destination
+        if(payload is None or destination is None):
+            logger.error(f"Couldn't upload [dgid]: {dgid}, giving up")
+            metrics.incr('retry.abandoned')
+            return {'next_attempt_at': None}, 'unroutable', None
+        if(destination == 'archive'):
+            archive = get_archive(self.app)
+            is_uploaded, is_error, failure = archive_payload(
+                archive, dgid, payload
+            ) if archive is not None else (False, True, 'unconfigured')
+        else:
+            client = get_uplink(self.app, destination)
+            if(client.breaker.remaining()):
+                # no attempt while the circuit is open, come back when it
+                # probes
+                return self.circuit_open(client.breaker)
+            is_uploaded, is_error, failure = send_payload(payload, client)
+            if(failure == 'circuit_open'):
+                # half open and another thread holds the probe, nothing was
+                # sent either
+                return self.circuit_open(client.breaker)
+        attempts += 1
+        if(is_uploaded):
+            metrics.incr('retry.ok')
+            return {
+                'is_uploaded': True,
+                'is_error': False,
+                'upload_attempts': attempts,
+                'next_attempt_at': None,
+            }, None, destination
+        metrics.incr('retry.error')
+        return {
+            'upload_attempts': attempts,
+            'next_attempt_at': next_attempt_after(self.app.config, attempts),
+        }, failure, destination
+
+    def circuit_open(self, breaker):
+        """
+        Reschedule without counting an attempt: when the circuit closes
+        again, or after a reset period while it is half open (remaining()
+        is 0 then)
+        """
+        metrics.incr('retry.circuit_open')
+        return {
+            'next_attempt_at': datetime.utcnow() + timedelta(
+                seconds=breaker.remaining() or breaker.reset_timeout
+            ),
+        }, 'circuit_open', None
+
+    def run_once(self):
+        """
+        Retry one batch of due datagrams, returns how many were tried
+        """
+        return self.retry(self.due(datetime.utcnow()))
+
+    def retry(self, batch):
+        """
+        Attempt a collected batch and store all outcomes in one commit
+        """
+        # don't sit in an open transaction while we talk to the uplink
+        db.session.rollback()
+        if(not batch):
+            return 0
+        outcomes = [
+            (item[0], ) + self.attempt(*item) for item in batch
+        ]
+        self.store(outcomes)
+        return len(batch)
+
+    def store(self, outcomes):
+        """
+        Save (dgid, flags, failure, destination) outcomes in one commit
+        """
+        try:
+            db.session.bulk_update_mappings(LISDatagram, [
+                dict(flags, id=dgid) for dgid, flags, _, _ in outcomes
+            ])
+            LISDelivery.record([
+                (dgid, destination, failure)
+                for dgid, _, failure, destination in outcomes
+                if destination is not None
+            ])
+            db.session.commit()
+        except Exception as e:
+            ## DO NOT BREAK!!!
+            db.session.rollback()
+            logger.error("WARNING -> DB failure saving retry outcomes")
+            logger.error(str(e))
+
+    def listen(self):
+        """
+        LISTEN on a dedicated connection, None means fall back to polling
+        """
+        if(db.engine.dialect.name != 'postgresql'):
+            return None
+        try:
+            raw = db.engine.raw_connection()
+            raw.detach()
+            conn = raw.connection
+            conn.autocommit = True
+            conn.cursor().execute(f"LISTEN {UPLOAD_RETRY_CHANNEL}")
+        except Exception as e:
+            logger.warning(
+                f"LISTEN unavailable, polling every {self.poll_interval}s: {e!r}"
+            )
+            return None
+        return conn
+
+    def wait(self, timeout):
+        if(self.listener is None):
+            time.sleep(timeout)
+            return
+        try:
+            if(select.select([self.listener], [], [], timeout)[0]):
+                self.listener.poll()
+                del self.listener.notifies[:]
+                metrics.incr('retry.wakeups')
+        except Exception as e:
+            logger.warning(f"LISTEN connection lost: {e!r}")
+            self.listener = None
+
+    def serve_forever(self):
+        logger.info(
+            f"Launching upload retry service (batch: {self.batch_size}, "
+            f"poll: {self.poll_interval}s)"
+        )
+        with self.app.app_context():
+            while True:
+                if(self.listener is None):
+                    self.listener = self.listen()
+                try:
+                    tried = self.run_once()
+                    if(tried >= self.batch_size):
+                        continue
+                    timeout = self.seconds_until_due()
+                except Exception:
+                    ## DO NOT BREAK!!!
+                    logger.exception("Retry pass failed")
+                    timeout = self.poll_interval
+                finally:
+                    db.session.remove()
+                self.wait(timeout)
+
+
+class ReplayStats(object):
+    """
+    Outcome and latency tally for a bulk replay
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.found = 0
+        self.ok = 0
+        self.latencies = []
+        self.failures = {}
+        self.elapsed = 0.0
+
+    def add(self, seconds, failure):
+        with self.lock:
+            self.latencies.append(seconds)
+            if(failure is None):
+                self.ok += 1
+            else:
+                self.failures[failure] = self.failures.get(failure, 0) + 1
+
+    def summary(self):
+        ordered = sorted(self.latencies)
+        sent = len(ordered)
+        rate = sent / self.elapsed if self.elapsed else 0.0
+        lines = [
+            f"found: {self.found}  sent: {sent}  ok: {self.ok}  "
+            f"failed: {sent - self.ok}  elapsed: {self.elapsed:.2f}s  "
+            f"throughput: {rate:.1f} req/s",
+            f"latency p50: {percentile(ordered, 50) * 1000:.1f}ms  "
+            f"p95: {percentile(ordered, 95) * 1000:.1f}ms  "
+            f"p99: {percentile(ordered, 99) * 1000:.1f}ms",
+        ]
+        if(self.failures):
+            lines.append("failures: " + '  '.join(
+                f"{name}={count}" for name, count in sorted(
+                    self.failures.items(), key=lambda kv: -kv[1]
+                )
+            ))
+        return '\n'.join(lines)
+
+
+def replay(app, concurrency=4, rate=None, since=None, until=None,
+           dry_run=False, echo=None):
+    """
+    Re-send every failed upload, due or not.
+
+    Rows are read in keyset pages of RETRY_BATCH_SIZE (by dgid), sent by
+    `concurrency` threads at no more than `rate` per second, and each
+    page's outcomes are committed together. `since`/`until` bound
+    created_at. With `dry_run` nothing is sent or written; `echo` (e.g.
+    print) is called with a line per row. Returns a ReplayStats.
+    """
+    scheduler = RetryScheduler(app)
+    bucket = TokenBucket(rate, burst=concurrency) if rate else None
+    stats = ReplayStats()
+    query = failed_query()
+    if(since):
+        query = query.filter(LISDatagram.created_at >= since)
+    if(until):
+        query = query.filter(LISDatagram.created_at < until)
+
+    def send(item):
+        if(bucket):
+            bucket.acquire()
+        start = time.perf_counter()
+        outcome = scheduler.attempt(*item)
+        stats.add(time.perf_counter() - start, outcome[1])
+        return (item[0], ) + outcome
+
+    start = time.perf_counter()
+    last_id = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            batch = scheduler.collect(
+                query.filter(
+                    LISDatagram.id > last_id
+                ).order_by(LISDatagram.id)
+            )
+            db.session.rollback()
+            if(not batch):
+                break
+            last_id = batch[-1][0]
+            stats.found += len(batch)
+            if(echo):
+                for dgid, attempts, payload, _ in batch:
+                    echo(
+                        f"[{dgid}]: {payload['vialId'] if payload else None}"
+                        f" - attempts: {attempts}"
+                    )
+            if(not dry_run):
+                scheduler.store(list(pool.map(send, batch)))
+    stats.elapsed = time.perf_counter() - start
+    return stats
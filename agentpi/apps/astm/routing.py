@@ -0,0 +1,183 @@
+"""Vial ID -> uplink destination routing."""
+import json
+import logging
+import re
+import signal
+from collections import namedtuple
+
+
+logger = logging.getLogger(__name__)
+
+
+Route = namedtuple(
+    'Route', ['destination', 'notify', 'is_vialid_uaxx', 'is_vialid_test']
+)
+
+SKIP = Route(None, False, False, False)
+
+# ONLY SEND UAXX-????? or TSTXX-?????? or TT-??? labels, first match wins.
+#   destination: uploads.DESTINATIONS name, null = store only
+#   notify: post "testid: ... sent!" to slack
+#   classification: 'uaxx' | 'test' | null, persisted as is_vialid_*
+DEFAULT_RULES = [
+    {
+        'name': 'uaxx',
+        'pattern': r'^UA[0-9]{2}-[0-9]*',
+        'destination': 'sars',
+        'notify': False,
+        'classification': 'uaxx',
+    },
+    {
+        'name': 'tt',
+        'pattern': r'^TT[a-zA-Z0-9]*$',
+        'destination': 'sars',
+        'notify': True,
+        'classification': 'test',
+    },
+    {
+        # UA01-TEST001
+        'name': 'uaxx_test',
+        'pattern': r'^UA[0-9]{2}-TEST[0-9]{3}$',
+        'destination': 'test',
+        'notify': True,
+        'classification': 'test',
+    },
+    {
+        # TST1-0000001
+        'name': 'tst',
+        'pattern': r'^TST[0-9]{1}-[0-9]{7}$',
+        'destination': 'test',
+        'notify': True,
+        'classification': 'test',
+    },
+]
+
+CLASSIFICATIONS = (None, 'uaxx', 'test')
+
+
+class RoutingTable(object):
+    """
+    Ordered rules compiled into one alternation, each rule wrapped in its
+    own named group; match.lastgroup names the rule that matched.
+    """
+    def __init__(self, rules):
+        # uploads -> retry -> routing
+        from .uploads import DESTINATIONS
+        self.rules = list(rules)
+        self.routes = {}
+        alternatives = []
+        for i, rule in enumerate(self.rules):
+            name = rule.get('name', f'rule {i}')
+            pattern = rule['pattern']
+            if(re.compile(pattern).groups):
+                raise ValueError(
+                    f"Routing rule '{name}': use (?:...), capturing groups "
+                    "would break the combined matcher"
+                )
+            destination = rule.get('destination')
+            if(destination is not None and destination not in DESTINATIONS):
+                raise ValueError(
+                    f"Routing rule '{name}': unknown destination '{destination}'"
+                )
+            classification = rule.get('classification')
+            if(classification not in CLASSIFICATIONS):
+                raise ValueError(
+                    f"Routing rule '{name}': unknown classification "
+                    f"'{classification}'"
+                )
+            group = f'r{i}'
+            alternatives.append(f'(?P<{group}>{pattern})')
+            self.routes[group] = Route(
+                destination,
+                bool(rule.get('notify', False)),
+                classification == 'uaxx',
+                classification == 'test',
+            )
+        self.matcher = re.compile('|'.join(alternatives)) if (
+            alternatives
+        ) else None
+
+    def route(self, vial_id):
+        if(self.matcher is None):
+            return SKIP
+        match = self.matcher.match(vial_id or '')
+        if(match is None):
+            return SKIP
+        return self.routes[match.lastgroup]
+
+
+def load_rules(config):
+    """
+    ROUTING_RULES_FILE (JSON) if set, else ROUTING_RULES (JSON or a list),
+    else DEFAULT_RULES
+    """
+    if(config['ROUTING_RULES_FILE']):
+        with open(config['ROUTING_RULES_FILE']) as f:
+            return json.load(f)
+    rules = config['ROUTING_RULES']
+    if(not rules):
+        return DEFAULT_RULES
+    if(isinstance(rules, str)):
+        return json.loads(rules)
+    return rules
+
+
+# rules source -> (generation, RoutingTable)
+_tables = {}
+_generation = 0
+
+
+def reload_rules(*args):
+    """
+    Rebuild routing tables on next use (safe from a signal handler)
+    """
+    global _generation
+    _generation += 1
+    logger.info("Routing rules will be reloaded")
+
+
+def install_reload_signal():
+    """
+    Reload routing rules on SIGHUP, open connections are not touched
+    """
+    if(not hasattr(signal, 'SIGHUP')):
+        return False
+    try:
+        signal.signal(signal.SIGHUP, reload_rules)
+    except ValueError:
+        # not the main thread
+        return False
+    return True
+
+
+def routing_table(config):
+    """
+    Compiled RoutingTable for `config`, a bad reload keeps the old table
+    """
+    source = config['ROUTING_RULES_FILE'] or config['ROUTING_RULES']
+    key = json.dumps(source, sort_keys=True) if (
+        isinstance(source, (list, dict))
+    ) else source
+    cached = _tables.get(key)
+    if(cached is not None and cached[0] == _generation):
+        return cached[1]
+    generation = _generation
+    try:
+        table = RoutingTable(load_rules(config))
+    except (OSError, ValueError, KeyError, TypeError, re.error) as e:
+        if(cached is None):
+            raise
+        logger.error(f"Routing rules reload failed, keeping previous: {e!r}")
+        table = cached[1]
+    else:
+        if(cached is not None):
+            logger.info(f"Loaded {len(table.rules)} routing rules")
+    _tables[key] = (generation, table)
+    return table
+
+
+def route_vialid(vial_id, config):
+    """
+    Route for a vial ID under `config`'s routing rules
+    """
+    return routing_table(config).route(vial_id)
@@ -0,0 +1,103 @@
+"""Record extractors compiled from the Quidel* declarations in records.py.
+
+Each declared (non constant, used) field becomes a getter of (field
+position, component position, converter); component fields are flattened
+as <field>_<component>, e.g. instrument_serial_number. Adding a field to
+records.py is all it takes to extract it.
+"""
+import logging
+from collections import namedtuple
+
+from astm.mapping import (
+    ComponentField, ConstantField, DateTimeField, IntegerField, NotUsedField,
+    RepeatedComponentField
+)
+
+from .codec import COMPONENT_SEP, ENCODING
+from .records import (
+    QuidelHeaderRecord, QuidelPatientRecord, QuidelOrderRecord,
+    QuidelCommentRecord, QuidelResultRecord
+)
+from .timestamps import parse_timestamp
+
+
+logger = logging.getLogger(__name__)
+
+
+# astm field class -> (converter from text, type name for the logs), text
+# fields stay as they are
+CONVERTERS = {
+    DateTimeField: (parse_timestamp, 'datetime'),
+    IntegerField: (int, 'int'),
+}
+
+SKIPPED = (ConstantField, NotUsedField, RepeatedComponentField)
+
+
+class RecordSchema(object):
+    """
+    Compiled extractor for one astm Record mapping, calling it with a
+    codec.Record gives a `self.type` namedtuple; missing, empty or
+    malformed fields are None
+    """
+    def __init__(self, name, mapping, encoding=ENCODING):
+        self.encoding = encoding
+        self.title = name.upper()
+        self.getters = []
+        for index, (field_name, field) in enumerate(mapping._fields):
+            if(isinstance(field, SKIPPED)):
+                continue
+            if(isinstance(field, ComponentField)):
+                for component, (sub_name, sub_field) in enumerate(
+                    field.mapping._fields
+                ):
+                    if(isinstance(sub_field, SKIPPED)):
+                        continue
+                    self.getters.append((
+                        f'{field_name}_{sub_name}',
+                        index,
+                        component,
+                        CONVERTERS.get(type(sub_field)),
+                    ))
+            else:
+                self.getters.append((
+                    field_name, index, None, CONVERTERS.get(type(field))
+                ))
+        self.type = namedtuple(name, [getter[0] for getter in self.getters])
+        # all None, for a record that never arrived
+        self.empty = self.type._make([None] * len(self.getters))
+
+    def __call__(self, record):
+        fields = record.fields
+        count = len(fields)
+        encoding = self.encoding
+        values = []
+        for name, index, component, convert in self.getters:
+            raw = fields[index] if index < count else b''
+            if(component is not None and raw):
+                parts = raw.split(COMPONENT_SEP)
+                raw = parts[component] if component < len(parts) else b''
+            if(not raw):
+                values.append(None)
+                continue
+            value = raw.decode(encoding)
+            if(convert is not None):
+                try:
+                    value = convert[0](value)
+                except ValueError:
+                    logger.error(
+                        f"ERROR on {self.title}, field pos {index}: "
+                        f"'{value}' TypeError to {convert[1]}!"
+                    )
+                    value = None
+            values.append(value)
+        return self.type._make(values)
+
+
+SCHEMAS = {
+    'H': RecordSchema('Header', QuidelHeaderRecord),
+    'P': RecordSchema('Patient', QuidelPatientRecord),
+    'O': RecordSchema('Order', QuidelOrderRecord),
+    'C': RecordSchema('Comment', QuidelCommentRecord),
+    'R': RecordSchema('Result', QuidelResultRecord),
+}
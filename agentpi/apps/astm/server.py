@@ -1,40 +1,210 @@
+import functools
 import logging
+import re
+from collections import namedtuple
+
 import netifaces as ni
 
 from astm import server
+from astm.constants import NAK
 
 from agentpi.library import is_ipv4
+from .codec import CHECKSUM_MODES
 from .dispatcher import AgentRecordDispatcher
+from .flow import ACTIONS, get_flow_control
+from .metrics import start_reporter
+from .notifier import get_notifier
+from .profiles import load_profiles, profile_config
+from .routing import install_reload_signal, routing_table
+from .spool import SpoolIngester
+from .sqlite_store import SqliteSync
+from .uploads import get_upload_queue
 
 
 logger = logging.getLogger(__name__)
 
+# eth0:11011, 10.0.0.5:11012@bench
+BIND_SPEC = re.compile(r'^(?P<interface>[^:@\s]+):(?P<port>[0-9]+)(?:@(?P<profile>[\w-]+))?$')
+
+Bind = namedtuple('Bind', ['interface', 'port', 'profile'])
+
+Listener = namedtuple('Listener', ['name', 'host', 'port', 'profile'])
+
+
+def parse_bind(spec):
+    """
+    'NIC_OR_IPV4:PORT[@profile]' -> Bind
+    """
+    match = BIND_SPEC.match(spec.strip())
+    if(match is None):
+        raise ValueError(f"Invalid bind '{spec}', expected NIC_OR_IP:PORT[@profile]")
+    return Bind(
+        match.group('interface'),
+        int(match.group('port')),
+        match.group('profile'),
+    )
+
+
+def parse_binds(specs):
+    """
+    Bind specs from a list or a comma/space separated string (LIS_BINDS)
+    """
+    if(isinstance(specs, str)):
+        specs = re.split(r'[,\s]+', specs)
+    return [parse_bind(spec) for spec in specs if spec.strip()]
+
 
-def run_server(current_app, port, astm_nic):
-    astm_port = int(port)
-    print(f"astm_nic: {astm_nic}  astm_port: {astm_port} ")
+def resolve_ip(astm_nic):
+    """
+    IPv4 address to bind for an interface name or address, None if the
+    interface doesn't exist or has no address
+    """
     if(is_ipv4(astm_nic)):
-        ip = astm_nic
-    else:
-        try:
-            ni.ifaddresses(astm_nic)
-        except ValueError:
-            logger.error(f"ERROR: No interface {astm_nic} found.")
-            return
-        try:
-            ip = ni.ifaddresses(astm_nic)[ni.AF_INET][0]['addr']
-        except KeyError:
+        return astm_nic
+    try:
+        ni.ifaddresses(astm_nic)
+    except ValueError:
+        logger.error(f"ERROR: No interface {astm_nic} found.")
+        return None
+    try:
+        return ni.ifaddresses(astm_nic)[ni.AF_INET][0]['addr']
+    except KeyError:
+        logger.error(f"ERROR: No IP found on interface {astm_nic}.")
+        return None
+
 
-            logger.error(f"ERROR: No IP found on interface {astm_nic}.")
+def resolve_listeners(config, binds):
+    """
+    Bind specs -> Listeners, None if any of them can't be bound
+    """
+    profiles = load_profiles(config)
+    listeners = []
+    for bind in binds:
+        if(bind.profile and bind.profile not in profiles):
+            logger.error(f"ERROR: No LIS profile '{bind.profile}' (LIS_PROFILES)")
+            return None
+        ip = resolve_ip(bind.interface)
+        if(ip is None):
+            return None
+        listeners.append(Listener(
+            f"{bind.interface}:{bind.port}", ip, bind.port, bind.profile
+        ))
+    return listeners
+
+
+class FlowControlRequestHandler(server.RequestHandler):
+    """
+    astm RequestHandler that NAKs the ENQ of a new session while
+    backpressure is engaged (`delay` can't wait on the one asyncore loop,
+    it NAKs right away)
+    """
+    def on_enq(self):
+        if(not self._is_transfer_state):
+            flow = get_flow_control(self.dispatcher.app)
+            if(not flow.admit(self.dispatcher.listener)):
+                return NAK
+        return super().on_enq()
+
+
+class FlowControlServer(server.Server):
+    """
+    astm Server that closes new connections while backpressure is engaged
+    with LIS_BACKPRESSURE_ACTION=refuse
+    """
+    request = FlowControlRequestHandler
+
+    def __init__(self, flow, listener, **kwargs):
+        self.flow = flow
+        self.listener = listener
+        super().__init__(**kwargs)
+
+    def handle_accept(self):
+        if(self.flow.refuses(self.listener)):
+            pair = self.accept()
+            if(pair is not None):
+                logger.warning(
+                    f"{self.listener} {pair[1]}: refused, "
+                    f"backpressure ({self.flow.reason})"
+                )
+                pair[0].close()
             return
+        super().handle_accept()
 
-    logger.info(f"Launching service on {astm_nic}: {ip}:{astm_port}")
-    s = server.Server(
-        host=ip,
-        port=astm_port,
-        request=None,
-        dispatcher=AgentRecordDispatcher,
-        timeout=None,
-        encoding=None
-    )
-    s.serve_forever()
+
+def run_server(current_app, binds, engine=None):
+    """
+    Serve every bind from this one process -- a single event loop, DB
+    engine and uplink pool
+    """
+    app = current_app._get_current_object()
+    engine = engine or app.config['LIS_ENGINE']
+    listeners = resolve_listeners(app.config, binds)
+    if(not listeners):
+        return
+
+    # fail fast on bad settings rather than on the first datagram
+    try:
+        for listener in listeners:
+            config = profile_config(app.config, listener.profile)
+            routing_table(config)
+            if(config['LIS_CHECKSUM'] not in CHECKSUM_MODES):
+                raise ValueError(f"LIS_CHECKSUM '{config['LIS_CHECKSUM']}'")
+        if(app.config['LIS_SPOOL_DIR'] and app.config['LIS_SQLITE_STORE']):
+            raise ValueError('LIS_SPOOL_DIR and LIS_SQLITE_STORE are exclusive')
+        if(app.config['LIS_BACKPRESSURE_ACTION'] not in ACTIONS):
+            raise ValueError(
+                f"LIS_BACKPRESSURE_ACTION '{app.config['LIS_BACKPRESSURE_ACTION']}'"
+            )
+    except Exception as e:
+        logger.error(f"ERROR: Invalid LIS settings: {e!r}")
+        return
+    install_reload_signal()
+
+    timeout = app.config['LIS_CONNECTION_TIMEOUT'] or None
+    for listener in listeners:
+        logger.info(
+            f"Launching {engine} service on {listener.name}: "
+            f"{listener.host}:{listener.port} "
+            f"(profile: {listener.profile or 'default'})"
+        )
+    if(engine == 'asyncio'):
+        from .aio import AsyncServer
+        s = AsyncServer(app, listeners, timeout=timeout)
+    else:
+        # every astm Server registers with the one asyncore socket map, so
+        # serve_forever on any of them polls them all
+        flow = get_flow_control(app)
+        for listener in listeners:
+            s = FlowControlServer(
+                flow,
+                listener.name,
+                host=listener.host,
+                port=listener.port,
+                request=None,
+                dispatcher=functools.partial(
+                    AgentRecordDispatcher,
+                    app=app,
+                    listener=listener.name,
+                    profile=listener.profile,
+                ),
+                timeout=timeout,
+                encoding=None
+            )
+    upload_queue = get_upload_queue(app)
+    notifier = get_notifier(app)
+    ingester = None
+    if(app.config['LIS_SPOOL_DIR']):
+        ingester = SpoolIngester(app)
+        ingester.start()
+    elif(app.config['LIS_SQLITE_STORE']):
+        ingester = SqliteSync(app)
+        ingester.start()
+    start_reporter(app.config['METRICS_LOG_INTERVAL'])
+    try:
+        s.serve_forever()
+    finally:
+        if(ingester is not None):
+            ingester.stop(timeout=10)
+        upload_queue.stop(timeout=10)
+        # flushes the pending digests
+        notifier.stop(timeout=10)
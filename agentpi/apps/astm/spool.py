@@ -0,0 +1,538 @@
+"""Local write-ahead spool, datagrams hit the disk before the database.
+
+The dispatcher appends each datagram (raw messages, parsed records and the
+upload it should trigger) to the current segment and returns once it is
+fsynced, concurrent appends share one fsync. SpoolIngester loads segments
+into the lis_* tables in batches and checkpoints what it has applied, so
+neither a slow nor a missing database holds up or loses a datagram.
+
+A segment is a run of entries: length (4 bytes) + crc32 (4 bytes) + JSON.
+A torn entry at the end of a segment (crash mid-write) ends that segment.
+Entries the database rejects are moved to the DEAD_LETTER file, in the
+same format, so they don't hold up the ones after them.
+"""
+import base64
+import fcntl
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from agentpi import db
+from .metrics import metrics
+from .models import LISDatagram, is_rejected
+from .retry import first_attempt_at
+from .schema import SCHEMAS
+from .uploads import UploadJob, get_upload_queue
+
+
+logger = logging.getLogger(__name__)
+
+
+ENTRY = struct.Struct('>II')
+SUFFIX = '.spool'
+CHECKPOINT = 'checkpoint'
+INGEST_LOCK = 'ingest.lock'
+DEAD_LETTER = 'dead-letter'
+
+
+def _default(value):
+    if(isinstance(value, datetime)):
+        return {'$datetime': value.isoformat()}
+    elif(isinstance(value, bytes)):
+        return {'$bytes': base64.b64encode(value).decode()}
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _object_hook(obj):
+    if(len(obj) == 1):
+        if('$datetime' in obj):
+            return datetime.fromisoformat(obj['$datetime'])
+        elif('$bytes' in obj):
+            return base64.b64decode(obj['$bytes'])
+    return obj
+
+
+def encode_entry(entry):
+    data = json.dumps(entry, default=_default, separators=(',', ':')).encode()
+    return ENTRY.pack(len(data), zlib.crc32(data)) + data
+
+
+def decode_entry(data):
+    return json.loads(data.decode(), object_hook=_object_hook)
+
+
+def datagram_entry(datagram, patient, order, comments, results, upload=None):
+    """
+    Spool entry of one datagram; records are schema.SCHEMAS namedtuples,
+    `upload` a (payload, destination, notify) to enqueue once it's stored
+    """
+    return {
+        'datagram': datagram,
+        'patient': patient._asdict() if patient else None,
+        'order': order._asdict() if order else None,
+        'comments': [c._asdict() for c in comments],
+        'results': [r._asdict() for r in results],
+        'upload': upload,
+    }
+
+
+def _record(schema, values):
+    if(values is None):
+        return None
+    return schema.type._make([values.get(f) for f in schema.type._fields])
+
+
+def entry_records(entry):
+    """
+    The (patient, order, comments, results) records of a spool entry
+    """
+    return (
+        _record(SCHEMAS['P'], entry['patient']),
+        _record(SCHEMAS['O'], entry['order']),
+        [_record(SCHEMAS['C'], c) for c in entry['comments']],
+        [_record(SCHEMAS['R'], r) for r in entry['results']],
+    )
+
+
+def segment_path(directory, number):
+    return os.path.join(directory, f'{number:016d}{SUFFIX}')
+
+
+def list_segments(directory):
+    """
+    [(number, path), ...] oldest first
+    """
+    return sorted(
+        (int(name[:-len(SUFFIX)]), os.path.join(directory, name))
+        for name in os.listdir(directory) if name.endswith(SUFFIX)
+    )
+
+
+def read_segment(path, offset=0, limit=None):
+    """
+    Yield (offset after, entry) from `offset`, up to `limit` entries
+    """
+    count = 0
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while limit is None or count < limit:
+            head = f.read(ENTRY.size)
+            if(len(head) < ENTRY.size):
+                return
+            size, crc = ENTRY.unpack(head)
+            data = f.read(size)
+            if(len(data) < size or zlib.crc32(data) != crc):
+                # torn write, or still being written
+                return
+            offset += ENTRY.size + size
+            count += 1
+            yield offset, decode_entry(data)
+
+
+def load_checkpoint(directory):
+    """
+    (segment, offset) of the first entry not yet in the database
+    """
+    try:
+        with open(os.path.join(directory, CHECKPOINT)) as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return (0, 0)
+    return (checkpoint['segment'], checkpoint['offset'])
+
+
+def save_checkpoint(directory, segment, offset):
+    path = os.path.join(directory, CHECKPOINT)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'segment': segment, 'offset': offset}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+class Spool(object):
+    """
+    Appender, segments are rotated past `segment_bytes`. Each process
+    starts a new segment, never writing after a possibly torn one.
+    """
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024, fsync=True):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.written = 0
+        self.synced = 0
+        os.makedirs(directory, exist_ok=True)
+        segments = list_segments(directory)
+        self.segment = segments[-1][0] + 1 if segments else 1
+        self.file = None
+        self.size = 0
+        self.open()
+
+    def open(self):
+        self.file = open(segment_path(self.directory, self.segment), 'ab')
+        self.size = self.file.tell()
+
+    def rotate(self):
+        # the segment is complete (flushed and synced) before the next one
+        # shows up, the ingester relies on it
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.segment += 1
+        self.open()
+
+    def append(self, entry):
+        """
+        Write `entry`, returns once it is on disk
+        """
+        data = encode_entry(entry)
+        with self.lock:
+            if(self.size and self.size + len(data) > self.segment_bytes):
+                self.rotate()
+            self.file.write(data)
+            self.size += len(data)
+            self.written += 1
+            lsn = self.written
+        metrics.incr('spool.appended')
+        metrics.incr('spool.bytes', len(data))
+        self.sync(lsn)
+
+    def sync(self, lsn):
+        """
+        Group commit: one fsync covers every append made before it
+        """
+        with self.sync_lock:
+            if(self.synced >= lsn):
+                return
+            with self.lock:
+                self.file.flush()
+                target = self.written
+                # a dup survives a rotate closing the file meanwhile
+                fd = os.dup(self.file.fileno()) if self.fsync else None
+            if(fd is not None):
+                start = time.perf_counter()
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                metrics.observe('spool.fsync_seconds', time.perf_counter() - start)
+            self.synced = target
+
+    def close(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+
+_lock = threading.Lock()
+
+
+def get_spool(app):
+    """
+    The app's Spool, None unless LIS_SPOOL_DIR is set
+    """
+    if(not app.config['LIS_SPOOL_DIR']):
+        return None
+    with _lock:
+        spool = app.extensions.get('astm_spool')
+        if(spool is None):
+            spool = Spool(
+                app.config['LIS_SPOOL_DIR'],
+                segment_bytes=app.config['LIS_SPOOL_SEGMENT_BYTES'],
+                fsync=app.config['LIS_SPOOL_FSYNC'],
+            )
+            app.extensions['astm_spool'] = spool
+        return spool
+
+
+class SpoolIngester(object):
+    """
+    Loads spooled datagrams into the database, `batch_size` per
+    transaction, then enqueues their uploads. Delivery is at least once: a
+    crash between the commit and the checkpoint loads that batch again.
+    Entries the database rejects are dead-lettered, not retried.
+    Only one ingester per spool directory (flock on INGEST_LOCK).
+    """
+    def __init__(self, app, directory=None):
+        self.app = app
+        self.directory = directory or app.config['LIS_SPOOL_DIR']
+        self.batch_size = app.config['LIS_SPOOL_BATCH_SIZE']
+        self.interval = app.config['LIS_SPOOL_INTERVAL']
+        self.lock_file = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def acquire(self):
+        """
+        Take the ingest lock, False if another process holds it
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self.lock_file = open(os.path.join(self.directory, INGEST_LOCK), 'w')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock_file.close()
+            self.lock_file = None
+            return False
+        return True
+
+    def release(self):
+        if(self.lock_file is not None):
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+
+    def start(self):
+        if(not self.acquire()):
+            logger.error(f"{self.directory}: spool is ingested by another process")
+            return False
+        self.thread = threading.Thread(
+            target=self.run, name='spool-ingest', daemon=True
+        )
+        self.thread.start()
+        return True
+
+    def stop(self, timeout=None):
+        self.stopped.set()
+        if(self.thread is not None):
+            self.thread.join(timeout)
+            self.thread = None
+        self.release()
+
+    def run(self):
+        failures = 0
+        while not self.stopped.is_set():
+            try:
+                count = self.ingest()
+            except Exception:
+                ## DO NOT BREAK!!!
+                failures += 1
+                metrics.incr('spool.ingest_error')
+                logger.exception("Spool ingest failure, will retry")
+                self.stopped.wait(min(60, self.interval * 2 ** failures))
+                continue
+            failures = 0
+            if(count < self.batch_size):
+                self.stopped.wait(self.interval)
+
+    def pending(self, limit):
+        """
+        Up to `limit` entries past the checkpoint -> ([(checkpoint after
+        it, entry), ...], checkpoint after them all)
+        """
+        segment, offset = load_checkpoint(self.directory)
+        segments = [s for s in list_segments(self.directory) if s[0] >= segment]
+        entries = []
+        position = (segment, offset)
+        for i, (number, path) in enumerate(segments):
+            if(number != position[0]):
+                position = (number, 0)
+            for end, entry in read_segment(
+                path, position[1], limit - len(entries)
+            ):
+                position = (number, end)
+                entries.append((position, entry))
+            if(len(entries) >= limit or i == len(segments) - 1):
+                break
+            # listed before it was read, so a later segment existed and
+            # this one was complete: move past it
+            position = (segments[i + 1][0], 0)
+        return entries, position
+
+    def ingest(self):
+        """
+        Apply one batch, returns how many entries it held. When the
+        database rejects the batch its entries are loaded one at a time,
+        the rejected ones dead-lettered.
+        """
+        pending, position = self.pending(self.batch_size)
+        entries = [entry for _, entry in pending]
+        error = None
+        for entry in entries:
+            if(entry['upload']):
+                # due for the retry service only if the upload enqueued
+                # below never reports back, however late the ingest runs
+                entry['datagram']['next_attempt_at'] = first_attempt_at(
+                    self.app.config
+                )
+                # spooled before lis_datagram.upload_destination
+                entry['datagram']['upload_destination'] = entry['upload'][1]
+        if(entries):
+            with self.app.app_context():
+                try:
+                    dgids = self.insert(entries)
+                except Exception as e:
+                    if(not is_rejected(e)):
+                        raise
+                    metrics.incr('spool.batch_rejected')
+                    logger.warning(
+                        f"Spool batch rejected ({e!r}), loading its "
+                        f"{len(entries)} entries one at a time"
+                    )
+                    dgids, error = self.insert_each(entries)
+            if(len(dgids) < len(entries)):
+                # the database went away meanwhile, keep what went in
+                entries = entries[:len(dgids)]
+                position = (
+                    pending[len(dgids) - 1][0] if dgids
+                    else load_checkpoint(self.directory)
+                )
+        if(position != load_checkpoint(self.directory)):
+            save_checkpoint(self.directory, *position)
+            self.prune(position[0])
+        if(entries):
+            metrics.incr('spool.ingested', len(entries))
+            self.enqueue(entries, dgids)
+        if(error is not None):
+            raise error
+        return len(entries)
+
+    def insert(self, entries):
+        start = time.perf_counter()
+        try:
+            dgids = LISDatagram.insert_datagrams(
+                db.session.connection(),
+                [(entry['datagram'], *entry_records(entry)) for entry in entries]
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+        metrics.observe('spool.ingest_seconds', time.perf_counter() - start)
+        logger.info(f"+LISDatagram(ids={dgids}) from spool")
+        return dgids
+
+    def insert_each(self, entries):
+        """
+        insert() one entry per transaction -> (dgids, None for a rejected
+        entry; the error that stopped it early, if the database failed)
+        """
+        dgids = []
+        for entry in entries:
+            try:
+                dgids.extend(self.insert([entry]))
+            except Exception as e:
+                if(not is_rejected(e)):
+                    return dgids, e
+                self.dead_letter(entry, e)
+                dgids.append(None)
+        return dgids, None
+
+    def dead_letter(self, entry, error):
+        """
+        Append (fsynced) an entry the database rejects to DEAD_LETTER, with
+        the error, so the checkpoint can move past it
+        """
+        data = encode_entry(dict(
+            entry, error=repr(error), rejected_at=datetime.utcnow()
+        ))
+        with open(os.path.join(self.directory, DEAD_LETTER), 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        metrics.incr('spool.dead_letter')
+        logger.error(
+            f"Spool entry {entry['datagram'].get('natural_key')} rejected "
+            f"by the database, moved to {DEAD_LETTER}: {error!r}"
+        )
+
+    def enqueue(self, entries, dgids):
+        upload_queue = None
+        for entry, dgid in zip(entries, dgids):
+            # dgid None: a duplicate, already in the database
+            if(entry['upload'] and dgid is not None):
+                upload_queue = upload_queue or get_upload_queue(self.app)
+                upload_queue.submit(UploadJob(dgid, *entry['upload']))
+
+    def prune(self, segment):
+        """
+        Delete the segments before `segment`, they are all in the database
+        """
+        for number, path in list_segments(self.directory):
+            if(number >= segment):
+                break
+            os.remove(path)
+            logger.info(f"spool segment {path} ingested, removed")
+
+    def replay(self):
+        """
+        Ingest everything spooled so far (listener not running), returns
+        the number of entries
+        """
+        if(not self.acquire()):
+            raise RuntimeError(
+                f"{self.directory}: spool is ingested by another process"
+            )
+        try:
+            total = 0
+            while True:
+                count = self.ingest()
+                total += count
+                if(count < self.batch_size):
+                    return total
+        finally:
+            self.release()
+
+
+def spool_status(directory):
+    """
+    [(number, path, bytes, entries, pending entries), ...] and the
+    checkpoint
+    """
+    checkpoint = load_checkpoint(directory)
+    status = []
+    for number, path in list_segments(directory):
+        entries = [end for end, _ in read_segment(path)]
+        if(number < checkpoint[0]):
+            pending = 0
+        elif(number == checkpoint[0]):
+            pending = len([end for end in entries if end > checkpoint[1]])
+        else:
+            pending = len(entries)
+        status.append(
+            (number, path, os.path.getsize(path), len(entries), pending)
+        )
+    return status, checkpoint
+
+
+def show_spool(current_app, segment=None, dead_letter=False, out=None):
+    """
+    Print the segments of LIS_SPOOL_DIR, or the entries of one (or the
+    dead-lettered ones) as NDJSON
+    """
+    directory = current_app.config['LIS_SPOOL_DIR']
+    if(not directory or not os.path.isdir(directory)):
+        print(f"No spool directory (LIS_SPOOL_DIR='{directory}')", file=out)
+        return
+    if(segment is not None or dead_letter):
+        path = (
+            os.path.join(directory, DEAD_LETTER) if dead_letter
+            else segment_path(directory, segment)
+        )
+        if(not os.path.exists(path)):
+            return
+        for _, entry in read_segment(path):
+            print(json.dumps(entry, default=_default), file=out)
+        return
+    status, checkpoint = spool_status(directory)
+    print(f"checkpoint: segment {checkpoint[0]} offset {checkpoint[1]}", file=out)
+    for number, path, size, entries, pending in status:
+        print(
+            f"{number:>8} {size:>12} bytes {entries:>8} entries "
+            f"{pending:>8} pending  {path}",
+            file=out,
+        )
+    path = os.path.join(directory, DEAD_LETTER)
+    if(os.path.exists(path)):
+        rejected = len([end for end, _ in read_segment(path)])
+        print(f"dead letter: {rejected} entries  {path}", file=out)
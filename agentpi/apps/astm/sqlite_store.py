@@ -0,0 +1,436 @@
+"""Local SQLite store, results are kept on the node first and pushed to the
+central database in the background.
+
+The lis_* tables are mirrored (same columns, local ids) in a WAL mode
+SQLite file; the dispatcher's write is a local commit, independent of the
+link to Postgres. SqliteSync copies datagrams past its high-water mark to
+Postgres in bulk batches and then enqueues their uploads. Datagrams
+Postgres rejects (SQLite doesn't enforce VARCHAR lengths) are quarantined
+and stay in the local file.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+
+from agentpi import db
+from .metrics import metrics
+from .models import (
+    LISDatagram, LISMessages, LISPatient, LISOrder, LISComment, LISResult,
+    is_rejected, record_row
+)
+from .retry import first_attempt_at
+from .spool import entry_records
+from .uploads import UploadJob, get_upload_queue
+
+
+logger = logging.getLogger(__name__)
+
+
+MODELS = (
+    LISDatagram, LISMessages, LISPatient, LISOrder, LISComment, LISResult
+)
+
+local = sa.MetaData()
+TABLES = {model: model.__table__.tometadata(local) for model in MODELS}
+
+# uploads to enqueue once a datagram is in Postgres
+UPLOADS = sa.Table(
+    'lis_sync_upload', local,
+    sa.Column('dgid', sa.Integer, primary_key=True),
+    sa.Column('payload', sa.JSON),
+    sa.Column('destination', sa.String(12)),
+    sa.Column('notify', sa.String(64)),
+)
+
+# name -> value, the sync high-water mark (last local dgid pushed)
+STATE = sa.Table(
+    'lis_sync_state', local,
+    sa.Column('name', sa.String(32), primary_key=True),
+    sa.Column('value', sa.Integer),
+)
+
+HIGH_WATER_MARK = 'high_water_mark'
+
+# datagrams Postgres rejected, skipped by the sync and never pruned
+QUARANTINE = sa.Table(
+    'lis_sync_quarantine', local,
+    sa.Column('dgid', sa.Integer, primary_key=True),
+    sa.Column('error', sa.Text),
+    sa.Column('created_at', sa.DateTime, default=datetime.utcnow),
+)
+
+
+def _pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    # WAL + NORMAL: durable across a crash of the process, only a power
+    # loss can take back the last commits
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA busy_timeout=5000')
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.close()
+
+
+def add_missing_columns(engine):
+    """
+    ALTER TABLE ADD COLUMN what the models gained since the file was made
+    (create_all only creates missing tables); the new columns are NULL on
+    the rows already there
+    """
+    inspector = sa.inspect(engine)
+    with engine.begin() as conn:
+        for table in local.sorted_tables:
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if(column.name in existing):
+                    continue
+                conn.execute(sa.text(
+                    f'ALTER TABLE {table.name} ADD COLUMN {column.name} '
+                    f'{column.type.compile(dialect=engine.dialect)}'
+                ))
+                logger.info(f"{engine.url}: added {table.name}.{column.name}")
+
+
+class SqliteStore(object):
+    """
+    The node's SQLite file, append() takes the same entries as Spool
+    """
+    def __init__(self, path):
+        self.path = path
+        self.engine = sa.create_engine(
+            f'sqlite:///{path}',
+            poolclass=sa.pool.QueuePool,
+            connect_args={'check_same_thread': False},
+        )
+        sa.event.listen(self.engine, 'connect', _pragmas)
+        local.create_all(self.engine)
+        add_missing_columns(self.engine)
+        # compiled once, append() is on the dispatcher's hot path
+        self.engine = self.engine.execution_options(compiled_cache={})
+        self.inserts = {model: TABLES[model].insert() for model in MODELS}
+        self.upload_insert = UPLOADS.insert()
+
+    def append(self, entry):
+        """
+        Commit one spool.datagram_entry locally, returns its local dgid or
+        None if its natural_key is already in the store
+        """
+        patient, order, comments, results = entry_records(entry)
+        start = time.perf_counter()
+        datagram = dict(entry['datagram'])
+        try:
+            dgid = self._append(entry, datagram, patient, order, comments, results)
+        except sa.exc.IntegrityError:
+            # only ux_lis_datagram_natural_key makes it a duplicate, any
+            # other constraint is a real error (the entry was rolled back)
+            if(not self.has_natural_key(datagram.get('natural_key'))):
+                raise
+            metrics.incr('dedup.conflicts')
+            logger.info(f"{datagram['natural_key']} already stored, duplicate dropped")
+            return None
+        metrics.observe('sqlite.append_seconds', time.perf_counter() - start)
+        metrics.incr('sqlite.appended')
+        return dgid
+
+    def has_natural_key(self, natural_key):
+        if(natural_key is None):
+            return False
+        table = TABLES[LISDatagram]
+        with self.engine.connect() as conn:
+            return conn.execute(
+                sa.select([table.c.dgid]).where(table.c.natural_key == natural_key)
+            ).first() is not None
+
+    def _append(self, entry, datagram, patient, order, comments, results):
+        insert = self.inserts
+        data = datagram.pop('messages', None)
+        with self.engine.begin() as conn:
+            dgid = conn.execute(
+                insert[LISDatagram], datagram
+            ).inserted_primary_key[0]
+            if(data is not None):
+                conn.execute(insert[LISMessages], dgid=dgid, data=data)
+            conn.execute(
+                insert[LISPatient], record_row(LISPatient, patient, dgid)
+            )
+            conn.execute(insert[LISOrder], record_row(LISOrder, order, dgid))
+            if(comments):
+                conn.execute(insert[LISComment], [
+                    record_row(LISComment, c, dgid) for c in comments
+                ])
+            if(results):
+                conn.execute(insert[LISResult], [
+                    record_row(LISResult, r, dgid) for r in results
+                ])
+            if(entry['upload']):
+                payload, destination, notify = entry['upload']
+                conn.execute(
+                    self.upload_insert,
+                    dgid=dgid,
+                    payload=payload,
+                    destination=destination,
+                    notify=notify,
+                )
+        return dgid
+
+    def high_water_mark(self, conn):
+        value = conn.execute(
+            sa.select([STATE.c.value]).where(STATE.c.name == HIGH_WATER_MARK)
+        ).scalar()
+        return value or 0
+
+    def pending(self, limit):
+        """
+        Up to `limit` datagrams past the high-water mark ->
+        [(local dgid, (datagram, patient, order, comments, results),
+        upload row or None), ...]
+        """
+        datagrams = TABLES[LISDatagram]
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                datagrams.select()
+                .where(datagrams.c.dgid > self.high_water_mark(conn))
+                .order_by(datagrams.c.dgid)
+                .limit(limit)
+            ).fetchall()
+            if(not rows):
+                return []
+            dgids = [row.dgid for row in rows]
+            children = {}
+            for model in MODELS[1:]:
+                table = TABLES[model]
+                by_dgid = children[model] = {}
+                for child in conn.execute(
+                    table.select()
+                    .where(table.c.dgid.in_(dgids))
+                    .order_by(list(table.primary_key.columns)[0])
+                ):
+                    by_dgid.setdefault(child.dgid, []).append(child)
+            uploads = {
+                upload.dgid: upload for upload in conn.execute(
+                    UPLOADS.select().where(UPLOADS.c.dgid.in_(dgids))
+                )
+            }
+        columns = [c.name for c in datagrams.columns if not c.primary_key]
+        messages = {
+            dgid: raw[0].data for dgid, raw in children[LISMessages].items()
+        }
+        return [(
+            row.dgid,
+            (
+                dict(
+                    {name: row[name] for name in columns},
+                    messages=messages.get(row.dgid),
+                ),
+                (children[LISPatient].get(row.dgid) or [None])[0],
+                (children[LISOrder].get(row.dgid) or [None])[0],
+                children[LISComment].get(row.dgid, []),
+                children[LISResult].get(row.dgid, []),
+            ),
+            uploads.get(row.dgid),
+        ) for row in rows]
+
+    def mark_synced(self, dgid, keep_days=None):
+        """
+        Move the high-water mark to `dgid` and drop what was synced more
+        than `keep_days` ago (the newest row always stays, so SQLite never
+        hands out its id again)
+        """
+        with self.engine.begin() as conn:
+            updated = conn.execute(
+                STATE.update()
+                .where(STATE.c.name == HIGH_WATER_MARK)
+                .values(value=dgid)
+            ).rowcount
+            if(not updated):
+                conn.execute(STATE.insert(), name=HIGH_WATER_MARK, value=dgid)
+            if(keep_days is None):
+                return
+            datagrams = TABLES[LISDatagram]
+            old = sa.select([datagrams.c.dgid]).where(sa.and_(
+                datagrams.c.dgid <= dgid,
+                datagrams.c.dgid.notin_(sa.select([QUARANTINE.c.dgid])),
+                datagrams.c.dgid < sa.select(
+                    [sa.func.max(datagrams.c.dgid)]
+                ).as_scalar(),
+                datagrams.c.created_at < (
+                    datetime.utcnow() - timedelta(days=keep_days)
+                ),
+            ))
+            for table in [UPLOADS] + [TABLES[m] for m in reversed(MODELS)]:
+                conn.execute(table.delete().where(table.c.dgid.in_(old)))
+
+    def quarantine(self, dgid, error):
+        """
+        Set local datagram `dgid` aside (kept, with the error) so the sync
+        can move past it
+        """
+        with self.engine.begin() as conn:
+            conn.execute(
+                QUARANTINE.delete().where(QUARANTINE.c.dgid == dgid)
+            )
+            conn.execute(QUARANTINE.insert(), dgid=dgid, error=repr(error))
+
+    def backlog(self):
+        datagrams = TABLES[LISDatagram]
+        with self.engine.connect() as conn:
+            return conn.execute(
+                sa.select([sa.func.count()])
+                .where(datagrams.c.dgid > self.high_water_mark(conn))
+            ).scalar()
+
+
+_lock = threading.Lock()
+
+
+def get_sqlite_store(app):
+    """
+    The app's SqliteStore, None unless LIS_SQLITE_STORE is set
+    """
+    if(not app.config['LIS_SQLITE_STORE']):
+        return None
+    with _lock:
+        store = app.extensions.get('astm_sqlite_store')
+        if(store is None):
+            store = SqliteStore(app.config['LIS_SQLITE_STORE'])
+            app.extensions['astm_sqlite_store'] = store
+        return store
+
+
+class SqliteSync(object):
+    """
+    Pushes the local store to Postgres, LIS_SQLITE_SYNC_BATCH datagrams
+    per transaction (executemany per table, LISDatagram.insert_datagrams).
+    At least once: a crash between the Postgres commit and the high-water
+    mark update pushes that batch again. When Postgres rejects a batch its
+    datagrams are pushed one at a time and the rejected ones quarantined.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.store = get_sqlite_store(app)
+        self.batch_size = app.config['LIS_SQLITE_SYNC_BATCH']
+        self.interval = app.config['LIS_SQLITE_SYNC_INTERVAL']
+        self.keep_days = app.config['LIS_SQLITE_KEEP_DAYS']
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name='sqlite-sync', daemon=True
+        )
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        self.stopped.set()
+        if(self.thread is not None):
+            self.thread.join(timeout)
+            self.thread = None
+
+    def run(self):
+        failures = 0
+        while not self.stopped.is_set():
+            try:
+                count = self.sync()
+            except Exception:
+                ## DO NOT BREAK!!!
+                failures += 1
+                metrics.incr('sqlite.sync_error')
+                logger.exception("SQLite sync failure, will retry")
+                self.stopped.wait(min(60, self.interval * 2 ** failures))
+                continue
+            failures = 0
+            if(count < self.batch_size):
+                self.stopped.wait(self.interval)
+
+    def sync(self):
+        """
+        Push one batch, returns how many datagrams it held
+        """
+        pending = self.store.pending(self.batch_size)
+        if(not pending):
+            metrics.gauge('sqlite.backlog', 0)
+            return 0
+        for _, datagram, upload in pending:
+            if(upload is not None):
+                # due for the retry service only if the upload enqueued
+                # below never reports back, however late the sync runs
+                datagram[0]['next_attempt_at'] = first_attempt_at(
+                    self.app.config
+                )
+                datagram[0]['upload_destination'] = upload.destination
+        start = time.perf_counter()
+        error = None
+        with self.app.app_context():
+            try:
+                dgids = self.push([datagram for _, datagram, _ in pending])
+            except Exception as e:
+                if(not is_rejected(e)):
+                    raise
+                metrics.incr('sqlite.batch_rejected')
+                logger.warning(
+                    f"SQLite sync batch rejected ({e!r}), pushing its "
+                    f"{len(pending)} datagrams one at a time"
+                )
+                dgids, error = self.push_each(pending)
+        # the database went away meanwhile, keep what went in
+        pending = pending[:len(dgids)]
+        metrics.observe('sqlite.sync_seconds', time.perf_counter() - start)
+        if(pending):
+            metrics.incr('sqlite.synced', len(pending))
+            logger.info(f"+LISDatagram(ids={dgids}) from the local store")
+            self.store.mark_synced(pending[-1][0], self.keep_days)
+        metrics.gauge('sqlite.backlog', self.store.backlog())
+        upload_queue = None
+        for (_, _, upload), dgid in zip(pending, dgids):
+            # dgid None: a duplicate, already in Postgres (and uploaded),
+            # or quarantined
+            if(upload is not None and dgid is not None):
+                upload_queue = upload_queue or get_upload_queue(self.app)
+                upload_queue.submit(UploadJob(
+                    dgid, upload.payload, upload.destination, upload.notify
+                ))
+        if(error is not None):
+            raise error
+        return len(pending)
+
+    def push(self, datagrams):
+        """
+        insert_datagrams in one Postgres transaction, returns the dgids
+        """
+        try:
+            dgids = LISDatagram.insert_datagrams(
+                db.session.connection(), datagrams
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+        return dgids
+
+    def push_each(self, pending):
+        """
+        push() one datagram per transaction -> (dgids, None for a
+        quarantined one; the error that stopped it early, if the database
+        failed)
+        """
+        dgids = []
+        for local_dgid, datagram, _ in pending:
+            try:
+                dgids.extend(self.push([datagram]))
+            except Exception as e:
+                if(not is_rejected(e)):
+                    return dgids, e
+                self.store.quarantine(local_dgid, e)
+                metrics.incr('sqlite.quarantined')
+                logger.error(
+                    f"Local datagram {local_dgid} "
+                    f"({datagram[0].get('natural_key')}) rejected by the "
+                    f"database, quarantined: {e!r}"
+                )
+                dgids.append(None)
+        return dgids, None
@@ -0,0 +1,61 @@
+"""ASTM (LIS2-A2) date/time fields: YYYYMMDD[HHMM[SS]][+HHMM].
+
+Parsing slices the fixed-width digits instead of going through strptime
+(slow, and it takes a global lock) and remembers recent values, a session
+repeats the same few timestamps.
+"""
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+
+FORMAT = '%Y%m%d%H%M%S'
+
+CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_timestamp(value):
+    """
+    '20200727154712' -> naive datetime. A value with an offset ('+0100')
+    is converted to UTC, so it fits the naive DateTime columns and the
+    natural_key like any other. Raises ValueError on anything else.
+    """
+    offset = None
+    if(len(value) > 5 and value[-5] in '+-'):
+        value, offset = value[:-5], value[-5:]
+    size = len(value)
+    if(size not in (8, 12, 14) or not (value.isascii() and value.isdigit())):
+        raise ValueError(f"Not an ASTM date/time: '{value}'")
+    tzinfo = None
+    if(offset is not None):
+        if(not (offset[1:].isascii() and offset[1:].isdigit())):
+            raise ValueError(f"Not an ASTM time zone: '{offset}'")
+        delta = timedelta(hours=int(offset[1:3]), minutes=int(offset[3:5]))
+        tzinfo = timezone(-delta if offset[0] == '-' else delta)
+    parsed = datetime(
+        int(value[0:4]),
+        int(value[4:6]),
+        int(value[6:8]),
+        int(value[8:10]) if size > 8 else 0,
+        int(value[10:12]) if size > 8 else 0,
+        int(value[12:14]) if size > 12 else 0,
+        tzinfo=tzinfo,
+    )
+    if(tzinfo is not None):
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def format_timestamp(value, tzinfo=None):
+    """
+    datetime -> 'YYYYMMDDHHMMSS' ('' for None or ''), aware values are
+    converted to `tzinfo` first when given
+    """
+    if(not value):
+        return ''
+    if(tzinfo is not None and value.tzinfo is not None):
+        value = value.astimezone(tzinfo)
+    return '%04d%02d%02d%02d%02d%02d' % (
+        value.year, value.month, value.day,
+        value.hour, value.minute, value.second,
+    )
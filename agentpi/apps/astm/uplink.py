@@ -0,0 +1,304 @@
+import gzip
+import logging
+import json
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .breaker import STATES, AdaptiveTimeout, CircuitBreaker
+from .metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+# destination name -> (url config key, api key config key)
+UPLINKS = {
+    'sars': ('SARS_UPLINK_API_URL', 'SARS_UPLINK_API_KEY'),
+    'test': ('TEST_UPLINK_API_URL', 'TEST_UPLINK_API_KEY'),
+    'audit': ('AUDIT_UPLINK_API_URL', 'AUDIT_UPLINK_API_KEY'),
+    'slack': ('SLACK_WEBHOOK', None),
+}
+
+BATCH_HEADERS = {'Content-Encoding': 'gzip'}
+
+BATCH_COMPRESSION = 6
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """
+    Not sent, the destination's circuit breaker is open
+    """
+
+
+class UplinkClient(object):
+    """
+    Keep-alive HTTP session with a bounded pool for a single destination,
+    behind a circuit breaker and a read timeout adapted to its latency
+    """
+    def __init__(self, url, key=None, pool_maxsize=4, connect_timeout=3.05,
+                 read_timeout=10, retries=2, backoff=0.3, breaker=None,
+                 adaptive_timeout=None):
+        self.url = url
+        self.connect_timeout = connect_timeout
+        self.breaker = breaker or CircuitBreaker(url, threshold=0)
+        self.read_timeout = adaptive_timeout or AdaptiveTimeout(
+            read_timeout, factor=0
+        )
+        # Only retry when the request surely never reached the app (connect
+        # errors) -- a read retry, or one on a gateway 502/504 that may come
+        # back after the app applied the POST, could double post. Those are
+        # left to the retry service.
+        retry_args = dict(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=0,
+            backoff_factor=backoff,
+            raise_on_status=False,
+        )
+        try:
+            retry = Retry(allowed_methods=frozenset(['POST']), **retry_args)
+        except TypeError:
+            # urllib3 < 1.26
+            retry = Retry(method_whitelist=frozenset(['POST']), **retry_args)
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_maxsize,
+            pool_block=True,
+            max_retries=retry,
+        )
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Content-Type'] = 'application/json'
+        if(key is not None):
+            self.session.headers['x-api-key'] = key
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout.value)
+
+    def post(self, data, **kwargs):
+        """
+        session.post() through the breaker: raises CircuitOpenError without
+        touching the network while it is open, a connection error, timeout
+        or 5xx counts as a failure
+        """
+        if(not self.breaker.allow()):
+            raise CircuitOpenError(f"circuit open: {self.url}")
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.perf_counter()
+        try:
+            res = self.session.post(self.url, data=data, **kwargs)
+        except Exception:
+            self.breaker.failure()
+            raise
+        if(res.status_code >= 500):
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+            self.read_timeout.add(time.perf_counter() - start)
+        return res
+
+    def close(self):
+        self.session.close()
+
+
+_lock = threading.Lock()
+
+
+def circuit_alert(app, name):
+    """
+    on_change hook of `name`'s breaker: metrics, and one slack notice per
+    state change (through the notifier, never on the caller's thread)
+    """
+    def on_change(old, new, breaker):
+        metrics.gauge(f'uplink.{name}.circuit', STATES[new])
+        metrics.incr(f'uplink.{name}.circuit_{new}')
+        if(name == 'slack'):
+            return
+        from .notifier import get_notifier
+        get_notifier(app).notify(
+            f"@channel uplink '{name}' circuit {new}" + (
+                f" after {breaker.failures} failures, results go to "
+                f"the retry backlog" if new == 'open' else ''
+            )
+        )
+    return on_change
+
+
+def get_uplink(app, name):
+    """
+    Return the app's shared UplinkClient for destination `name`
+    """
+    with _lock:
+        uplinks = app.extensions.setdefault('astm_uplinks', {})
+        client = uplinks.get(name)
+        if(client is None):
+            url_key, api_key = UPLINKS[name]
+            client = UplinkClient(
+                app.config[url_key],
+                app.config[api_key] if api_key else None,
+                pool_maxsize=app.config['UPLINK_POOL_MAXSIZE'],
+                connect_timeout=app.config['UPLINK_CONNECT_TIMEOUT'],
+                read_timeout=app.config['UPLINK_READ_TIMEOUT'],
+                retries=app.config['UPLINK_RETRY_TOTAL'],
+                backoff=app.config['UPLINK_RETRY_BACKOFF'],
+                breaker=CircuitBreaker(
+                    name,
+                    threshold=app.config['UPLINK_BREAKER_THRESHOLD'],
+                    reset_timeout=app.config['UPLINK_BREAKER_RESET'],
+                    on_change=circuit_alert(app, name),
+                ),
+                adaptive_timeout=AdaptiveTimeout(
+                    app.config['UPLINK_READ_TIMEOUT'],
+                    minimum=app.config['UPLINK_TIMEOUT_MIN'],
+                    factor=app.config['UPLINK_TIMEOUT_FACTOR'],
+                ),
+            )
+            uplinks[name] = client
+        return client
+
+
+def send_payload(payload, client):
+    """
+    Send our data upstream, returns (is_uploaded, is_error, failure) where
+    failure names the class of error ('connection', 'timeout', 'http_503'...)
+    """
+    is_uploaded = False
+    is_error = False
+    failure = None
+    url = client.url
+    try:
+        res = client.post(json.dumps(payload))
+        res.raise_for_status()
+    except CircuitOpenError:
+        # straight to the retry backlog, the state change was alerted
+        logger.info(f"Circuit open, patient_id: '{payload['vialId']}' not sent")
+        is_error = True
+        failure = 'circuit_open'
+    except requests.exceptions.HTTPError as e:
+        logger.error(repr(e))
+        logger.error(f"url: '{url}'")
+        logger.error(f"HTTP error with patient_id: '{payload['vialId']}'")
+        is_error = True
+        failure = f"http_{e.response.status_code}" if (
+            e.response is not None
+        ) else 'http'
+    except requests.exceptions.ConnectionError as e:
+        logger.error(repr(e))
+        logger.error(f"url: '{url}'")
+        logger.error(f"Connection error with patient_id: '{payload['vialId']}'")
+        is_error = True
+        failure = 'connection'
+    except requests.exceptions.Timeout as e:
+        logger.error(repr(e))
+        logger.error(f"url: '{url}'")
+        logger.error(f"Timeout with patient_id '{payload['vialId']}'")
+        is_error = True
+        failure = 'timeout'
+    except (requests.exceptions.RequestException, Exception) as e:
+        logger.error(repr(e))
+        logger.error(f"url: '{url}'")
+        logger.error(f"Unknown error with patient_id '{payload['vialId']}'")
+        is_error = True
+        failure = type(e).__name__
+    else:
+        if(res.status_code == 200):
+            # Successfully uploaded data
+            is_uploaded = True
+        else:
+            # This should be impossible
+            logger.error(f"HTTP ERROR '{res.status_code}': : {payload['vialId']}")
+            is_error = True
+            failure = f"http_{res.status_code}"
+    return is_uploaded, is_error, failure
+
+
+def send_batch(payloads, client):
+    """
+    Send `payloads` upstream as one gzipped JSON array, returns an
+    (is_uploaded, is_error, failure) per payload, in order. The uplink
+    answers 200 with a JSON array of per-item HTTP statuses; any other
+    answer fails the whole batch.
+    """
+    url = client.url
+    body = gzip.compress(
+        json.dumps(payloads).encode('utf-8'), BATCH_COMPRESSION
+    )
+    try:
+        res = client.post(body, headers=BATCH_HEADERS)
+        res.raise_for_status()
+        if(res.status_code != 200):
+            # This should be impossible
+            failure = f"http_{res.status_code}"
+        else:
+            acks = res.json()
+            if(not isinstance(acks, list) or len(acks) != len(payloads)):
+                raise ValueError(f"expected {len(payloads)} acks, got {acks!r}")
+            return [
+                (True, False, None) if ack == 200 else (False, True, f"http_{ack}")
+                for ack in acks
+            ]
+    except CircuitOpenError:
+        logger.info(f"Circuit open, batch of {len(payloads)} not sent")
+        return [(False, True, 'circuit_open')] * len(payloads)
+    except requests.exceptions.HTTPError as e:
+        logger.error(repr(e))
+        failure = f"http_{e.response.status_code}" if (
+            e.response is not None
+        ) else 'http'
+    except requests.exceptions.ConnectionError as e:
+        logger.error(repr(e))
+        failure = 'connection'
+    except requests.exceptions.Timeout as e:
+        logger.error(repr(e))
+        failure = 'timeout'
+    except (ValueError, TypeError) as e:
+        # not one ack per item, which ones arrived is unknown
+        logger.error(repr(e))
+        failure = 'batch_ack'
+    except (requests.exceptions.RequestException, Exception) as e:
+        logger.error(repr(e))
+        failure = type(e).__name__
+    logger.error(f"url: '{url}'")
+    logger.error(
+        f"Batch of {len(payloads)} failed ({failure}), patient_ids: "
+        f"{[payload['vialId'] for payload in payloads]}"
+    )
+    return [(False, True, failure)] * len(payloads)
+
+
+def slack_message(app, message):
+    """
+    Push a notice to slack, returns whether it was sent
+    """
+    hostname = app.config['HOSTNAME']
+    slack_webhook = app.config['SLACK_WEBHOOK']
+    slack_webhook_enabled = app.config['SLACK_CHANNEL_ENABLED']
+    if(slack_webhook and slack_webhook_enabled):
+        payload = {
+            'text': f'{hostname}: {message}'
+        }
+        try:
+            r = get_uplink(app, 'slack').post(
+                json.dumps(payload).encode('utf-8')
+            )
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to send slack notfication! {e!r}")
+            return False
+        if(r.status_code != requests.codes.ok):
+            logger.error(f"Failed to send slack notfication! {r.status_code}")
+            try:
+                r.raise_for_status()
+            except Exception as e:
+                logger.error(str(e))
+            return False
+        return True
+    elif(slack_webhook_enabled):
+        logger.warning("Slack hook empty!")
+    return False
@@ -0,0 +1,369 @@
+"""Outbound upload queue, drained away from the LIS listener loop.
+
+Each result goes to its routed destination (the primary, whose outcome
+drives the LISDatagram flags and the retry service) and is fanned out to
+the UPLOAD_FANOUT sinks. Every destination has its own lane: queue,
+workers and LISDelivery rows, so a slow sink only backs up itself. Slack
+notices go to the notifier.
+"""
+import json
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+
+from werkzeug.utils import import_string
+
+from .archive import archive_payload, get_archive
+from .metrics import metrics
+from .notifier import get_notifier
+from .retry import next_attempt_after
+from .uplink import UPLINKS, get_uplink, send_batch, send_payload
+
+
+logger = logging.getLogger(__name__)
+
+
+UploadJob = namedtuple(
+    'UploadJob', ['dgid', 'payload', 'destination', 'notify', 'primary'],
+    defaults=(True, )
+)
+
+# destinations that are not HTTP uplinks
+LOCAL_SINKS = ('archive', )
+
+# slack is the notifier's
+DESTINATIONS = tuple(name for name in UPLINKS if name != 'slack') + LOCAL_SINKS
+
+
+def destination_list(value):
+    """
+    'sars, test' -> ['sars', 'test']
+    """
+    return [name.strip() for name in (value or '').split(',') if name.strip()]
+
+
+def fanout_destinations(config):
+    """
+    UPLOAD_FANOUT, checked against DESTINATIONS
+    """
+    destinations = destination_list(config['UPLOAD_FANOUT'])
+    for destination in destinations:
+        if(destination not in DESTINATIONS):
+            raise ValueError(f"UPLOAD_FANOUT: unknown destination '{destination}'")
+    return destinations
+
+
+class BaseUploadQueue(object):
+    """
+    The dispatcher only `submit`s jobs; subclasses decide where `deliver`
+    runs.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.fanout = fanout_destinations(app.config)
+
+    def start(self):
+        pass
+
+    def stop(self, timeout=None):
+        pass
+
+    def depth(self):
+        return 0
+
+    def submit(self, job):
+        """
+        put() a result's job and its copies for the UPLOAD_FANOUT sinks.
+        Returns whether the job itself was queued.
+        """
+        queued = self.put(job)
+        for destination in self.fanout:
+            if(destination != job.destination):
+                self.put(UploadJob(
+                    job.dgid, job.payload, destination, None, False
+                ))
+        return queued
+
+    def put(self, job):
+        """
+        Accept a job, returns False if it could not be queued
+        """
+        raise NotImplementedError
+
+    def send(self, job):
+        """
+        Deliver one job to its destination -> (is_uploaded, is_error, failure)
+        """
+        if(job.destination == 'archive'):
+            archive = get_archive(self.app)
+            if(archive is None):
+                return False, True, 'unconfigured'
+            return archive_payload(archive, job.dgid, job.payload)
+        return send_payload(job.payload, get_uplink(self.app, job.destination))
+
+    def deliver(self, job):
+        """
+        Deliver one job and record the outcome; a failed primary upload is
+        handed to the retry service
+        """
+        start = time.perf_counter()
+        outcome = self.send(job)
+        metrics.observe(
+            f'upload.{job.destination}.send_seconds', time.perf_counter() - start
+        )
+        self.record([job], [outcome])
+
+    def deliver_batch(self, jobs):
+        """
+        deliver() for several jobs of one uplink, in a single request
+        """
+        start = time.perf_counter()
+        destination = jobs[0].destination
+        outcomes = send_batch(
+            [job.payload for job in jobs], get_uplink(self.app, destination)
+        )
+        metrics.observe(
+            f'upload.{destination}.send_seconds', time.perf_counter() - start
+        )
+        metrics.observe('upload.batch_size', len(jobs))
+        self.record(jobs, outcomes)
+
+    def record(self, jobs, outcomes):
+        """
+        Write each job's (is_uploaded, is_error, failure) to LISDelivery
+        and, for primary jobs, back to its LISDatagram; job.notify goes to
+        the notifier once the primary upload went through
+        """
+        from .models import LISDatagram
+        flags = {}
+        deliveries = []
+        errors = 0
+        for job, (is_uploaded, is_error, failure) in zip(jobs, outcomes):
+            metrics.incr(
+                f'upload.{job.destination}.ok' if is_uploaded else
+                f'upload.{job.destination}.error'
+            )
+            if(job.dgid is not None):
+                deliveries.append((
+                    job.dgid, job.destination,
+                    None if is_uploaded else (failure or 'error'),
+                ))
+            if(not job.primary):
+                continue
+            metrics.incr('upload.ok' if is_uploaded else 'upload.error')
+            if(is_uploaded and job.notify):
+                get_notifier(self.app).notify(job.notify)
+            # an open circuit was alerted once, when it opened
+            errors += is_error and failure != 'circuit_open'
+            if(job.dgid is not None):
+                flags[job.dgid] = dict(
+                    is_uploaded=is_uploaded,
+                    is_error=is_error,
+                    upload_attempts=1,
+                    next_attempt_at=next_attempt_after(self.app.config, 1) if (
+                        is_error
+                    ) else None,
+                )
+        if(deliveries and not self.app.config['DISABLE_DATABASE']):
+            with self.app.app_context():
+                LISDatagram.update_flags_many_without_fail(flags, deliveries)
+        for _ in range(errors):
+            get_notifier(self.app).notify(
+                "@channel ERROR Detected!", key='upload_error'
+            )
+
+
+class InlineUploadQueue(BaseUploadQueue):
+    """
+    Deliver on the caller's thread (the old blocking behaviour, never
+    batched)
+    """
+    def put(self, job):
+        self.deliver(job)
+        return True
+
+
+class UploadLane(object):
+    """
+    One destination's bounded queue and worker threads. A batching lane
+    (UPLINK_BATCH_DESTINATIONS) delivers UPLINK_BATCH_SIZE jobs at a time,
+    or whatever arrived within UPLINK_BATCH_WAIT_MS of the first.
+    """
+    def __init__(self, upload_queue, destination, workers, batch_size=1,
+                 wait=0.0):
+        self.upload_queue = upload_queue
+        self.destination = destination
+        self.workers = workers
+        self.size = batch_size
+        self.wait = wait
+        self.queue = queue.Queue(
+            maxsize=upload_queue.app.config['UPLOAD_QUEUE_MAXSIZE']
+        )
+        self.threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self.run, name=f'upload-{self.destination}-{i}',
+                daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=None):
+        """
+        Let the workers drain the queue and exit, `timeout` seconds at most
+        in all: a lane kept full by a down uplink isn't waited on forever
+        (its primary jobs are left to the retry service)
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining():
+            if(deadline is None):
+                return None
+            return max(0.0, deadline - time.monotonic())
+
+        for _ in self.threads:
+            try:
+                self.queue.put(None, timeout=remaining())
+            except queue.Full:
+                logger.warning(
+                    f"Upload queue '{self.destination}' still full on stop, "
+                    f"{self.depth()} jobs not delivered"
+                )
+                break
+        for thread in self.threads:
+            thread.join(remaining())
+        self.threads = []
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def next_batch(self):
+        """
+        Block for a job, then gather more until the batch is full or the
+        wait is over -> (jobs, stopping)
+        """
+        job = self.queue.get()
+        if(job is None):
+            return [], True
+        jobs = [job]
+        deadline = time.monotonic() + self.wait
+        while len(jobs) < self.size:
+            remaining = deadline - time.monotonic()
+            if(remaining <= 0):
+                break
+            try:
+                job = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if(job is None):
+                return jobs, True
+            jobs.append(job)
+        return jobs, False
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            jobs, stopping = self.next_batch()
+            try:
+                if(len(jobs) > 1):
+                    self.upload_queue.deliver_batch(jobs)
+                elif(jobs):
+                    self.upload_queue.deliver(jobs[0])
+            except Exception:
+                ## DO NOT BREAK!!!
+                logger.exception(f"Upload worker failure ({self.destination})")
+
+
+class ThreadedUploadQueue(BaseUploadQueue):
+    """
+    An UploadLane per destination, UPLOAD_DESTINATION_WORKERS threads each
+    (when not listed UPLOAD_QUEUE_WORKERS, or 1 for a batching lane)
+    """
+    def __init__(self, app):
+        super().__init__(app)
+        config = app.config
+        self.put_timeout = config['UPLOAD_QUEUE_PUT_TIMEOUT']
+        workers = json.loads(config['UPLOAD_DESTINATION_WORKERS'] or '{}')
+        batching = set(destination_list(config['UPLINK_BATCH_DESTINATIONS']))
+        self.lanes = {}
+        for destination in DESTINATIONS:
+            batch = destination in batching and destination not in LOCAL_SINKS
+            # one worker fills a batch before the next is started
+            self.lanes[destination] = UploadLane(
+                self,
+                destination,
+                workers.get(
+                    destination, 1 if batch else config['UPLOAD_QUEUE_WORKERS']
+                ),
+                batch_size=config['UPLINK_BATCH_SIZE'] if batch else 1,
+                wait=config['UPLINK_BATCH_WAIT_MS'] / 1000 if batch else 0.0,
+            )
+
+    def start(self):
+        for lane in self.lanes.values():
+            lane.start()
+
+    def stop(self, timeout=None):
+        for lane in self.lanes.values():
+            lane.stop(timeout)
+
+    def depth(self):
+        return sum(lane.depth() for lane in self.lanes.values())
+
+    def put(self, job):
+        lane = self.lanes.get(job.destination)
+        if(lane is None):
+            metrics.incr('upload.unknown_destination')
+            logger.error(
+                f"No upload lane for '{job.destination}', patient_id: "
+                f"'{job.payload.get('vialId')}' "
+                + ("left for retry" if job.primary else "not delivered")
+            )
+            return False
+        start = time.perf_counter()
+        try:
+            lane.queue.put(job, timeout=self.put_timeout)
+        except queue.Full:
+            metrics.incr('upload.queue_full')
+            metrics.incr(f'upload.{job.destination}.queue_full')
+            logger.error(
+                f"Upload queue '{job.destination}' full ({lane.queue.maxsize}), "
+                f"patient_id: '{job.payload.get('vialId')}' "
+                + ("left for retry" if job.primary else "not delivered")
+            )
+            return False
+        finally:
+            metrics.observe('upload.enqueue_seconds', time.perf_counter() - start)
+        metrics.gauge(f'upload.{job.destination}.queue_depth', lane.depth())
+        metrics.gauge('upload.queue_depth', self.depth())
+        return True
+
+
+UPLOAD_QUEUE_BACKENDS = {
+    'inline': InlineUploadQueue,
+    'thread': ThreadedUploadQueue,
+}
+
+_lock = threading.Lock()
+
+
+def get_upload_queue(app):
+    """
+    Return the app's upload queue, creating and starting it on first use.
+
+    UPLOAD_QUEUE_BACKEND is either a key of UPLOAD_QUEUE_BACKENDS or the
+    dotted import path of a BaseUploadQueue subclass.
+    """
+    with _lock:
+        upload_queue = app.extensions.get('astm_upload_queue')
+        if(upload_queue is None):
+            backend = app.config['UPLOAD_QUEUE_BACKEND']
+            cls = UPLOAD_QUEUE_BACKENDS.get(backend) or import_string(backend)
+            upload_queue = cls(app)
+            upload_queue.start()
+            app.extensions['astm_upload_queue'] = upload_queue
+        return upload_queue
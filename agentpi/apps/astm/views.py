@@ -1,3 +1,5 @@
+import gzip
+import json
 import pprint
 
 from flask import Blueprint, jsonify, request, abort, current_app
@@ -19,7 +21,17 @@ def home():
     elif(request.method == 'POST'):
         key = request.headers.get('x-api-key')
         if key == current_app.config['TEST_UPLINK_API_KEY']:
-            pp.pprint(request.get_json())
+            data = request.get_data()
+            if(request.headers.get('Content-Encoding') == 'gzip'):
+                data = gzip.decompress(data)
+            payload = json.loads(data)
+            pp.pprint(payload)
+            if(isinstance(payload, list)):
+                # uplink.send_batch: one status per item, in order
+                return jsonify([
+                    200 if isinstance(item, dict) and item.get('vialId') else 400
+                    for item in payload
+                ])
             return('OK')
         else:
             abort(401)
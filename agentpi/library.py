@@ -1,4 +1,7 @@
 import re
+import math
+import threading
+import time
 from functools import wraps
 
 from flask import current_app, request
@@ -15,3 +18,50 @@ def is_ipv4(ip):
         return True
     else:
         return False
+
+
+def percentile(ordered, pct):
+    """
+    Nearest-rank percentile of an already sorted list (0.0 when empty)
+    """
+    if(not ordered):
+        return 0.0
+    rank = max(int(math.ceil(pct / 100.0 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket: `rate` tokens per second, bursts up to `burst`
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(self.rate, 1))
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.stamp) * self.rate
+        )
+        self.stamp = now
+
+    def try_acquire(self, tokens=1):
+        with self.lock:
+            self._refill()
+            if(self.tokens >= tokens):
+                self.tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1):
+        while True:
+            with self.lock:
+                self._refill()
+                if(self.tokens >= tokens):
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
@@ -0,0 +1,122 @@
+"""
+Requests/sec and bytes on the wire of single-item uploads (send_payload)
+vs gzipped batches (send_batch).
+
+    python -m benchmarks.bench_batch [payloads] [batch size]
+
+Runs against a local keep-alive stand-in for the SARS uplink that
+acknowledges batches per item, like the /api/test_result view.
+"""
+import gzip
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from agentpi.apps.astm.uplink import UplinkClient, send_batch, send_payload
+
+
+STATS = {'requests': 0, 'up': 0, 'down': 0}
+
+
+class Counting(object):
+    """
+    File wrapper adding what goes through it to STATS[key]
+    """
+    def __init__(self, raw, key):
+        self.raw = raw
+        self.key = key
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def read(self, *args):
+        data = self.raw.read(*args)
+        STATS[self.key] += len(data)
+        return data
+
+    def readline(self, *args):
+        data = self.raw.readline(*args)
+        STATS[self.key] += len(data)
+        return data
+
+    def write(self, data):
+        STATS[self.key] += len(data)
+        return self.raw.write(data)
+
+
+class StandInUplink(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.rfile = Counting(self.rfile, 'up')
+        self.wfile = Counting(self.wfile, 'down')
+
+    def do_POST(self):
+        STATS['requests'] += 1
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if(self.headers.get('Content-Encoding') == 'gzip'):
+            body = json.dumps(
+                [200] * len(json.loads(gzip.decompress(data)))
+            ).encode('utf-8')
+        else:
+            body = b'OK'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def payloads(count):
+    return [{
+        'vialId': f'UA01-{i:07d}',
+        'testType': 'SARS',
+        'results': 'negative',
+        'serialNo': '29000021',
+        'resultTime': '20200727154712',
+    } for i in range(count)]
+
+
+def run(title, send, items):
+    for key in STATS:
+        STATS[key] = 0
+    start = time.perf_counter()
+    uploaded = send()
+    elapsed = time.perf_counter() - start
+    assert uploaded == items, uploaded
+    print(
+        f"{title:<16} {STATS['requests']:6d} requests "
+        f"{STATS['requests'] / elapsed:8.0f} req/s "
+        f"{items / elapsed:8.0f} items/s   "
+        f"up {STATS['up'] / 1024:8.1f} KiB ({STATS['up'] / items:6.1f} B/item)  "
+        f"down {STATS['down'] / 1024:8.1f} KiB"
+    )
+
+
+def main(count=2000, size=50):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInUplink)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = UplinkClient(
+        f'http://127.0.0.1:{server.server_port}/api/test_result', 'test'
+    )
+    items = payloads(count)
+    run('single', lambda: sum(
+        send_payload(payload, client)[0] for payload in items
+    ), count)
+    run(f'batch of {size}', lambda: sum(
+        outcome[0]
+        for i in range(0, count, size)
+        for outcome in send_batch(items[i:i + size], client)
+    ), count)
+    client.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
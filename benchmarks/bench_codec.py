@@ -0,0 +1,82 @@
+"""
+Frames/sec of astm.codec vs agentpi.apps.astm.codec on the
+test_string_01..04 captures (checksums recomputed, some captures were
+edited by hand).
+
+    python -m benchmarks.bench_codec [rounds]
+"""
+import sys
+import time
+
+from astm import codec as astm_codec
+
+from agentpi.apps.astm import codec
+from agentpi.apps.astm.client import (
+    test_string_01, test_string_02, test_string_03, test_string_04
+)
+
+
+def reencode(messages):
+    frames = []
+    for message in messages:
+        seq, records = codec.decode_message(message, verify=codec.OFF)
+        frames.append(codec.build_frame(seq, records[0].raw + codec.CR))
+    return frames
+
+
+FRAMES = reencode(test_string_01 + test_string_02 + test_string_03 + test_string_04)
+
+# the fields the dispatcher reads
+USED = {'H': (4, 12, 13), 'P': (2, 25), 'O': (2, 4, 10, 15), 'C': (3,),
+        'R': (2, 3, 4, 5, 6, 8, 12), 'L': ()}
+
+
+def astm_decode(frame):
+    seq, records, cs = astm_codec.decode_message(frame, 'latin-1')
+    return records
+
+
+def astm_decode_used(frame):
+    seq, records, cs = astm_codec.decode_message(frame, 'latin-1')
+    return [[record[i] for i in USED[record[0]] if i < len(record)]
+            for record in records]
+
+
+def codec_decode(frame):
+    seq, records = codec.decode_message(frame)
+    return records
+
+
+def codec_decode_used(frame):
+    seq, records = codec.decode_message(frame)
+    return [[record.text(i) for i in USED[record.type]] for record in records]
+
+
+def rate(fn, frames, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for frame in frames:
+            fn(frame)
+    return rounds * len(frames) / (time.perf_counter() - start)
+
+
+def main(rounds=20000):
+    records = [astm_decode(frame)[0] for frame in FRAMES]
+    cases = [
+        ('checksum', lambda f: astm_codec.make_checksum(f[1:-4]),
+         lambda f: codec.checksum(memoryview(f)[1:-4]), FRAMES),
+        ('decode', astm_decode, codec_decode, FRAMES),
+        ('decode + used fields', astm_decode_used, codec_decode_used, FRAMES),
+        ('encode', lambda r: astm_codec.encode([r], 'latin-1'),
+         lambda r: codec.encode([r]), records),
+    ]
+    print(f"{'':<22} {'astm.codec':>14} {'codec':>14}")
+    for title, before, after, items in cases:
+        print(
+            f"{title:<22} {rate(before, items, rounds):>10.0f} f/s "
+            f"{rate(after, items, rounds):>10.0f} f/s"
+        )
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
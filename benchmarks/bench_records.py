@@ -0,0 +1,92 @@
+"""
+Per-record decode time: astm.codec plus the dispatcher's old positional
+picks vs codec.Record plus the compiled schema extractors, and strptime vs
+timestamps.parse_timestamp.
+
+    python -m benchmarks.bench_records [rounds]
+"""
+import sys
+import time
+from datetime import datetime
+
+from astm import codec as astm_codec
+
+from agentpi.apps.astm import codec
+from agentpi.apps.astm.schema import SCHEMAS
+from agentpi.apps.astm.timestamps import parse_timestamp
+from benchmarks.bench_codec import FRAMES
+
+
+def positional(record):
+    # what on_header/on_patient/on_order/on_comment/on_result used to do
+    rtype = record[0]
+    if(rtype == 'H'):
+        notfail = not (len(record) < 14)
+        model, serial = record[4] if (
+            record[4] and type(record[4]) == list
+        ) else (None, None)
+        timestamp = record[13] if notfail else None
+        if(timestamp):
+            timestamp = datetime.strptime(timestamp, "%Y%m%d%H%M%S")
+        return (model, serial, record[12] if notfail else None, timestamp)
+    elif(rtype == 'P'):
+        notfail = not (len(record) <= 25)
+        return (record[2] if notfail else None, record[25] if notfail else None)
+    elif(rtype == 'O'):
+        notfail = not (len(record) <= 15)
+        return tuple(record[i] if notfail else None for i in (2, 4, 10, 15))
+    elif(rtype == 'C'):
+        return record[3] if not (len(record) <= 3) else None
+    elif(rtype == 'R'):
+        notfail1 = not (len(record) <= 12)
+        notfail2 = notfail1 and (not (len(record[2]) <= 3))
+        completion = record[12] if notfail1 else None
+        if(completion):
+            completion = datetime.strptime(completion, "%Y%m%d%H%M%S")
+        return (record[2][3] if notfail2 else None,) + tuple(
+            record[i] if notfail1 else None for i in (3, 4, 5, 6, 8)
+        ) + (completion,)
+
+
+def before(frame):
+    seq, records, cs = astm_codec.decode_message(frame, 'latin-1')
+    return [positional(record) for record in records]
+
+
+def after(frame):
+    seq, records = codec.decode_message(frame)
+    return [
+        SCHEMAS[record.type](record) for record in records
+        if record.type in SCHEMAS
+    ]
+
+
+def per_record(fn, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for frame in FRAMES:
+            fn(frame)
+    return (time.perf_counter() - start) / (rounds * len(FRAMES))
+
+
+def per_call(fn, value, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn(value)
+    return (time.perf_counter() - start) / rounds
+
+
+def main(rounds=20000):
+    print(f"astm.codec + positional: {per_record(before, rounds) * 1e6:.2f}us/record")
+    print(f"codec + schema:          {per_record(after, rounds) * 1e6:.2f}us/record")
+    value = '20200727154712'
+    for title, fn in (
+        ('strptime', lambda v: datetime.strptime(v, "%Y%m%d%H%M%S")),
+        ('parse_timestamp, uncached', parse_timestamp.__wrapped__),
+        ('parse_timestamp, cached', parse_timestamp),
+    ):
+        print(f"{title:<26} {per_call(fn, value, rounds * 10) * 1e9:.0f}ns")
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
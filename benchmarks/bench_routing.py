@@ -0,0 +1,62 @@
+"""
+Routing cost per datagram as the rule table grows: the old chain of
+re.match calls vs the combined RoutingTable matcher.
+
+    python -m benchmarks.bench_routing [iterations]
+"""
+import re
+import sys
+import time
+
+from agentpi.apps.astm.routing import DEFAULT_RULES, RoutingTable
+
+
+VIAL_IDS = [
+    'UA01-0000001', 'UA12-1234567', 'TTabc123', 'UA01-TEST001',
+    'TST1-0000001', 'LAB999-000001', 'XYZ', '',
+]
+
+
+def extra_rules(count):
+    # rules that never match the sample IDs, placed *before* the defaults so
+    # every lookup has to get past all of them
+    return [{
+        'name': f'lab{i}',
+        'pattern': rf'^LAB{i:03d}-[0-9]{{6}}$',
+        'destination': 'test',
+    } for i in range(count)]
+
+
+def sequential(rules):
+    compiled = [(rule['pattern'], rule.get('destination')) for rule in rules]
+
+    def route(vial_id):
+        for pattern, destination in compiled:
+            if(re.match(pattern, vial_id)):
+                return destination
+        return None
+    return route
+
+
+def timed(route, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for vial_id in VIAL_IDS:
+            route(vial_id)
+    return (time.perf_counter() - start) / (iterations * len(VIAL_IDS))
+
+
+def main(iterations=20000):
+    print(f"{'rules':>6} {'re.match chain':>16} {'RoutingTable':>14}")
+    for extra in (0, 4, 16, 64, 256):
+        rules = extra_rules(extra) + DEFAULT_RULES
+        table = RoutingTable(rules)
+        before = timed(sequential(rules), iterations)
+        after = timed(table.route, iterations)
+        print(
+            f"{len(rules):>6} {before * 1e9:>14.0f}ns {after * 1e9:>12.0f}ns"
+        )
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
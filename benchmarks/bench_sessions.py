@@ -0,0 +1,66 @@
+"""
+Memory held by concurrent instrument sessions, measured with tracemalloc.
+
+    python -m benchmarks.bench_sessions [sessions]
+
+Opens `sessions` dispatchers, feeds each one a full H..R session (so they
+are all mid-datagram at once) and then the terminators. DB and uplink are
+disabled, only the dispatchers' own state is measured.
+"""
+import contextlib
+import os
+import sys
+import tracemalloc
+
+from flask import Flask
+
+from agentpi.apps.astm import codec
+from agentpi.apps.astm.client import test_string_01
+from agentpi.apps.astm.dispatcher import AgentRecordDispatcher
+
+
+def session(i):
+    frames = []
+    for message in test_string_01:
+        seq, records = codec.decode_message(message, verify=codec.OFF)
+        data = records[0].raw.replace(b'TST1-0000001', b'TST1-%07d' % i)
+        frames.append(codec.build_frame(seq, data + codec.CR))
+    return frames
+
+
+def main(sessions=1000):
+    app = Flask('bench_sessions')
+    app.config.from_object('config.Config')
+    app.config.update(DISABLE_DATABASE=True, DISABLE_UPLINK=True)
+    feeds = [session(i) for i in range(sessions)]
+
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        tracemalloc.start()
+        base = tracemalloc.take_snapshot()
+        start, _ = tracemalloc.get_traced_memory()
+        dispatchers = [
+            AgentRecordDispatcher(app=app) for _ in range(sessions)
+        ]
+        for step in range(len(test_string_01) - 1):
+            for dispatcher, frames in zip(dispatchers, feeds):
+                dispatcher(frames[step])
+        open_sessions, _ = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        for dispatcher, frames in zip(dispatchers, feeds):
+            dispatcher(frames[-1])
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    per_session = (open_sessions - start) / sessions
+    print(f"sessions:           {sessions}")
+    print(f"held per session:   {per_session / 1024:.2f} KiB")
+    print(f"held after L:       {(current - start) / sessions / 1024:.2f} KiB/session")
+    print(f"peak:               {(peak - start) / 1024 / 1024:.2f} MiB")
+    print("top allocations (open sessions):")
+    for stat in snapshot.compare_to(base, 'lineno')[:8]:
+        print(f"    {stat}")
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
@@ -0,0 +1,79 @@
+"""
+Datagram write latency of the local stores the dispatcher can sit on:
+spool.Spool (fsync per group commit, and without fsync) and
+sqlite_store.SqliteStore (WAL).
+
+    python -m benchmarks.bench_store [datagrams]
+"""
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from agentpi.apps.astm import codec
+from agentpi.apps.astm.client import test_string_01
+from agentpi.apps.astm.models import pack_messages
+from agentpi.apps.astm.schema import SCHEMAS
+from agentpi.apps.astm.spool import Spool, datagram_entry
+from agentpi.apps.astm.sqlite_store import SqliteStore
+from agentpi.library import percentile
+
+
+def entry():
+    records = {}
+    for message in test_string_01:
+        _, (record, ) = codec.decode_message(message, verify=codec.OFF)
+        if(record.type in SCHEMAS):
+            records[record.type] = SCHEMAS[record.type](record)
+    header = records['H']
+    return datagram_entry(
+        {
+            'instrument_model': header.instrument_model,
+            'instrument_serial_number': header.instrument_serial_number,
+            'instrument_firmware': header.firmware,
+            'instrument_timestamp': header.timestamp,
+            'messages': pack_messages(test_string_01),
+            'is_error': True,
+            'next_attempt_at': datetime.utcnow(),
+        },
+        records['P'],
+        records['O'],
+        [records['C']],
+        [records['R']],
+        upload=({'vialId': records['P'].patient_id}, 'test', None),
+    )
+
+
+def run(name, store, sample, datagrams):
+    timings = []
+    for _ in range(datagrams):
+        start = time.perf_counter()
+        store.append(sample)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    print(
+        f"{name:<18} p50 {percentile(timings, 50) * 1e3:7.3f} ms   "
+        f"p99 {percentile(timings, 99) * 1e3:7.3f} ms"
+    )
+
+
+def main(datagrams=2000):
+    sample = entry()
+    with tempfile.TemporaryDirectory() as directory:
+        run('spool (fsync)', Spool(f'{directory}/fsync'), sample, datagrams)
+        run(
+            'spool (no fsync)',
+            Spool(f'{directory}/nofsync', fsync=False),
+            sample,
+            datagrams,
+        )
+        run(
+            'sqlite (WAL)',
+            SqliteStore(f'{directory}/local.sqlite'),
+            sample,
+            datagrams,
+        )
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
@@ -0,0 +1,82 @@
+"""
+Per-request latency of one-shot requests.post vs the pooled UplinkClient.
+
+    python -m benchmarks.bench_uplink [requests]
+
+Runs against a local keep-alive stand-in for the SARS uplink.
+"""
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from agentpi.apps.astm.uplink import UplinkClient
+from agentpi.library import percentile
+
+
+PAYLOAD = json.dumps({
+    'vialId': 'UA01-0000001',
+    'testType': 'SARS',
+    'results': 'negative',
+    'serialNo': '29000021',
+    'resultTime': '20200727154712',
+})
+
+
+class StandInUplink(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'OK')
+
+    def log_message(self, *args):
+        pass
+
+
+def measure(send, count):
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        send().raise_for_status()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings
+
+
+def report(title, timings):
+    print(
+        f"{title:<24} n={len(timings)} "
+        f"p50={percentile(timings, 50) * 1000:.3f}ms "
+        f"p95={percentile(timings, 95) * 1000:.3f}ms "
+        f"p99={percentile(timings, 99) * 1000:.3f}ms "
+        f"total={sum(timings):.3f}s"
+    )
+
+
+def main(count=1000):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInUplink)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/api/test_result'
+    headers = {'Content-Type': 'application/json', 'x-api-key': 'test'}
+
+    report('requests.post (before)', measure(
+        lambda: requests.post(url, data=PAYLOAD, headers=headers), count
+    ))
+    client = UplinkClient(url, 'test')
+    report('UplinkClient (after)', measure(
+        lambda: client.post(PAYLOAD), count
+    ))
+    client.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
@@ -17,6 +17,52 @@ class Config(object):
 
     DEFAULT_LIS_NIC = environ.get('DEFAULT_LIS_NIC')
     DEFAULT_LIS_PORT = environ.get('DEFAULT_LIS_PORT')
+    # Listener: asyncio | legacy (astm asyncore server)
+    LIS_ENGINE = environ.get('LIS_ENGINE', 'legacy')
+    # Listeners, 'eth0:11011,eth1:11012@bench' (instead of DEFAULT_LIS_*)
+    LIS_BINDS = environ.get('LIS_BINDS', '')
+    # Profile name -> config overrides, JSON: '{"bench": {"DISABLE_UPLINK": true}}'
+    LIS_PROFILES = environ.get('LIS_PROFILES', '{}')
+    LIS_EXECUTOR_WORKERS = int(environ.get('LIS_EXECUTOR_WORKERS', 8))
+    LIS_CONNECTION_TIMEOUT = int(environ.get('LIS_CONNECTION_TIMEOUT', 0))  # 0 = never
+    # Frame checksums: strict (NAK) | warn (log, accept) | off
+    LIS_CHECKSUM = environ.get('LIS_CHECKSUM', 'strict')
+    # Raw messages stored per datagram, bytes (0 = no limit); past
+    # LIS_MESSAGE_SPOOL_BYTES they are held in a temp file (0 = memory only)
+    LIS_MESSAGE_MAX_BYTES = int(environ.get('LIS_MESSAGE_MAX_BYTES', 1048576))
+    LIS_MESSAGE_SPOOL_BYTES = int(environ.get('LIS_MESSAGE_SPOOL_BYTES', 65536))
+    # Write-ahead spool directory, datagrams are fsynced there and loaded
+    # into the DB in the background ('' = straight to the DB)
+    LIS_SPOOL_DIR = environ.get('LIS_SPOOL_DIR', '')
+    LIS_SPOOL_SEGMENT_BYTES = int(environ.get('LIS_SPOOL_SEGMENT_BYTES', 16777216))
+    LIS_SPOOL_FSYNC = False if environ.get('LIS_SPOOL_FSYNC', 'true').lower() == 'false' else True
+    LIS_SPOOL_BATCH_SIZE = int(environ.get('LIS_SPOOL_BATCH_SIZE', 100))
+    LIS_SPOOL_INTERVAL = float(environ.get('LIS_SPOOL_INTERVAL', 0.5))
+    # Or a local SQLite file (WAL) synced to the DB in bulk (LIS_SPOOL_DIR
+    # and LIS_SQLITE_STORE are exclusive); synced rows are kept for
+    # LIS_SQLITE_KEEP_DAYS
+    LIS_SQLITE_STORE = environ.get('LIS_SQLITE_STORE', '')
+    LIS_SQLITE_SYNC_BATCH = int(environ.get('LIS_SQLITE_SYNC_BATCH', 500))
+    LIS_SQLITE_SYNC_INTERVAL = float(environ.get('LIS_SQLITE_SYNC_INTERVAL', 1.0))
+    LIS_SQLITE_KEEP_DAYS = int(environ.get('LIS_SQLITE_KEEP_DAYS', 7))
+    # Results (serial|vial ID|completion) remembered to drop instrument
+    # retransmits before they reach the DB (0 = only the DB's unique index)
+    LIS_DEDUP_CACHE_SIZE = int(environ.get('LIS_DEDUP_CACHE_SIZE', 10000))
+
+    # Backpressure toward the instruments (off | nak | delay | refuse) once
+    # a backlog passes its high watermark, until all are under their low
+    # one: queued uploads, spool bytes not ingested, SQLite rows not synced
+    # (0 = not watched). `delay` holds an ENQ up to LIS_BACKPRESSURE_DELAY
+    # seconds first (asyncio engine; instruments give up after 15s)
+    LIS_BACKPRESSURE_ACTION = environ.get('LIS_BACKPRESSURE_ACTION', 'nak')
+    LIS_BACKPRESSURE_INTERVAL = float(environ.get('LIS_BACKPRESSURE_INTERVAL', 1.0))
+    LIS_BACKPRESSURE_DELAY = float(environ.get('LIS_BACKPRESSURE_DELAY', 10))
+    LIS_BACKPRESSURE_UPLOADS_HIGH = int(environ.get('LIS_BACKPRESSURE_UPLOADS_HIGH', 800))
+    LIS_BACKPRESSURE_UPLOADS_LOW = int(environ.get('LIS_BACKPRESSURE_UPLOADS_LOW', 200))
+    LIS_BACKPRESSURE_SPOOL_HIGH = int(environ.get('LIS_BACKPRESSURE_SPOOL_HIGH', 256 * 1024 * 1024))
+    LIS_BACKPRESSURE_SPOOL_LOW = int(environ.get('LIS_BACKPRESSURE_SPOOL_LOW', 64 * 1024 * 1024))
+    LIS_BACKPRESSURE_STORE_HIGH = int(environ.get('LIS_BACKPRESSURE_STORE_HIGH', 10000))
+    LIS_BACKPRESSURE_STORE_LOW = int(environ.get('LIS_BACKPRESSURE_STORE_LOW', 2000))
 
     # Flask-SQLAlchemy
     SQLALCHEMY_DATABASE_URI = environ.get('SQLALCHEMY_DATABASE_URI')
@@ -41,11 +87,72 @@ class Config(object):
     TEST_UPLINK_API_URL = environ.get('TEST_UPLINK_API_URL')
     TEST_UPLINK_API_KEY = environ.get('TEST_UPLINK_API_KEY')
 
+    AUDIT_UPLINK_API_URL = environ.get('AUDIT_UPLINK_API_URL')
+    AUDIT_UPLINK_API_KEY = environ.get('AUDIT_UPLINK_API_KEY')
+
+    # Shared keep-alive uplink sessions (per destination)
+    UPLINK_POOL_MAXSIZE = int(environ.get('UPLINK_POOL_MAXSIZE', 4))
+    UPLINK_CONNECT_TIMEOUT = float(environ.get('UPLINK_CONNECT_TIMEOUT', 3.05))
+    UPLINK_READ_TIMEOUT = float(environ.get('UPLINK_READ_TIMEOUT', 10))
+    UPLINK_RETRY_TOTAL = int(environ.get('UPLINK_RETRY_TOTAL', 2))
+    UPLINK_RETRY_BACKOFF = float(environ.get('UPLINK_RETRY_BACKOFF', 0.3))
+    # Circuit breaker per destination: open after this many failures in a
+    # row (0 = never), probe again after UPLINK_BREAKER_RESET seconds
+    UPLINK_BREAKER_THRESHOLD = int(environ.get('UPLINK_BREAKER_THRESHOLD', 5))
+    UPLINK_BREAKER_RESET = float(environ.get('UPLINK_BREAKER_RESET', 30))
+    # Read timeout = factor x p95 latency, within [UPLINK_TIMEOUT_MIN,
+    # UPLINK_READ_TIMEOUT] (factor 0 = always UPLINK_READ_TIMEOUT)
+    UPLINK_TIMEOUT_FACTOR = float(environ.get('UPLINK_TIMEOUT_FACTOR', 3.0))
+    UPLINK_TIMEOUT_MIN = float(environ.get('UPLINK_TIMEOUT_MIN', 1.0))
+    # Destinations ('sars,test') that take batches, a gzipped JSON array per
+    # POST acknowledged per item; sent at UPLINK_BATCH_SIZE items or
+    # UPLINK_BATCH_WAIT_MS after the first (thread upload queue only)
+    UPLINK_BATCH_DESTINATIONS = environ.get('UPLINK_BATCH_DESTINATIONS', '')
+    UPLINK_BATCH_SIZE = int(environ.get('UPLINK_BATCH_SIZE', 50))
+    UPLINK_BATCH_WAIT_MS = int(environ.get('UPLINK_BATCH_WAIT_MS', 200))
+
+    # Vial ID routing rules, JSON list (default: routing.DEFAULT_RULES);
+    # a file is re-read on SIGHUP
+    ROUTING_RULES = environ.get('ROUTING_RULES')
+    ROUTING_RULES_FILE = environ.get('ROUTING_RULES_FILE')
+
     DISABLE_UPLINK = True if environ.get('DISABLE_UPLINK', 'false').lower() == 'true' else False
     DISABLE_DATABASE = True if environ.get('DISABLE_DATABASE', 'false').lower() == 'true' else False
 
     SLACK_WEBHOOK = environ.get('SLACK_WEBHOOK', '')
     SLACK_CHANNEL_ENABLED = environ.get('SLACK_CHANNEL_ENABLED', False)
+    # Notifier: queued notices (more are dropped), sent at SLACK_RATE per
+    # second (bursts of SLACK_BURST); repeats within SLACK_DIGEST_SECONDS
+    # are sent as one digest
+    SLACK_QUEUE_MAXSIZE = int(environ.get('SLACK_QUEUE_MAXSIZE', 100))
+    SLACK_RATE = float(environ.get('SLACK_RATE', 1.0))
+    SLACK_BURST = int(environ.get('SLACK_BURST', 5))
+    SLACK_DIGEST_SECONDS = float(environ.get('SLACK_DIGEST_SECONDS', 60))
+
+    # Outbound upload queue (inline | thread | dotted.path.Class)
+    UPLOAD_QUEUE_BACKEND = environ.get('UPLOAD_QUEUE_BACKEND', 'thread')
+    UPLOAD_QUEUE_WORKERS = int(environ.get('UPLOAD_QUEUE_WORKERS', 2))
+    UPLOAD_QUEUE_MAXSIZE = int(environ.get('UPLOAD_QUEUE_MAXSIZE', 1000))
+    UPLOAD_QUEUE_PUT_TIMEOUT = float(environ.get('UPLOAD_QUEUE_PUT_TIMEOUT', 0.05))
+    # Sinks ('audit,archive') every uploaded result also goes to, on their
+    # own queues; workers per destination, JSON (default UPLOAD_QUEUE_WORKERS)
+    UPLOAD_FANOUT = environ.get('UPLOAD_FANOUT', '')
+    UPLOAD_DESTINATION_WORKERS = environ.get(
+        'UPLOAD_DESTINATION_WORKERS', '{"archive": 1}'
+    )
+    # 'archive' sink: daily results-YYYYMMDD.ndjson files
+    LIS_ARCHIVE_DIR = environ.get('LIS_ARCHIVE_DIR', '')
+
+    # Upload retry service (seconds unless noted)
+    RETRY_INITIAL_DELAY = int(environ.get('RETRY_INITIAL_DELAY', 60))
+    RETRY_BACKOFF_BASE = int(environ.get('RETRY_BACKOFF_BASE', 30))
+    RETRY_BACKOFF_MAX = int(environ.get('RETRY_BACKOFF_MAX', 3600))
+    RETRY_MAX_ATTEMPTS = int(environ.get('RETRY_MAX_ATTEMPTS', 20))  # 0 = forever
+    RETRY_BATCH_SIZE = int(environ.get('RETRY_BATCH_SIZE', 100))
+    RETRY_POLL_INTERVAL = int(environ.get('RETRY_POLL_INTERVAL', 60))
+
+    # Seconds between metric snapshots in the log (0 = off)
+    METRICS_LOG_INTERVAL = int(environ.get('METRICS_LOG_INTERVAL', 300))
 
     LOGGING = {
         'version': 1,
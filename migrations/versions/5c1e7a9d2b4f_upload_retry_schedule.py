@@ -0,0 +1,49 @@
+"""Upload retry schedule on lis_datagram
+
+Revision ID: 5c1e7a9d2b4f
+Revises: 192fe90d6f8d
+Create Date: 2026-10-18 10:12:40.118402
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1e7a9d2b4f'
+down_revision = '192fe90d6f8d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    # create_app() (db.create_all) made a fresh lis_datagram with them
+    columns = {c['name'] for c in inspector.get_columns('lis_datagram')}
+    indexes = {i['name'] for i in inspector.get_indexes('lis_datagram')}
+    if('upload_attempts' not in columns):
+        op.add_column('lis_datagram', sa.Column('upload_attempts', sa.Integer(), nullable=True))
+    if('next_attempt_at' not in columns):
+        op.add_column('lis_datagram', sa.Column('next_attempt_at', sa.DateTime(), nullable=True))
+    # Hand the backlog the old `flask publish_results` sweep covered to the
+    # retry service: failed UAxx uploads since 2020-10-15, due right away
+    op.execute(
+        "UPDATE lis_datagram SET upload_attempts = 0, next_attempt_at = created_at "
+        "WHERE is_error AND NOT is_uploaded AND is_vialid_uaxx "
+        "AND created_at > '2020-10-15'"
+    )
+    if('ix_lis_datagram_retry' in indexes):
+        return
+    op.create_index(
+        'ix_lis_datagram_retry',
+        'lis_datagram',
+        ['next_attempt_at'],
+        unique=False,
+        postgresql_where=sa.text('is_error AND NOT is_uploaded')
+    )
+
+
+def downgrade():
+    op.drop_index('ix_lis_datagram_retry', table_name='lis_datagram')
+    op.drop_column('lis_datagram', 'next_attempt_at')
+    op.drop_column('lis_datagram', 'upload_attempts')
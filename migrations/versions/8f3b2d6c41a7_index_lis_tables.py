@@ -0,0 +1,54 @@
+"""Index lis_* foreign keys and lookup columns
+
+Revision ID: 8f3b2d6c41a7
+Revises: 5c1e7a9d2b4f
+Create Date: 2026-10-18 11:02:17.530911
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f3b2d6c41a7'
+down_revision = '5c1e7a9d2b4f'
+branch_labels = None
+depends_on = None
+
+
+# (index, table, columns) -- the failed upload partial index
+# (ix_lis_datagram_retry) already comes from 5c1e7a9d2b4f
+INDEXES = [
+    ('ix_lis_datagram_instrument_serial_number', 'lis_datagram', ['instrument_serial_number']),
+    ('ix_lis_datagram_created_at', 'lis_datagram', ['created_at']),
+    ('ix_lis_patient_patient_id', 'lis_patient', ['patient_id']),
+    ('ix_lis_patient_dgid', 'lis_patient', ['dgid']),
+    ('ix_lis_order_dgid', 'lis_order', ['dgid']),
+    ('ix_lis_comment_dgid', 'lis_comment', ['dgid']),
+    ('ix_lis_result_dgid', 'lis_result', ['dgid']),
+]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    # create_app() (db.create_all) made fresh tables with them
+    existing = {
+        (table, index['name'])
+        for table in {table for _, table, _ in INDEXES}
+        for index in inspector.get_indexes(table)
+    }
+    # CONCURRENTLY so the listener can keep writing while these build
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            if((table, name) in existing):
+                continue
+            op.create_index(
+                name, table, columns, unique=False,
+                postgresql_concurrently=True
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
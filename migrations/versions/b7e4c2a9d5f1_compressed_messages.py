@@ -0,0 +1,118 @@
+"""Move lis_datagram.messages to a compressed lis_messages table
+
+Revision ID: b7e4c2a9d5f1
+Revises: 8f3b2d6c41a7
+Create Date: 2026-10-18 18:20:05.291774
+
+"""
+import json
+import re
+import zlib
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e4c2a9d5f1'
+down_revision = '8f3b2d6c41a7'
+branch_labels = None
+depends_on = None
+
+
+BATCH_SIZE = 5000
+
+# frozen copies of models.pack_messages / unpack_messages
+FRAME = re.compile(rb'\x02.*?\r\n', re.S)
+
+
+def pack(messages):
+    return zlib.compress(b''.join(m.encode('utf-8') for m in messages), 6)
+
+
+def unpack(data):
+    return [
+        m.decode('utf-8', 'replace')
+        for m in FRAME.findall(zlib.decompress(data))
+    ]
+
+
+def batches(conn, sql):
+    """
+    Rows of `sql` (selecting dgid first, after :last) BATCH_SIZE at a time
+    """
+    last = 0
+    while True:
+        rows = conn.execute(
+            sa.text(sql), last=last, limit=BATCH_SIZE
+        ).fetchall()
+        if(not rows):
+            return
+        yield rows
+        last = rows[-1][0]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    # create_app() (db.create_all) makes missing tables before this runs
+    if('lis_messages' not in inspector.get_table_names()):
+        op.create_table(
+            'lis_messages',
+            sa.Column('dgid', sa.Integer(), nullable=False),
+            sa.Column('data', sa.LargeBinary(), nullable=False),
+            sa.ForeignKeyConstraint(['dgid'], ['lis_datagram.dgid'], ),
+            sa.PrimaryKeyConstraint('dgid')
+        )
+    if('messages' not in {
+        column['name'] for column in inspector.get_columns('lis_datagram')
+    }):
+        # lis_datagram made by create_all, nothing to move
+        return
+    messages = sa.table(
+        'lis_messages', sa.column('dgid'), sa.column('data', sa.LargeBinary)
+    )
+    # one commit per batch so the listener isn't locked out for the whole
+    # backfill; rows already copied are skipped if this is run again
+    with op.get_context().autocommit_block():
+        conn = op.get_bind()
+        for rows in batches(conn, """
+            SELECT d.dgid, d.messages FROM lis_datagram d
+            WHERE d.dgid > :last AND d.messages IS NOT NULL
+            AND NOT EXISTS (SELECT 1 FROM lis_messages m WHERE m.dgid = d.dgid)
+            ORDER BY d.dgid LIMIT :limit
+        """):
+            conn.execute(messages.insert(), [
+                {
+                    'dgid': dgid,
+                    'data': pack(
+                        json.loads(data) if isinstance(data, str) else data
+                    ),
+                } for dgid, data in rows
+            ])
+    op.drop_column('lis_datagram', 'messages')
+    # the space only comes back with VACUUM FULL lis_datagram (or pg_repack)
+
+
+def downgrade():
+    op.add_column(
+        'lis_datagram',
+        sa.Column('messages', postgresql.JSONB(), nullable=True)
+    )
+    with op.get_context().autocommit_block():
+        conn = op.get_bind()
+        for rows in batches(conn, """
+            SELECT dgid, data FROM lis_messages
+            WHERE dgid > :last ORDER BY dgid LIMIT :limit
+        """):
+            conn.execute(
+                sa.text(
+                    "UPDATE lis_datagram SET messages = CAST(:messages AS JSONB) "
+                    "WHERE dgid = :dgid"
+                ),
+                [
+                    {'dgid': dgid, 'messages': json.dumps(unpack(data))}
+                    for dgid, data in rows
+                ]
+            )
+    op.drop_table('lis_messages')
@@ -0,0 +1,74 @@
+"""Unique lis_datagram.natural_key and a duplicates counter
+
+Revision ID: d3a8f1c6e207
+Revises: b7e4c2a9d5f1
+Create Date: 2026-10-18 20:41:37.118240
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3a8f1c6e207'
+down_revision = 'b7e4c2a9d5f1'
+branch_labels = None
+depends_on = None
+
+
+# dedup.natural_key of the stored datagrams with exactly one result; the
+# oldest copy gets the key, later copies are counted and keep NULL
+BACKFILL = """
+    WITH keyed AS (
+        SELECT d.dgid,
+               d.instrument_serial_number || '|' || p.patient_id || '|'
+               || to_char(r.completion, 'YYYYMMDDHH24MISS') AS natural_key
+        FROM lis_datagram d
+        JOIN lis_patient p ON p.dgid = d.dgid
+        JOIN lis_result r ON r.dgid = d.dgid
+        WHERE d.instrument_serial_number <> '' AND p.patient_id <> ''
+        AND r.completion IS NOT NULL
+        AND (SELECT count(*) FROM lis_result o WHERE o.dgid = d.dgid) = 1
+    ), first AS (
+        SELECT natural_key, min(dgid) AS dgid, count(*) - 1 AS duplicates
+        FROM keyed GROUP BY natural_key
+    )
+    UPDATE lis_datagram d
+    SET natural_key = first.natural_key, duplicates = first.duplicates
+    FROM first WHERE d.dgid = first.dgid
+"""
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    # create_app() (db.create_all) made a fresh lis_datagram with them
+    columns = {c['name'] for c in inspector.get_columns('lis_datagram')}
+    indexes = {i['name'] for i in inspector.get_indexes('lis_datagram')}
+    if('natural_key' not in columns):
+        op.add_column(
+            'lis_datagram',
+            sa.Column('natural_key', sa.String(length=64), nullable=True)
+        )
+        op.add_column(
+            'lis_datagram',
+            sa.Column('duplicates', sa.Integer(), server_default='0', nullable=True)
+        )
+        op.execute(BACKFILL)
+    if('ux_lis_datagram_natural_key' in indexes):
+        return
+    # CONCURRENTLY so the listener can keep writing while it builds
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ux_lis_datagram_natural_key', 'lis_datagram', ['natural_key'],
+            unique=True, postgresql_concurrently=True
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            'ux_lis_datagram_natural_key', table_name='lis_datagram',
+            postgresql_concurrently=True
+        )
+    op.drop_column('lis_datagram', 'duplicates')
+    op.drop_column('lis_datagram', 'natural_key')
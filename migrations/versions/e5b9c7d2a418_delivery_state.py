@@ -0,0 +1,37 @@
+"""Per destination delivery state (lis_delivery)
+
+Revision ID: e5b9c7d2a418
+Revises: d3a8f1c6e207
+Create Date: 2026-10-18 21:36:52.407113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b9c7d2a418'
+down_revision = 'd3a8f1c6e207'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # create_app() (db.create_all) makes missing tables before this runs
+    if('lis_delivery' in sa.inspect(op.get_bind()).get_table_names()):
+        return
+    op.create_table(
+        'lis_delivery',
+        sa.Column('dgid', sa.Integer(), nullable=False),
+        sa.Column('destination', sa.String(length=12), nullable=False),
+        sa.Column('status', sa.String(length=8), nullable=False),
+        sa.Column('failure', sa.String(length=32), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['dgid'], ['lis_datagram.dgid'], ),
+        sa.PrimaryKeyConstraint('dgid', 'destination')
+    )
+
+
+def downgrade():
+    op.drop_table('lis_delivery')
@@ -0,0 +1,35 @@
+"""Routed destination on lis_datagram, for the retry service
+
+Revision ID: f2a6d8c4e1b9
+Revises: e5b9c7d2a418
+Create Date: 2026-10-18 18:52:14.603318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2a6d8c4e1b9'
+down_revision = 'e5b9c7d2a418'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = {
+        column['name']
+        for column in sa.inspect(op.get_bind()).get_columns('lis_datagram')
+    }
+    # create_app() (db.create_all) made lis_datagram with it already
+    if('upload_destination' in columns):
+        return
+    # rows stored before are routed again by the default rules on retry
+    op.add_column(
+        'lis_datagram',
+        sa.Column('upload_destination', sa.String(length=12), nullable=True)
+    )
+
+
+def downgrade():
+    op.drop_column('lis_datagram', 'upload_destination')